@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Rackspace Hosting
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measurement of benchmark cases that must run inside an event loop, for
+run.py.  Kept apart from it because async syntax needs Python 3.
+"""
+
+import asyncio
+import timeit
+import tracemalloc
+
+# Calls between event loop iterations.  AsyncioStatsdMetricsLogger sends the
+# lines written during one iteration on the next, so this bounds the lines
+# pending, as an application yielding to the loop would
+CALLS_PER_ITERATION = 100
+
+
+async def _run_calls(timer, number):
+    remaining = number
+    while remaining:
+        calls = min(remaining, CALLS_PER_ITERATION)
+        timer.timeit(calls)
+        remaining -= calls
+        await asyncio.sleep(0)
+
+
+async def _measure(func, number, repeat, memory_number):
+    timer = timeit.Timer(func)
+    # The first send opens the datagram transport
+    func()
+    await asyncio.sleep(0.01)
+
+    best = None
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        await _run_calls(timer, number)
+        elapsed = timeit.default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    try:
+        await _run_calls(timer, memory_number)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best / number * 1e9, peak, current / float(memory_number)
+
+
+def measure(func, number, repeat, memory_number):
+    """Measure func inside a running event loop, including the loop
+    iterations that send what it emits.
+
+    :returns: (best ns per call over repeat runs of number calls, peak bytes
+        allocated and bytes retained per call over memory_number calls)
+    """
+    return asyncio.run(_measure(func, number, repeat, memory_number))
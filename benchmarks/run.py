@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Rackspace Hosting
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Micro-benchmarks of every emit path, on each backend.  Run from the
+repository root with `make bench`, or:
+
+    PYTHONPATH=. python benchmarks/run.py [--filter REGEX] [--json FILE]
+                                          [--compare BASELINE.json]
+
+For each case, prints the best time per operation over several repeats and,
+where tracemalloc is available (Python 3), the peak memory allocated while
+running the case and the memory it retained per operation.  CPython has no
+allocation counter, so allocation cost is reported in bytes.  The asyncio
+cases (Python 3.7+) run inside an event loop that iterates every
+aio_cases.CALLS_PER_ITERATION calls, and their times include sending.  A
+case that drops metrics, e.g. because a queue filled up, is an error: its
+time would be that of the drop path.
+
+--json writes the results as JSON; --compare prints the change against a
+previous --json file, and exits with status 1 if any case slowed down by
+more than --threshold percent.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import re
+import socket
+import sys
+import time
+import timeit
+
+import metricslogging
+import metricslogging.runtime
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+if sys.version_info >= (3, 7):
+    import aio_cases
+    import metricslogging.aio
+else:
+    aio_cases = None
+
+# Most metrics a case emits per call
+MAX_METRICS_PER_CALL = 20
+
+
+def _logger(cls, sink=None):
+    logger = cls()
+    logger.setPrefix('service')
+    logger.setPrependHost(False)
+    if sink is not None:
+        logger.setStatsdHost('127.0.0.1')
+        logger.setStatsdPort(sink.getsockname()[1])
+    return logger
+
+
+def _emit_cases(prefix, logger):
+    """Cases for the public emit methods of logger."""
+    gauge = logger.gauge_handle('active')
+    counter = logger.counter_handle('requests')
+    timer = logger.timer_handle('latency')
+    tags = metricslogging.getTagSet({'region': 'dfw'})
+    names = ['pool%d' % i for i in range(MAX_METRICS_PER_CALL)]
+    values = list(range(MAX_METRICS_PER_CALL))
+    batch = [('gauge', name, value) for name, value in zip(names, values)]
+
+    def gauges_20():
+        for name, value in zip(names, values):
+            logger.gauge(name, value)
+
+    return [
+        (prefix + '.gauge', lambda: logger.gauge('active', 10)),
+        (prefix + '.counter', lambda: logger.counter('requests', 1)),
+        (prefix + '.counter_sampled',
+         lambda: logger.counter('requests', 1, sample_rate=0.5)),
+        (prefix + '.timer', lambda: logger.timer('latency', 1.5)),
+        (prefix + '.gauge_tags',
+         lambda: logger.gauge('active', 10, tags={'region': 'dfw'})),
+        (prefix + '.gauge_tagset',
+         lambda: logger.gauge('active', 10, tags=tags)),
+        (prefix + '.gauge_handle', lambda: gauge.set(10)),
+        (prefix + '.counter_handle', counter.inc),
+        (prefix + '.timer_handle', lambda: timer.record(1.5)),
+        (prefix + '.gauge_x20', gauges_20),
+        (prefix + '.emit_many_x20', lambda: logger.emit_many(batch)),
+        (prefix + '.emit_gauges_x20',
+         lambda: logger.emit_gauges(names, values)),
+    ]
+
+
+def _decorator_cases(prefix, logger):
+    """Cases for the context decorators of logger, against an undecorated
+    call of the same function.
+    """
+    def func():
+        return 42
+
+    timed = logger.timer_cd('latency')(func)
+    counted = logger.counter_cd('calls')(func)
+    gauged = logger.return_val_gauge_d('result')(func)
+    timer_cd = logger.timer_cd('latency')
+
+    def timer_cd_block():
+        with timer_cd:
+            func()
+
+    return [
+        (prefix + '.undecorated', func),
+        (prefix + '.timer_cd', timed),
+        (prefix + '.timer_cd_block', timer_cd_block),
+        (prefix + '.counter_cd', counted),
+        (prefix + '.return_val_gauge_d', gauged),
+    ]
+
+
+def _internal_cases(logger):
+    """Cases for the formatting steps of the statsd emit path."""
+    names = ['metric%d' % i for i in range(100)]
+    index = [0]
+
+    def format_name_uncached():
+        logger._format_name_uncached('active')
+
+    def format_name_cached():
+        logger.format_name('active')
+
+    def sanitize():
+        logger._sanitize(names[index[0] % 100])
+        index[0] += 1
+
+    return [
+        ('internal.format_name_uncached', format_name_uncached),
+        ('internal.format_name', format_name_cached),
+        ('internal.sanitize', sanitize),
+        ('internal.sanitize_dirty', lambda: logger._sanitize('a|b:c')),
+        ('internal.getTagSet',
+         lambda: metricslogging.getTagSet({'region': 'dfw'})),
+    ]
+
+
+def _processor_cases(sink):
+    dropping = _logger(metricslogging.StatsdMetricsLogger, sink)
+    dropping.setProcessors([metricslogging.NameFilter(deny=['dropped.*'])])
+    passing = _logger(metricslogging.StatsdMetricsLogger, sink)
+    passing.setProcessors([metricslogging.NameFilter(allow=['active'])])
+    return [
+        ('processors.filter_drop', lambda: dropping.gauge('dropped.x', 1)),
+        ('processors.filter_pass', lambda: passing.gauge('active', 1)),
+    ]
+
+
+def cases(sink):
+    """Return the (name, callable) benchmark cases."""
+    noop = _logger(metricslogging.NoopMetricsLogger)
+    statsd = _logger(metricslogging.StatsdMetricsLogger, sink)
+    batched = _logger(metricslogging.StatsdMetricsLogger, sink)
+    batched.setStatsdPacketSize(batched.PACKET_SIZE_ETHERNET)
+    batched.setStatsdFlushInterval(None)
+    aggregating = _logger(metricslogging.AggregatingMetricsLogger, sink)
+    aggregating.setAggregateInterval(None)
+    async_statsd = _logger(metricslogging.StatsdMetricsLogger, sink)
+    async_statsd.setAsyncDelivery(True)
+    child = statsd.child('db').child('query')
+
+    result = []
+    result += _emit_cases('noop', noop)
+    result += _emit_cases('statsd', statsd)
+    result += _emit_cases('statsd_batched', batched)
+    result += _emit_cases('statsd_async', async_statsd)
+    result += _emit_cases('aggregating', aggregating)
+    result += [('statsd.child_gauge', lambda: child.gauge('active', 10))]
+    result += _decorator_cases('noop', noop)
+    result += _decorator_cases('statsd', statsd)
+    result += _internal_cases(statsd)
+    result += _processor_cases(sink)
+    result += [('runtime.collect',
+                metricslogging.runtime.RuntimeCollector().collect)]
+    return result
+
+
+def loop_cases(sink):
+    """Return the (name, callable) benchmark cases to run inside an event
+    loop.
+    """
+    if aio_cases is None:
+        return []
+    logger = _logger(metricslogging.aio.AsyncioStatsdMetricsLogger, sink)
+    return _emit_cases('asyncio', logger)
+
+
+def measure_memory(func, number):
+    """Return (peak bytes allocated, bytes retained per call) while calling
+    func number times, or (None, None) without tracemalloc.
+    """
+    if tracemalloc is None:
+        return None, None
+    func()
+    tracemalloc.start()
+    try:
+        for _ in range(number):
+            func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak, current / float(number)
+
+
+def dropped():
+    """Metrics dropped so far by the async delivery queue and transports."""
+    stats = metricslogging.getStats()
+    return stats['async']['dropped'] + sum(
+        values.get('dropped', 0) for values in stats['transports'].values())
+
+
+def _settle():
+    """Send the metrics queued and batched by the previous run."""
+    metricslogging.metricslogging._async_sender.drain()
+    metricslogging.flush()
+
+
+def measure_time(func, number, repeat):
+    """Best time per call over repeat runs of number calls, in ns."""
+    best = None
+    for _ in range(repeat):
+        elapsed = timeit.timeit(func, number=number)
+        # Keep batched and queued metrics from piling up across runs
+        _settle()
+        best = elapsed if best is None else min(best, elapsed)
+    return best / number * 1e9
+
+
+def run(selected, number, repeat):
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    # Room for everything a timing run queues, so the async delivery cases
+    # time queueing rather than the drop path
+    queue_size = metricslogging.getAsyncQueueSize()
+    metricslogging.setAsyncQueueSize(
+        max(queue_size, number * MAX_METRICS_PER_CALL))
+    memory_number = min(number, 1000)
+    all_cases = [(name, func, False) for name, func in cases(sink)] + \
+        [(name, func, True) for name, func in loop_cases(sink)]
+    try:
+        for name, func, in_loop in all_cases:
+            if selected is not None and not selected.search(name):
+                continue
+            dropped_before = dropped()
+            if in_loop:
+                ns, peak, retained = aio_cases.measure(
+                    func, number, repeat, memory_number)
+            else:
+                ns = measure_time(func, number, repeat)
+                peak, retained = measure_memory(func, memory_number)
+            _settle()
+            lost = dropped() - dropped_before
+            if lost:
+                raise RuntimeError('%s dropped %d metrics, so its time is '
+                                   'that of the drop path' % (name, lost))
+            yield name, {'ns_per_op': ns,
+                         'alloc_peak_bytes': peak,
+                         'alloc_retained_bytes_per_op': retained}
+    finally:
+        metricslogging.setAsyncQueueSize(queue_size)
+        sink.close()
+
+
+def _format_bytes(value, fmt):
+    return fmt % value if value is not None else '-'
+
+
+def compare(results, baseline, threshold):
+    """Print the change of each case against baseline.
+
+    :returns: Names of the cases slower by more than threshold percent
+    """
+    regressions = []
+    print()
+    print('%-36s %12s %12s %9s' % ('case', 'baseline ns', 'ns/op', 'change'))
+    for name in sorted(results):
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        new_ns = results[name]['ns_per_op']
+        change = (new_ns - old['ns_per_op']) / old['ns_per_op'] * 100
+        flag = ''
+        if change > threshold:
+            flag = ' !'
+            regressions.append(name)
+        print('%-36s %12.0f %12.0f %+8.1f%%%s' % (
+            name, old['ns_per_op'], new_ns, change, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='metricslogging micro-benchmarks')
+    parser.add_argument('--filter', help='Only run cases matching REGEX',
+                        metavar='REGEX')
+    parser.add_argument('--number', type=int, default=20000,
+                        help='Calls per timing run')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Timing runs per case; the best is reported')
+    parser.add_argument('--json', metavar='FILE',
+                        help='Write the results as JSON to FILE')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Compare against results written by --json')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Slowdown in percent that --compare fails on')
+    args = parser.parse_args(argv)
+
+    selected = re.compile(args.filter) if args.filter else None
+
+    print('%-36s %12s %12s %14s' % ('case', 'ns/op', 'peak bytes',
+                                    'retained b/op'))
+    results = dict()
+    for name, result in run(selected, args.number, args.repeat):
+        results[name] = result
+        print('%-36s %12.0f %12s %14s' % (
+            name, result['ns_per_op'],
+            _format_bytes(result['alloc_peak_bytes'], '%d'),
+            _format_bytes(result['alloc_retained_bytes_per_op'], '%.1f')))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'metricslogging_version': metricslogging.__version__,
+                'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'number': args.number,
+                'repeat': args.repeat,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
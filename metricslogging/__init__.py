@@ -4,4 +4,4 @@ __author__ = 'Alex Weeks'
 __email__ = 'alex.weeks@rackspace.com'
 __version__ = '0.1.0'
 
-from metricslogging import *
+from .metricslogging import *
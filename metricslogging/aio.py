@@ -0,0 +1,532 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Rackspace Hosting
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+asyncio support: a statsd backend that never blocks the event loop,
+timing and counting context managers for coroutines, and an event loop lag
+monitor.  Requires Python 3.7+.
+"""
+
+import asyncio
+import functools
+import inspect
+import threading
+import weakref
+
+from . import metricslogging as _core
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, endpoint):
+        self._endpoint = endpoint
+
+    def error_received(self, exc):
+        # e.g. ECONNREFUSED while nothing listens on the statsd port
+        self._endpoint.send_errors += 1
+
+    def connection_lost(self, exc):
+        self._endpoint._lost()
+
+
+class _DatagramEndpoint(object):
+    """
+    Lines waiting to be sent to one statsd target from one event loop.  Lines
+    written during a loop iteration are packed into datagrams and sent by a
+    single callback scheduled for the next iteration.
+
+    Counts packets_sent, bytes_sent, send_errors (errors reported by the
+    transport, such as ECONNREFUSED) and dropped lines, which are reported
+    by getStats() like those of the other transports.
+
+    The endpoint closes when its loop shuts down its asynchronous
+    generators, which asyncio.run() does before closing the loop: pending
+    lines are sent, the transport is closed and the endpoint is forgotten.
+    Endpoints of loops closed without loop.shutdown_asyncgens() are
+    forgotten the next time an endpoint is created or stats are read.
+    """
+    # Lines kept while the transport is being created; later ones are dropped
+    MAX_PENDING_LINES = 10000
+
+    def __init__(self, loop, target):
+        self._loop = loop
+        self._target = target
+        self._transport = None
+        self._connecting = False
+        self._lines = []
+        self._packet_size = None
+        self._scheduled = False
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.send_errors = 0
+        self.dropped = 0
+        self._watcher = None
+
+    def write(self, line, packet_size):
+        if len(self._lines) >= self.MAX_PENDING_LINES:
+            self.dropped += 1
+            return
+        self._lines.append(line)
+        self._packet_size = packet_size
+        if not self._scheduled:
+            self._scheduled = True
+            self._loop.call_soon(self._send_pending)
+
+    def flush(self):
+        """Send pending lines now, if the transport is ready."""
+        if self._transport is None or not self._lines:
+            return
+        lines, self._lines = self._lines, []
+        for payload in _core._pack_lines(lines, self._packet_size):
+            self._transport.sendto(payload)
+            self.packets_sent += 1
+            self.bytes_sent += len(payload)
+
+    def stats(self):
+        """Return a dict of this endpoint's counters."""
+        return {'packets_sent': self.packets_sent,
+                'bytes_sent': self.bytes_sent,
+                'send_errors': self.send_errors,
+                'dropped': self.dropped}
+
+    def close(self):
+        self.flush()
+        if self._transport is not None:
+            self._transport.close()
+
+    def watch_shutdown(self):
+        """Close the endpoint on loop.shutdown_asyncgens().  Must be called
+        from the loop's thread, while it runs.
+        """
+        # Running the generator to its first yield registers it with the
+        # running loop's asyncgen hooks, which hold it only weakly
+        self._watcher = self._until_shutdown()
+        try:
+            self._watcher.asend(None).send(None)
+        except StopIteration:
+            pass
+
+    async def _until_shutdown(self):
+        try:
+            yield
+        finally:
+            _remove_endpoint(self._loop, self._target)
+            self.close()
+
+    def _send_pending(self):
+        self._scheduled = False
+        if self._transport is None:
+            self._connect()
+        else:
+            self.flush()
+
+    def _connect(self):
+        if not self._connecting:
+            self._connecting = True
+            self._loop.create_task(self._open())
+
+    async def _open(self):
+        try:
+            self._transport, _ = await self._loop.create_datagram_endpoint(
+                lambda: _DatagramProtocol(self), remote_addr=self._target)
+        except OSError:
+            self.send_errors += 1
+            self.dropped += len(self._lines)
+            self._lines = []
+        else:
+            self.flush()
+        finally:
+            self._connecting = False
+
+    def _lost(self):
+        self._transport = None
+        if self._lines:
+            self._connect()
+
+
+# Endpoints by event loop, then by (host, port) target.  An endpoint's
+# transport refers to its loop, so entries are removed explicitly once the
+# loop shuts down or is found closed.
+_endpoints = weakref.WeakKeyDictionary()
+
+# Counters of removed endpoints, by stats key, so that totals never go back
+_retired_stats = dict()
+_retired_lock = threading.Lock()
+
+
+def _stats_key(target):
+    return 'asyncio-udp:%s:%s' % target
+
+
+def _add_stats(totals, key, values):
+    sums = totals.setdefault(key, dict.fromkeys(values, 0))
+    for field, value in values.items():
+        sums[field] += value
+
+
+def _retire(endpoint):
+    with _retired_lock:
+        _add_stats(_retired_stats, _stats_key(endpoint._target),
+                   endpoint.stats())
+
+
+def _remove_endpoint(loop, target):
+    endpoints = _endpoints.get(loop, {})
+    endpoint = endpoints.pop(target, None)
+    if not endpoints:
+        _endpoints.pop(loop, None)
+    if endpoint is not None:
+        _retire(endpoint)
+
+
+def _remove_closed_loops():
+    for loop in list(_endpoints.keys()):
+        if loop.is_closed():
+            for endpoint in list(_endpoints.pop(loop, {}).values()):
+                _retire(endpoint)
+
+
+def _endpoint_stats():
+    """Counters of every endpoint, summed over event loops, by target."""
+    _remove_closed_loops()
+    with _retired_lock:
+        stats = dict((key, dict(values))
+                     for key, values in _retired_stats.items())
+    for endpoints in list(_endpoints.values()):
+        for target, endpoint in list(endpoints.items()):
+            _add_stats(stats, _stats_key(target), endpoint.stats())
+    return stats
+
+
+_core._register_transport_stats(_endpoint_stats)
+
+
+def _retired_after_fork():
+    global _retired_lock
+    _retired_lock = threading.Lock()
+
+
+_core._register_after_fork(_retired_after_fork)
+
+
+def _get_endpoint(loop, target):
+    endpoints = _endpoints.get(loop)
+    if endpoints is None:
+        _remove_closed_loops()
+        endpoints = _endpoints[loop] = dict()
+    endpoint = endpoints.get(target)
+    if endpoint is None:
+        endpoint = endpoints[target] = _DatagramEndpoint(loop, target)
+        endpoint.watch_shutdown()
+    return endpoint
+
+
+class AsyncioStatsdMetricsLogger(_core.StatsdMetricsLogger):
+    """
+    StatsdMetricsLogger for asyncio applications.
+
+    Within a running event loop, lines are sent through one datagram
+    transport per loop and target, created with
+    loop.create_datagram_endpoint(), so no call ever blocks the loop.  Lines
+    written during one loop iteration are batched into datagrams of up to
+    setStatsdPacketSize() bytes (PACKET_SIZE_ETHERNET if unset) and sent on
+    the next.  Outside a running loop, e.g. from another thread, or with a
+    statsd transport other than 'udp', lines are sent as by
+    StatsdMetricsLogger.
+    """
+    def _write(self, line):
+        settings = self._settings()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None or settings['transport_name'] != self.TRANSPORT_UDP:
+            return super(AsyncioStatsdMetricsLogger, self)._write(line)
+
+        _get_endpoint(loop, settings['target']).write(
+            line, settings['packet_size'] or self.PACKET_SIZE_ETHERNET)
+
+    def _write_many(self, lines):
+        settings = self._settings()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None or settings['transport_name'] != self.TRANSPORT_UDP:
+            return super(AsyncioStatsdMetricsLogger, self)._write_many(lines)
+
+        endpoint = _get_endpoint(loop, settings['target'])
+        packet_size = settings['packet_size'] or self.PACKET_SIZE_ETHERNET
+        for line in lines:
+            endpoint.write(line, packet_size)
+
+    def flush(self):
+        """Send lines pending for this logger's target on the running event
+        loop, then any buffered by StatsdMetricsLogger.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            endpoint = _endpoints.get(loop, {}).get(
+                self._settings()['target'])
+            if endpoint is not None:
+                endpoint.flush()
+        super(AsyncioStatsdMetricsLogger, self).flush()
+
+
+class LoopLagMonitor(object):
+    """
+    Measures how late an event loop runs its callbacks, which is how long
+    something blocked it: every interval seconds a callback scheduled with
+    loop.call_later() compares when it ran with when it was due, and sends
+    the delay as a timer, in milliseconds.  For example:
+
+        monitor = LoopLagMonitor(getLogger("service"))
+        monitor.install()
+        ...
+        monitor.uninstall()
+
+    The timer is sent through a TimerHandle, so it is aggregated and batched
+    like any other.  The monitor costs one callback per interval, whatever
+    the load on the loop.  install() and uninstall() must be called from the
+    loop's thread.
+    """
+    def __init__(self, logger, name=('loop', 'lag'), interval=0.25,
+                 tags=None):
+        """
+        :param logger: MetricsLogger to send the timer through
+        :param name: Metric name
+        :param interval: Seconds between measurements
+        :param tags: Tags sent with each timer
+        """
+        if not interval or interval <= 0:
+            raise ValueError("Loop lag interval must be positive")
+        self.interval = interval
+        self._handle = logger.timer_handle(name, tags=tags)
+        self._loop = None
+        self._timer = None
+        self._due = None
+
+    @property
+    def installed(self):
+        return self._timer is not None
+
+    def install(self, loop=None):
+        """Start measuring the lag of loop, by default the running loop.
+        Does nothing if already installed.
+        """
+        if self._timer is not None:
+            return
+        self._loop = loop or asyncio.get_running_loop()
+        self._schedule()
+
+    def uninstall(self):
+        """Stop measuring."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+            self._loop = None
+
+    def _schedule(self):
+        self._due = self._loop.time() + self.interval
+        self._timer = self._loop.call_at(self._due, self._tick)
+
+    def _tick(self):
+        lag = self._loop.time() - self._due
+        self._schedule()
+        self._handle.record(max(lag, 0.0) * 1000.0)
+
+
+class AsyncTimerContextDecorator(object):
+    """
+    Combination decorator and async context manager to time coroutine
+    functions or code blocks within them.  Emits a timer metric to the
+    specified logger.  Recommended to be instantiated by the timer_acd()
+    convenience function on a MetricsLogger.
+
+    One instance may be entered concurrently by many tasks.
+    """
+    def __init__(self, logger, name, tags=None):
+        self.logger = logger
+        self.name = name
+        self.tags = _core.getTagSet(tags)
+        self._kwargs = _core._tag_kwargs(self.tags)
+        self._starts = weakref.WeakKeyDictionary()
+
+    async def __aenter__(self):
+        task = asyncio.current_task()
+        self._starts.setdefault(task, []).append(_core._time_ns())
+        return self
+
+    async def __aexit__(self, *exc):
+        task = asyncio.current_task()
+        starts = self._starts[task]
+        start_ns = starts.pop()
+        if not starts:
+            del self._starts[task]
+        duration_ns = _core._time_ns() - start_ns
+        self.logger.timer(self.name, duration_ns / 1000000.0, **self._kwargs)
+
+    def __call__(self, func):
+        return _wrap_timer(self.logger, self.name, func, self.tags)
+
+
+class AsyncCounterContextDecorator(object):
+    """
+    Combination decorator and async context manager to count coroutine
+    function calls or code blocks within them.  Emits a counter metric to the
+    specified logger.  Recommended to be instantiated by the counter_acd()
+    convenience function on a MetricsLogger.
+    """
+    def __init__(self, logger, name, sample_rate, sampler=None, tags=None):
+        self.logger = logger
+        self.name = name
+        self.sample_rate = sample_rate
+        self.sampler = sampler or logger.sampler(sample_rate)
+        self.tags = _core.getTagSet(tags)
+        self._kwargs = _core._tag_kwargs(self.tags)
+
+    def _count(self):
+        if self.sampler is None or self.sampler():
+            self.logger._emit(self.logger.COUNTER, self.name, 1,
+                              self.sample_rate, **self._kwargs)
+        else:
+            self.logger._sample_skipped()
+
+    async def __aenter__(self):
+        self._count()
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    def __call__(self, func):
+        return _wrap_counter(self._count, func)
+
+
+def _check_async(func):
+    if not _core._is_async(func):
+        raise TypeError(
+            "%r is not a coroutine or async generator function" % (func,))
+
+
+def _wrap_async_gen(func, start=None, value=None, finish=None):
+    """Wrap an async generator function in one whose generators behave the
+    same to their caller: values passed to asend() and exceptions passed to
+    athrow() are forwarded to the wrapped generator, and closing the wrapper
+    closes it.
+
+    :param start: Called when iteration starts; its result is passed to
+        finish
+    :param value: Called with each value yielded
+    :param finish: Called once the generator is exhausted, raises or is
+        closed
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        agen = func(*args, **kwargs)
+        state = start() if start is not None else None
+        try:
+            try:
+                item = await agen.__anext__()
+            except StopAsyncIteration:
+                return
+            while True:
+                if value is not None:
+                    value(item)
+                try:
+                    sent = yield item
+                except GeneratorExit:
+                    raise
+                except BaseException as e:
+                    try:
+                        item = await agen.athrow(e)
+                    except StopAsyncIteration:
+                        return
+                else:
+                    try:
+                        item = await agen.asend(sent)
+                    except StopAsyncIteration:
+                        return
+        finally:
+            try:
+                await agen.aclose()
+            finally:
+                if finish is not None:
+                    finish(state)
+    return wrapper
+
+
+def _wrap_timer(logger, name, func, tags=None):
+    """Wrap a coroutine function to time its coroutine until it completes,
+    or an async generator function to time its generator until exhausted.
+    """
+    _check_async(func)
+    tag_kwargs = _core._tag_kwargs(tags)
+
+    if inspect.isasyncgenfunction(func):
+        def finish(start_ns):
+            logger.timer(name, (_core._time_ns() - start_ns) / 1000000.0,
+                         **tag_kwargs)
+        return _wrap_async_gen(func, start=_core._time_ns, finish=finish)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start_ns = _core._time_ns()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            logger.timer(name, (_core._time_ns() - start_ns) / 1000000.0,
+                         **tag_kwargs)
+    return wrapper
+
+
+def _wrap_counter(count, func):
+    """Wrap a coroutine function or async generator function to call count()
+    when its coroutine starts running, or its iteration starts.
+    """
+    _check_async(func)
+
+    if inspect.isasyncgenfunction(func):
+        return _wrap_async_gen(func, start=count)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        count()
+        return await func(*args, **kwargs)
+    return wrapper
+
+
+def _wrap_return_val_gauge(logger, name, func, tags=None):
+    """Wrap a coroutine function to gauge its awaited result, or an async
+    generator function to gauge each value it yields.
+    """
+    _check_async(func)
+    tag_kwargs = _core._tag_kwargs(tags)
+
+    if inspect.isasyncgenfunction(func):
+        def gauge(value):
+            logger.gauge(name, value, **tag_kwargs)
+        return _wrap_async_gen(func, value=gauge)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        result = await func(*args, **kwargs)
+        logger.gauge(name, result, **tag_kwargs)
+        return result
+    return wrapper
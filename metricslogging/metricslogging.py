@@ -16,20 +16,63 @@
 #    under the License.
 
 import abc
-import contextlib
+import atexit
+import collections
 import contextlib2
+import errno
+import fnmatch
+import functools
+import heapq
+import inspect
 import itertools
+import math
+import os
 import pprint
 import random
+import re
 import six
 import socket
 import string
+import threading
 import time
+import weakref
 import wrapt
 
 
-def _time():
-    return time.time()
+if hasattr(time, 'perf_counter_ns'):
+    _default_clock_ns = time.perf_counter_ns
+elif hasattr(time, 'perf_counter'):
+    def _default_clock_ns():
+        return int(time.perf_counter() * 1000000000)
+else:
+    def _default_clock_ns():
+        return int(time.time() * 1000000000)
+
+_clock_ns = _default_clock_ns
+
+
+def _time_ns():
+    """Current reading of the timer clock, in integer nanoseconds."""
+    return _clock_ns()
+
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+_MISSING = object()
+
+
+if six.PY2:
+    def _encode(s):
+        return s
+else:
+    def _encode(s):
+        return s.encode('utf-8')
+
+
+def _translation_table(prohibited, replace):
+    if six.PY2:
+        return string.maketrans(prohibited, replace)
+    return str.maketrans(prohibited, replace)
 
 
 def _to_list(parts):
@@ -37,7 +80,7 @@ def _to_list(parts):
         return []
     elif isinstance(parts, list):
         return parts
-    elif isinstance(parts, basestring):
+    elif isinstance(parts, six.string_types):
         return [parts]
     elif isinstance(parts, tuple):
         return list(parts)
@@ -56,19 +99,79 @@ def _list_join(delimiter, skip_empty, *parts):
 
 
 def _get_host_parts(host):
-    if isinstance(host, basestring):
+    if isinstance(host, six.string_types):
         return _to_list(host.split('.'))
     else:
         return _to_list(host)
 
 
+# Functions run in a forked child to give it its own locks, sockets, queues,
+# buffers and background threads, in registration order
+_after_fork_hooks = []
+_pid = os.getpid()
+
+# Without os.register_at_fork, forks are noticed by comparing pids
+_CHECK_PID = not hasattr(os, 'register_at_fork')
+
+
+def _register_after_fork(hook):
+    _after_fork_hooks.append(hook)
+
+
+def _run_after_fork_hooks():
+    global _pid
+    _pid = os.getpid()
+    for hook in _after_fork_hooks:
+        hook()
+    # Last, so scheduled callbacks only run once every hook has discarded
+    # the parent's state
+    _scheduler._restart_after_fork()
+
+
+def _check_fork():
+    """Run the after-fork hooks if this is a forked child that hasn't yet.
+    Only needed when _CHECK_PID is set; costs a getpid() call.
+    """
+    if _pid != os.getpid():
+        _run_after_fork_hooks()
+
+
+if not _CHECK_PID:
+    os.register_at_fork(after_in_child=_run_after_fork_hooks)
+
+
 class NestedConfig(object):
+    """
+    Config values looked up through a chain of parent configs.
+
+    Each config has a version that increases whenever one of its values, or a
+    value it inherits from a parent, changes.  Values derived from config can
+    therefore be cached together with the version they were computed at, and
+    checked for staleness with a single comparison.  Callbacks registered with
+    subscribe() are called on the same changes.
+    """
+    _lock = threading.RLock()
+
     def __init__(self, parent=None):
         self._config = dict()
         self._parent = parent
+        self._version = 0
+        self._children = weakref.WeakSet()
+        self._subscribers = []
+
+        if parent is not None:
+            with self._lock:
+                parent._children.add(self)
+
+    @property
+    def version(self):
+        """Version of the values visible through this config."""
+        return self._version
 
     def set_config(self, name, value):
-        self._config[name] = value
+        with self._lock:
+            self._config[name] = value
+            self._changed(name, value)
 
     def get_config(self, name):
         if name in self._config:
@@ -79,7 +182,9 @@ class NestedConfig(object):
             return None
 
     def reset_config(self):
-        self._config = dict()
+        with self._lock:
+            self._config = dict()
+            self._changed(None, None)
 
     def add_config(self, name, default=None, override=False):
         def setter_fn(value):
@@ -93,6 +198,156 @@ class NestedConfig(object):
 
         return setter_fn, getter_fn
 
+    def set_parent(self, parent):
+        """Inherit values from parent instead of the current parent config.
+
+        :param parent: NestedConfig, or None
+        """
+        with self._lock:
+            if self._parent is not None:
+                self._parent._children.discard(self)
+            self._parent = parent
+            if parent is not None:
+                parent._children.add(self)
+            self._changed(None, None)
+
+    def subscribe(self, callback):
+        """Call callback(name, value) whenever a value visible through this
+        config changes, including values inherited from a parent.  name and
+        value are None when the whole config was reset.
+
+        Callbacks run on the thread making the change, and must not block.
+        """
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Stop calling a callback registered with subscribe()."""
+        with self._lock:
+            self._subscribers.remove(callback)
+
+    def _changed(self, name, value):
+        self._version += 1
+        for child in list(self._children):
+            # A child overriding name doesn't see the change
+            if name is None or name not in child._config:
+                child._changed(name, value)
+        for callback in list(self._subscribers):
+            callback(name, value)
+
+    @classmethod
+    def _after_fork(cls):
+        cls._lock = threading.RLock()
+
+
+_register_after_fork(NestedConfig._after_fork)
+
+
+class _LRUCache(object):
+    """Thread-safe mapping holding at most maxsize entries, evicting the
+    least recently used entry first.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TagSet(object):
+    """
+    Immutable set of metric tags, as (key, value) pairs sorted by key.
+    Backends cache their wire encoding of a tag set on it, so emitting the
+    same tag set again doesn't re-sort or re-sanitize it.  Use getTagSet()
+    to create tag sets, which interns them.
+    """
+    __slots__ = ('pairs', '_encoded')
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+        self._encoded = dict()
+
+    def __eq__(self, other):
+        return isinstance(other, TagSet) and self.pairs == other.pairs
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.pairs)
+
+    def __iter__(self):
+        return iter(self.pairs)
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __repr__(self):
+        return 'TagSet(%r)' % (self.pairs,)
+
+
+# Interned tag sets, forgotten once the dict grows past TAG_SET_CACHE_SIZE
+TAG_SET_CACHE_SIZE = 10000
+_tag_sets = dict()
+
+
+def getTagSet(tags):
+    """
+    Return the interned TagSet for tags, a dict or an iterable of (key,
+    value) pairs.  Tag sets are returned as is, and None or empty tags give
+    None.  Metric methods accepting tags call this themselves; call it once
+    up front to skip even the lookup.
+
+    :param tags: Dict or iterable of (key, value) pairs, TagSet, or None
+    """
+    if tags is None or type(tags) is TagSet:
+        return tags
+
+    key = frozenset(six.iteritems(tags) if isinstance(tags, dict) else tags)
+    tag_set = _tag_sets.get(key)
+    if tag_set is None:
+        if not key:
+            return None
+        tag_set = TagSet(tuple(sorted(six.iteritems(dict(key)),
+                                      key=lambda pair: str(pair[0]))))
+        if len(_tag_sets) >= TAG_SET_CACHE_SIZE:
+            _tag_sets.clear()
+        _tag_sets[key] = tag_set
+    return tag_set
+
+
+_NO_TAGS = {}
+
+
+def _tag_kwargs(tags):
+    """Keyword arguments passing tags on to metric and backend methods.
+    Tags are only passed when set, so backends and overrides written before
+    tags were supported keep working for metrics without them.
+    """
+    return _NO_TAGS if tags is None else {'tags': tags}
+
 
 # Global config options
 _global_config = NestedConfig()
@@ -106,6 +361,32 @@ setPrependHostReverse, getPrependHostReverse = \
     _global_config.add_config('prepend_host_reverse', False)
 setHost, getHost = \
     _global_config.add_config('host', socket.gethostname())
+setTimerClock, getTimerClock = \
+    _global_config.add_config('timer_clock', _default_clock_ns)
+setNameCacheSize, getNameCacheSize = \
+    _global_config.add_config('name_cache_size', 1000)
+setProcessors, getProcessors = \
+    _global_config.add_config('processors', None)
+setInternalStats, getInternalStats = \
+    _global_config.add_config('internal_stats', False)
+setInternalStatsInterval, getInternalStatsInterval = \
+    _global_config.add_config('internal_stats_interval', None)
+setCollectorTimeout, getCollectorTimeout = \
+    _global_config.add_config('collector_timeout', 1.0)
+
+setAsyncDelivery, getAsyncDelivery = \
+    _global_config.add_config('async_delivery', False)
+setAsyncQueueSize, getAsyncQueueSize = \
+    _global_config.add_config('async_queue_size', 10000)
+setAsyncOverflowPolicy, getAsyncOverflowPolicy = \
+    _global_config.add_config('async_overflow_policy', 'drop_newest')
+
+setAggregateInterval, getAggregateInterval = \
+    _global_config.add_config('aggregate_interval', 10.0)
+setAggregateTimers, getAggregateTimers = \
+    _global_config.add_config('aggregate_timers', False)
+setTimerPercentiles, getTimerPercentiles = \
+    _global_config.add_config('timer_percentiles', (50, 90, 99))
 
 setStatsdDelimiter, getStatsdDelimiter = \
     _global_config.add_config('statsd_delimiter', '.')
@@ -113,6 +394,1240 @@ setStatsdHost, getStatsdHost = \
     _global_config.add_config('statsd_host', 'localhost')
 setStatsdPort, getStatsdPort =\
     _global_config.add_config('statsd_port', 8125)
+setStatsdPacketSize, getStatsdPacketSize = \
+    _global_config.add_config('statsd_packet_size', None)
+setStatsdFlushInterval, getStatsdFlushInterval = \
+    _global_config.add_config('statsd_flush_interval', 1.0)
+setStatsdTagFormat, getStatsdTagFormat = \
+    _global_config.add_config('statsd_tag_format', 'dogstatsd')
+setStatsdTransport, getStatsdTransport = \
+    _global_config.add_config('statsd_transport', 'udp')
+setStatsdSocketPath, getStatsdSocketPath = \
+    _global_config.add_config('statsd_socket_path', None)
+setStatsdTcpBufferSize, getStatsdTcpBufferSize = \
+    _global_config.add_config('statsd_tcp_buffer_size', 1048576)
+setStatsdDnsTtl, getStatsdDnsTtl = \
+    _global_config.add_config('statsd_dns_ttl', 60.0)
+
+
+def _timer_clock_changed(name, value):
+    global _clock_ns
+    if name in (None, 'timer_clock'):
+        _clock_ns = getTimerClock() or _default_clock_ns
+
+
+_global_config.subscribe(_timer_clock_changed)
+
+
+class _Resolver(object):
+    """
+    Caches the address statsd (host, port) targets resolve to.
+
+    A target is resolved with getaddrinfo() the first time it is used, taking
+    the first IPv4 address returned, or the first IPv6 address if there is
+    none, e.g. for IPv6 literals and IPv6-only names.  IPv4 is preferred
+    because a dual-stack 'localhost' usually resolves to ::1 first, while
+    statsd servers commonly listen on IPv4 only, which is all earlier
+    versions sent to.
+
+    After that, lookups never block: the target is re-resolved on the shared
+    scheduler thread every getStatsdDnsTtl() seconds, and soon after a send
+    to it fails.  When the address changes, the pooled socket for the target
+    is discarded, so the next send connects to the new address.  If a target
+    can't be resolved, the unresolved (host, port) is used until a later
+    lookup succeeds.
+    """
+    # Seconds between lookups triggered by send failures
+    MIN_REFRESH_INTERVAL = 1.0
+    # Seconds before retrying a failed lookup, at most
+    RETRY_DELAY = 5.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._addresses = dict()
+        self._refreshes = dict()
+        self._resolved_at = dict()
+
+    def resolve(self, target):
+        """Return (family, address) to connect a socket to for target.
+
+        :param target: (host, port) tuple
+        """
+        address = self._addresses.get(target)
+        if address is None:
+            # Only the first send to a target waits for its lookup, which
+            # is made without the lock so other targets aren't held up
+            resolved, address = self._lookup(target)
+            with self._lock:
+                if target not in self._addresses:
+                    self._store(target, resolved, address)
+                address = self._addresses[target]
+        return address
+
+    def refresh_soon(self, target):
+        """Re-resolve target on the scheduler thread, e.g. after a failed
+        send, unless it was resolved less than MIN_REFRESH_INTERVAL ago.
+        """
+        with self._lock:
+            if target not in self._addresses:
+                return
+            if _monotonic() - self._resolved_at[target] < \
+                    self.MIN_REFRESH_INTERVAL:
+                return
+            self._schedule(target, 0)
+
+    def _refresh(self, target):
+        if target not in self._addresses:
+            return
+        # getaddrinfo() can take seconds: only the result is stored under
+        # the lock, which emitting threads take
+        resolved, address = self._lookup(target)
+        with self._lock:
+            old = self._addresses.get(target)
+            if old is None:
+                # Reset while looking up
+                return
+            self._store(target, resolved, address)
+        if address != old:
+            _socket_pool.discard_target(target)
+
+    def _store(self, target, resolved, address):
+        """Cache the address of target, and schedule the next lookup.
+        Called with the lock held.
+        """
+        self._addresses[target] = address
+        self._resolved_at[target] = _monotonic()
+
+        ttl = getStatsdDnsTtl()
+        if not resolved:
+            self._schedule(target, min(ttl or self.RETRY_DELAY,
+                                       self.RETRY_DELAY))
+        elif ttl:
+            self._schedule(target, ttl)
+        else:
+            self._refreshes.pop(target, None)
+
+    def _schedule(self, target, delay):
+        entry = self._refreshes.get(target)
+        if entry is not None:
+            _scheduler.cancel(entry)
+        self._refreshes[target] = _scheduler.call_later(
+            delay, lambda: self._refresh(target))
+
+    @staticmethod
+    def _lookup(target):
+        """:returns: (resolved, (family, address))"""
+        host, port = target
+        try:
+            infos = socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+                                       socket.SOCK_DGRAM)
+        except socket.error:
+            infos = None
+        if not infos:
+            return False, (socket.AF_INET, target)
+        for info in infos:
+            if info[0] == socket.AF_INET:
+                break
+        else:
+            info = infos[0]
+        family, _, _, _, address = info
+        return True, (family, address)
+
+    def reset(self):
+        """Forget every cached address."""
+        with self._lock:
+            for entry in self._refreshes.values():
+                _scheduler.cancel(entry)
+            self._addresses.clear()
+            self._refreshes.clear()
+            self._resolved_at.clear()
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+
+_resolver = _Resolver()
+
+_register_after_fork(_resolver._after_fork)
+
+
+class _SocketPool(object):
+    """
+    Process-wide pool of connected datagram sockets, keyed by (host, port),
+    or by path for unix sockets.  (host, port) targets are connected to the
+    address cached by _resolver.
+
+    Every StatsdMetricsLogger sending to the same target shares one socket.
+    Sockets are created lazily under a lock, while lookups of existing sockets
+    are lock-free.  A forked child never reuses its parent's sockets: the pool
+    is emptied by an after-fork hook.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sockets = dict()
+
+    def get(self, target, open_socket):
+        """Return the connected socket for target, creating it if needed.
+
+        :param target: (host, port) tuple, or unix socket path
+        :param open_socket: Callable returning a new, unconnected socket of
+            the address family it is passed
+        """
+        if _CHECK_PID:
+            _check_fork()
+
+        sock = self._sockets.get(target)
+        if sock is None:
+            if isinstance(target, tuple):
+                family, address = _resolver.resolve(target)
+            else:
+                family, address = socket.AF_UNIX, target
+
+            with self._lock:
+                sock = self._sockets.get(target)
+                if sock is None:
+                    sock = open_socket(family)
+                    try:
+                        sock.connect(address)
+                    except Exception:
+                        sock.close()
+                        raise
+                    self._sockets[target] = sock
+        return sock
+
+    def discard(self, target, sock):
+        """Close sock and drop it from the pool if it is still current.
+
+        :param target: (host, port) tuple
+        :param sock: Socket previously returned by get()
+        """
+        with self._lock:
+            if self._sockets.get(target) is sock:
+                del self._sockets[target]
+        sock.close()
+
+    def discard_target(self, target):
+        """Close and drop the pooled socket for target, if any.
+
+        :param target: (host, port) tuple, or unix socket path
+        """
+        with self._lock:
+            sock = self._sockets.pop(target, None)
+        if sock is not None:
+            sock.close()
+
+    def reset(self, close=True):
+        """Drop every pooled socket.
+
+        :param close: Close the dropped sockets.  Pass False in a forked
+            child, whose sockets are still in use by the parent.
+        """
+        with self._lock:
+            sockets, self._sockets = self._sockets, dict()
+        if close:
+            for sock in sockets.values():
+                sock.close()
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self.reset(close=False)
+
+
+_socket_pool = _SocketPool()
+
+_register_after_fork(_socket_pool._after_fork)
+
+
+class _DatagramTransport(object):
+    """Sends each payload as one datagram over the pooled socket for a UDP
+    (host, port) or unix socket path target.
+    """
+    def __init__(self, target, open_socket):
+        self.target = target
+        self._open_socket = open_socket
+        # UDP sockets are connected, so an ICMP port unreachable for a
+        # datagram is reported as ECONNREFUSED by a later send()
+        self._udp = isinstance(target, tuple)
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.send_errors = 0
+        self.refused = 0
+
+    def send(self, payload):
+        try:
+            sent = self._send(payload)
+        except socket.error:
+            self.send_errors += 1
+            raise
+        self.packets_sent += 1
+        self.bytes_sent += len(payload)
+        return sent
+
+    def _send(self, payload):
+        """Send payload over the pooled socket for the target.
+
+        ECONNREFUSED on a UDP socket only means an earlier datagram found
+        nothing listening, as while the statsd agent restarts: the socket is
+        fine, and the send is retried once on it.  A socket that fails to
+        send otherwise is discarded and the send retried once on a fresh
+        socket, so stale connections (e.g. after a network change, or a unix
+        socket server restarting) recover without losing the datagram; the
+        target is also re-resolved in the background, in case its address
+        has changed.
+        """
+        target = self.target
+        sock = _socket_pool.get(target, self._open_socket)
+        try:
+            return sock.send(payload)
+        except socket.error as e:
+            if self._udp and e.errno == errno.ECONNREFUSED:
+                self.refused += 1
+                return sock.send(payload)
+            _socket_pool.discard(target, sock)
+            if self._udp:
+                _resolver.refresh_soon(target)
+
+        sock = _socket_pool.get(target, self._open_socket)
+        try:
+            return sock.send(payload)
+        except socket.error:
+            _socket_pool.discard(target, sock)
+            raise
+
+    def stats(self):
+        """Return a dict of this transport's counters."""
+        return {'packets_sent': self.packets_sent,
+                'bytes_sent': self.bytes_sent,
+                'send_errors': self.send_errors,
+                'refused': self.refused}
+
+    def _after_fork(self):
+        pass
+
+
+class _StreamTransport(object):
+    """
+    Sends newline-terminated payloads over one persistent TCP connection.
+
+    Connecting never blocks an emitting thread or the shared scheduler: the
+    first send starts a connect on a _worker_pool thread, and while the
+    connection is down, or being made, payloads are kept in memory, up to
+    getStatsdTcpBufferSize() bytes with the oldest dropped first.  Failed
+    connects are retried with exponential backoff between
+    RECONNECT_MIN_DELAY and RECONNECT_MAX_DELAY seconds.  Once connected,
+    the worker sends the buffered payloads in order, without the lock, before
+    emitting threads send over the connection directly.
+    """
+    RECONNECT_MIN_DELAY = 0.1
+    RECONNECT_MAX_DELAY = 30.0
+    # Seconds to wait for connect() and each send
+    TIMEOUT = 1.0
+
+    def __init__(self, target):
+        self.target = target
+        self.dropped = 0
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.send_errors = 0
+        self._lock = threading.Lock()
+        self._sock = None
+        self._address = None
+        self._pending = collections.deque()
+        self._pending_size = 0
+        self._delay = self.RECONNECT_MIN_DELAY
+        self._reconnect_entry = None
+        self._connecting = False
+        # Incremented by close(), so a connect in flight is abandoned
+        self._generation = 0
+
+    def send(self, payload):
+        data = payload + b'\n'
+        with self._lock:
+            if self._sock is not None and \
+                    self._address != _resolver.resolve(self.target):
+                # Re-resolved to a new address
+                self._sock.close()
+                self._sock = None
+            if self._sock is None:
+                self._buffer(data)
+                if not self._connecting and self._reconnect_entry is None:
+                    self._start_connect()
+                return None
+            try:
+                self._sock.sendall(data)
+            except socket.error:
+                self.send_errors += 1
+                self._disconnect()
+                self._buffer(data)
+                return None
+            self.packets_sent += 1
+            self.bytes_sent += len(data)
+        return len(data)
+
+    def stats(self):
+        """Return a dict of this transport's counters."""
+        return {'packets_sent': self.packets_sent,
+                'bytes_sent': self.bytes_sent,
+                'send_errors': self.send_errors,
+                'buffered_bytes': self._pending_size,
+                'dropped': self.dropped}
+
+    def close(self):
+        """Close the connection, dropping any buffered payloads."""
+        with self._lock:
+            self._generation += 1
+            self._connecting = False
+            if self._reconnect_entry is not None:
+                _scheduler.cancel(self._reconnect_entry)
+                self._reconnect_entry = None
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+            self._pending.clear()
+            self._pending_size = 0
+
+    def _start_connect(self):
+        """Connect on a worker thread.  Called with the lock held."""
+        self._connecting = True
+        generation = self._generation
+        _worker_pool.submit(lambda: self._connect(generation))
+
+    def _connect(self, generation):
+        """Connect, then send the buffered payloads, on a worker thread.
+        Emitting threads only buffer until this is done.
+        """
+        address = _resolver.resolve(self.target)
+        family, sockaddr = address
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.TIMEOUT)
+        try:
+            sock.connect(sockaddr)
+        except socket.error:
+            sock.close()
+            self._connect_failed(generation, None)
+            return
+
+        pending = self._pending
+        while True:
+            with self._lock:
+                if generation != self._generation:
+                    sock.close()
+                    return
+                if not pending:
+                    self._sock = sock
+                    self._address = address
+                    self._connecting = False
+                    self._delay = self.RECONNECT_MIN_DELAY
+                    return
+                data = pending[0]
+            try:
+                sock.sendall(data)
+            except socket.error:
+                self._connect_failed(generation, sock)
+                return
+            with self._lock:
+                if pending and pending[0] is data:
+                    pending.popleft()
+                    self._pending_size -= len(data)
+                self.packets_sent += 1
+                self.bytes_sent += len(data)
+
+    def _connect_failed(self, generation, sock):
+        if sock is not None:
+            sock.close()
+        with self._lock:
+            if generation != self._generation:
+                return
+            self.send_errors += 1
+            self._connecting = False
+            self._schedule_reconnect()
+        _resolver.refresh_soon(self.target)
+
+    def _disconnect(self):
+        self._sock.close()
+        self._sock = None
+        self._schedule_reconnect()
+        _resolver.refresh_soon(self.target)
+
+    def _schedule_reconnect(self):
+        self._reconnect_entry = _scheduler.call_later(self._delay,
+                                                      self._reconnect)
+        self._delay = min(self._delay * 2, self.RECONNECT_MAX_DELAY)
+
+    def _reconnect(self):
+        # Runs on the scheduler thread, which only hands the connect over
+        with self._lock:
+            self._reconnect_entry = None
+            if self._sock is None and not self._connecting:
+                self._start_connect()
+
+    def _buffer(self, data):
+        pending = self._pending
+        pending.append(data)
+        self._pending_size += len(data)
+        limit = getStatsdTcpBufferSize()
+        while self._pending_size > limit:
+            self._pending_size -= len(pending.popleft())
+            self.dropped += 1
+
+    def _after_fork(self):
+        # The parent still uses the connection, and sends what it buffered
+        self._lock = threading.Lock()
+        self._sock = None
+        self._pending = collections.deque()
+        self._pending_size = 0
+        self._delay = self.RECONNECT_MIN_DELAY
+        self._reconnect_entry = None
+        self._connecting = False
+        self._generation += 1
+
+
+# Transports by (transport name, target)
+_transports = dict()
+_transports_lock = threading.Lock()
+
+
+def _get_transport(name, target, open_socket):
+    key = (name, target)
+    transport = _transports.get(key)
+    if transport is None:
+        with _transports_lock:
+            transport = _transports.get(key)
+            if transport is None:
+                if name == 'tcp':
+                    transport = _StreamTransport(target)
+                elif name in ('udp', 'unix'):
+                    transport = _DatagramTransport(target, open_socket)
+                else:
+                    raise ValueError(
+                        "Unknown statsd transport %r" % (name,))
+                _transports[key] = transport
+    return transport
+
+
+def _transports_after_fork():
+    global _transports_lock
+    _transports_lock = threading.Lock()
+    for transport in _transports.values():
+        transport._after_fork()
+
+
+_register_after_fork(_transports_after_fork)
+
+
+class _Scheduler(object):
+    """
+    Runs deferred and periodic callbacks on a single shared daemon thread.
+
+    The thread is started on first use.  Exceptions raised by callbacks are
+    swallowed so one misbehaving callback can't stop the others.
+    """
+    # Scheduled entries are lists of [when, seq, interval, callback, cancelled]
+    _WHEN, _SEQ, _INTERVAL, _CALLBACK, _CANCELLED = range(5)
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._heap = []
+        self._seq = itertools.count()
+        self._thread = None
+        self._stopped = False
+
+    def call_later(self, delay, callback):
+        """Run callback once, delay seconds from now.
+
+        :returns: Entry that can be passed to cancel()
+        """
+        return self._schedule(_monotonic() + delay, None, callback)
+
+    def call_every(self, interval, callback):
+        """Run callback every interval seconds until cancelled.
+
+        :returns: Entry that can be passed to cancel()
+        """
+        return self._schedule(_monotonic() + interval, interval, callback)
+
+    def call_every_method(self, interval, method):
+        """Like call_every(), for a bound method whose instance is only weakly
+        referenced.  The entry is cancelled once the instance is collected.
+        """
+        ref = weakref.ref(method.__self__)
+        func = method.__func__
+
+        def callback():
+            obj = ref()
+            if obj is None:
+                self.cancel(entry)
+            else:
+                func(obj)
+
+        entry = self.call_every(interval, callback)
+        return entry
+
+    def cancel(self, entry):
+        entry[self._CANCELLED] = True
+
+    def _schedule(self, when, interval, callback):
+        entry = [when, next(self._seq), interval, callback, False]
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._start()
+            elif self._heap[0] is entry:
+                self._cond.notify()
+        return entry
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='metricslogging-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop running callbacks, and wait up to timeout seconds for the
+        thread to exit.  Used at interpreter exit, so the thread doesn't
+        wake up while the interpreter is being torn down.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def _next_entry(self):
+        with self._cond:
+            while True:
+                if self._stopped:
+                    return None
+                while self._heap and self._heap[0][self._CANCELLED]:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                now = _monotonic()
+                delay = self._heap[0][self._WHEN] - now
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+                entry = heapq.heappop(self._heap)
+                interval = entry[self._INTERVAL]
+                if interval is not None:
+                    entry[self._WHEN] = max(entry[self._WHEN] + interval, now)
+                    heapq.heappush(self._heap, entry)
+                return entry
+
+    def _run(self):
+        while True:
+            entry = self._next_entry()
+            if entry is None:
+                return
+            try:
+                entry[self._CALLBACK]()
+            except Exception:
+                pass
+
+    def _after_fork(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+
+    def _restart_after_fork(self):
+        # Run by _run_after_fork_hooks() after every registered hook
+        with self._cond:
+            if self._heap and self._thread is None:
+                self._start()
+
+
+_scheduler = _Scheduler()
+
+_register_after_fork(_scheduler._after_fork)
+
+
+def _pack_lines(lines, packet_size):
+    """Yield newline-joined payloads of at most packet_size bytes holding
+    lines in order.  A line is never split; one longer than packet_size is
+    yielded on its own.
+    """
+    batch = []
+    size = 0
+    for line in lines:
+        if batch and size + 1 + len(line) > packet_size:
+            yield b'\n'.join(batch)
+            batch = []
+            size = 0
+        if batch:
+            size += 1
+        batch.append(line)
+        size += len(line)
+    if batch:
+        yield b'\n'.join(batch)
+
+
+class _PacketBuffer(object):
+    """
+    Collects statsd lines for one transport and sends them newline-joined, in
+    as few payloads as the configured packet size allows.  A line is never
+    split across payloads; a single line larger than the packet size is sent
+    on its own.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+        self._lock = threading.Lock()
+        self._lines = []
+        self._size = 0
+        self._timer = None
+
+    def add(self, line, packet_size, flush_interval):
+        """Buffer line, sending the buffered payload first if line would
+        not fit in the same datagram.
+
+        :param line: Formatted statsd line
+        :param packet_size: Maximum payload size in bytes
+        :param flush_interval: Seconds after which a partially filled buffer
+            is sent anyway, or None to wait for a full buffer or flush()
+        """
+        payload = None
+        with self._lock:
+            if self._lines and self._size + 1 + len(line) > packet_size:
+                payload = self._take()
+            if self._lines:
+                self._size += 1
+            elif flush_interval:
+                self._timer = _scheduler.call_later(flush_interval,
+                                                    self.flush)
+            self._lines.append(line)
+            self._size += len(line)
+
+        if payload is not None:
+            self.transport.send(payload)
+
+    def flush(self):
+        """Send any buffered lines."""
+        with self._lock:
+            payload = self._take()
+
+        if payload is not None:
+            self.transport.send(payload)
+
+    def clear(self):
+        """Discard any buffered lines without sending them."""
+        with self._lock:
+            self._take()
+
+    def _take(self):
+        if self._timer is not None:
+            _scheduler.cancel(self._timer)
+            self._timer = None
+        if not self._lines:
+            return None
+
+        payload = b'\n'.join(self._lines)
+        self._lines = []
+        self._size = 0
+        return payload
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+
+# Packet buffers by transport
+_packet_buffers = dict()
+_packet_buffers_lock = threading.Lock()
+
+
+def _get_packet_buffer(transport):
+    buf = _packet_buffers.get(transport)
+    if buf is None:
+        with _packet_buffers_lock:
+            buf = _packet_buffers.get(transport)
+            if buf is None:
+                buf = _packet_buffers[transport] = _PacketBuffer(transport)
+    return buf
+
+
+def flush():
+    """Send all metric data buffered by batching StatsdMetricsLoggers."""
+    for buf in list(_packet_buffers.values()):
+        try:
+            buf.flush()
+        except socket.error:
+            pass
+
+
+def _packet_buffers_after_fork():
+    global _packet_buffers_lock
+    _packet_buffers_lock = threading.Lock()
+    # Lines buffered before the fork belong to the parent, which sends them
+    for buf in _packet_buffers.values():
+        buf._after_fork()
+
+
+_register_after_fork(_packet_buffers_after_fork)
+
+
+class _AsyncSender(object):
+    """
+    Bounded queue of metric records, drained by a dedicated sender thread.
+
+    Producers only append a (logger, kind, name, value, sample_rate, tags)
+    tuple to a deque, which needs no lock; the sender thread formats and
+    sends them.
+    What happens when the queue is full is set by setAsyncOverflowPolicy():
+
+    * 'drop_newest': discard the record being added (default)
+    * 'drop_oldest': discard the oldest queued record
+    * 'block': wait until the sender thread makes room
+    """
+    DROP_NEWEST = 'drop_newest'
+    DROP_OLDEST = 'drop_oldest'
+    BLOCK = 'block'
+
+    def __init__(self):
+        self._queue = collections.deque()
+        self._wakeup = threading.Event()
+        self._space = threading.Condition(threading.Lock())
+        self._blocked = 0
+        # True while the sender thread may hold a record it popped but
+        # hasn't delivered yet
+        self._busy = False
+        self._idle = threading.Condition(threading.Lock())
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.dropped = 0
+
+    def put(self, logger, kind, name, value, sample_rate=None, tags=None):
+        """Queue a metric for delivery by the sender thread.
+
+        :returns: False if the record was dropped, otherwise True
+        """
+        if _CHECK_PID:
+            _check_fork()
+        if self._thread is None:
+            self._start()
+
+        queue = self._queue
+        if len(queue) >= getAsyncQueueSize():
+            policy = getAsyncOverflowPolicy()
+            if policy == self.DROP_OLDEST:
+                try:
+                    queue.popleft()
+                    self.dropped += 1
+                except IndexError:
+                    pass
+            elif policy == self.BLOCK:
+                if threading.current_thread() is self._thread:
+                    # Metrics emitted while delivering can't wait on ourself
+                    logger._deliver(kind, name, value, sample_rate, tags)
+                    return True
+                self._wait_for_space()
+            else:
+                self.dropped += 1
+                return False
+
+        queue.append((logger, kind, name, value, sample_rate, tags))
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+        return True
+
+    def drain(self, timeout=None):
+        """Deliver every queued record on the calling thread, then wait for
+        the sender thread to finish delivering the record it's working on.
+
+        :param timeout: Seconds to wait for the sender thread, or None to
+            wait as long as it takes
+        :returns: False if the sender thread was still delivering when
+            timeout expired, otherwise True
+        """
+        queue = self._queue
+        while True:
+            try:
+                record = queue.popleft()
+            except IndexError:
+                break
+            self._deliver(record)
+
+        if threading.current_thread() is self._thread:
+            return True
+        deadline = None if timeout is None else _monotonic() + timeout
+        with self._idle:
+            while self._busy:
+                if deadline is None:
+                    self._idle.wait()
+                    continue
+                remaining = deadline - _monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def _wait_for_space(self):
+        with self._space:
+            self._blocked += 1
+            try:
+                while len(self._queue) >= getAsyncQueueSize():
+                    self._space.wait(0.1)
+            finally:
+                self._blocked -= 1
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                thread = threading.Thread(target=self._run,
+                                          name='metricslogging-sender')
+                thread.daemon = True
+                thread.start()
+                self._thread = thread
+
+    def _run(self):
+        queue = self._queue
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while True:
+                # Set before popping, so drain() can't see an empty queue
+                # and an idle thread while a record is on its way
+                self._busy = True
+                try:
+                    record = queue.popleft()
+                except IndexError:
+                    break
+                self._deliver(record)
+                if self._blocked:
+                    with self._space:
+                        self._space.notify_all()
+            with self._idle:
+                self._busy = False
+                self._idle.notify_all()
+
+    @staticmethod
+    def _deliver(record):
+        logger, kind, name, value, sample_rate, tags = record
+        try:
+            logger._deliver(kind, name, value, sample_rate, tags)
+        except Exception:
+            pass
+
+    def _after_fork(self):
+        # Records queued before the fork belong to the parent, which sends them
+        self._queue.clear()
+        self._wakeup = threading.Event()
+        self._space = threading.Condition(threading.Lock())
+        self._blocked = 0
+        self._busy = False
+        self._idle = threading.Condition(threading.Lock())
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+
+_async_sender = _AsyncSender()
+
+
+def getDroppedMetricsCount():
+    """Number of metrics discarded because the async delivery queue was
+    full.
+    """
+    return _async_sender.dropped
+
+
+_register_after_fork(_async_sender._after_fork)
+
+
+_children_lock = threading.Lock()
+
+
+def _children_after_fork():
+    global _children_lock
+    _children_lock = threading.Lock()
+
+
+_register_after_fork(_children_after_fork)
+
+
+_iscoroutinefunction = getattr(inspect, 'iscoroutinefunction',
+                               lambda func: False)
+_isasyncgenfunction = getattr(inspect, 'isasyncgenfunction',
+                              lambda func: False)
+
+
+def _is_async(func):
+    """True for coroutine functions and async generator functions, which
+    decorators must wrap with async code to see their execution.
+    """
+    return _iscoroutinefunction(func) or _isasyncgenfunction(func)
+
+
+class _Call(object):
+    """A function call run by a _WorkerPool, which can be waited on."""
+    __slots__ = ('func', 'done', 'result', 'error')
+
+    def __init__(self, func):
+        self.func = func
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.func()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+
+class _WorkerPool(object):
+    """
+    Daemon threads that run calls which may block for a long time, so the
+    caller can wait for each with a timeout.  A thread is started whenever no
+    idle one is waiting for work, and exits after IDLE_TIMEOUT seconds
+    without any.  A thread stuck in a call is never handed another.
+    """
+    IDLE_TIMEOUT = 60.0
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._queue = collections.deque()
+        self._idle = 0
+        self._threads = set()
+        self._stopped = False
+
+    def submit(self, func):
+        """Run func on a worker thread.
+
+        :returns: _Call whose done event is set once func has returned
+        """
+        call = _Call(func)
+        with self._cond:
+            self._queue.append(call)
+            if len(self._queue) > self._idle:
+                thread = threading.Thread(target=self._run,
+                                          name='metricslogging-worker')
+                thread.daemon = True
+                thread.start()
+                self._threads.add(thread)
+            else:
+                self._cond.notify()
+        return call
+
+    def stop(self, timeout=None):
+        """Let threads exit once the calls already queued have run, and
+        wait up to timeout seconds for them to.  Used at interpreter exit, like
+        _Scheduler.stop(), so e.g. a TCP connect started by the last flush
+        still sends.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+            threads = list(self._threads)
+        deadline = None if timeout is None else _monotonic() + timeout
+        for thread in threads:
+            if deadline is None:
+                thread.join()
+            else:
+                thread.join(max(deadline - _monotonic(), 0))
+
+    def _next_call(self):
+        with self._cond:
+            self._idle += 1
+            try:
+                deadline = _monotonic() + self.IDLE_TIMEOUT
+                while not self._queue and not self._stopped:
+                    remaining = deadline - _monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            finally:
+                self._idle -= 1
+            # Once stopped, threads still run the calls already queued
+            if not self._queue:
+                self._threads.discard(threading.current_thread())
+                return None
+            return self._queue.popleft()
+
+    def _run(self):
+        while True:
+            call = self._next_call()
+            if call is None:
+                return
+            call.run()
+
+    def _after_fork(self):
+        # Calls queued before the fork are the parent's
+        self._cond = threading.Condition(threading.Lock())
+        self._queue = collections.deque()
+        self._idle = 0
+        self._threads = set()
+
+
+_worker_pool = _WorkerPool()
+
+_register_after_fork(_worker_pool._after_fork)
+
+
+class CollectorRegistration(object):
+    """
+    A collector registered by MetricsLogger.add_collector().  Call remove()
+    to stop sampling it.
+    """
+    def __init__(self, logger, name, collect, interval, timeout, tags):
+        self.logger = logger
+        self.name = name
+        self.interval = interval
+        self.timeout = timeout
+        self.tags = tags
+        self._collect = collect
+        self._call = None
+
+    def remove(self):
+        """Stop sampling the collector.  A call already running completes,
+        but its values aren't sent.
+        """
+        _collectors.remove(self)
+
+    def _busy(self):
+        return self._call is not None and not self._call.done.is_set()
+
+    def _add_values(self, result, names, values):
+        """Append the gauges of a collector's result to names and values."""
+        if isinstance(result, dict):
+            prefix = _to_list(self.name)
+            for key, value in six.iteritems(result):
+                if value is not None:
+                    names.append(prefix + _to_list(key) if prefix else key)
+                    values.append(value)
+        elif self.name is None:
+            raise ValueError("A collector registered without a name must "
+                             "return a dict")
+        else:
+            names.append(self.name)
+            values.append(result)
+
+
+class _CollectorGroup(object):
+    """
+    The collectors registered with one interval.  Every interval the
+    scheduler thread hands the group to a worker thread, so it never waits on
+    a collector itself.  The group starts every collector on a worker thread
+    of its own, waits for each up to its timeout, then sends the values
+    returned in one emit_gauges() call per logger and tag set.  Collectors
+    still running from an earlier round, past their timeout, are skipped
+    until they return.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.registrations = []
+        self._running = False
+        self._entry = _scheduler.call_every(interval, self._tick)
+
+    def cancel(self):
+        _scheduler.cancel(self._entry)
+
+    def _tick(self):
+        if not self._running:
+            self._running = True
+            _worker_pool.submit(self.run)
+
+    def run(self):
+        try:
+            self.collect()
+        finally:
+            self._running = False
+
+    def collect(self):
+        """Sample every collector of the group once, and send the results."""
+        start = _monotonic()
+        started = []
+        for registration in list(self.registrations):
+            if registration._busy():
+                _collectors.skipped += 1
+                continue
+            registration._call = _worker_pool.submit(registration._collect)
+            started.append(registration)
+
+        batches = collections.OrderedDict()
+        for registration in started:
+            call = registration._call
+            timeout = registration.timeout
+            if timeout is None:
+                timeout = getCollectorTimeout()
+            if not call.done.wait(max(start + timeout - _monotonic(), 0)):
+                _collectors.timeouts += 1
+                continue
+            if registration not in self.registrations:
+                continue
+            if call.error is not None:
+                _collectors.errors += 1
+                continue
+            if call.result is None:
+                continue
+
+            key = (registration.logger, registration.tags)
+            names, values = batches.setdefault(key, ([], []))
+            try:
+                registration._add_values(call.result, names, values)
+            except Exception:
+                _collectors.errors += 1
+
+        for (logger, tags), (names, values) in six.iteritems(batches):
+            try:
+                logger.emit_gauges(names, values, tags)
+            except Exception:
+                _collectors.errors += 1
+
+
+class _CollectorRegistry(object):
+    """
+    Registered collectors, grouped by interval so the collectors sharing an
+    interval are sampled together and their values sent in one batch.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._groups = dict()
+        self.timeouts = 0
+        self.errors = 0
+        self.skipped = 0
+
+    def add(self, registration):
+        with self._lock:
+            group = self._groups.get(registration.interval)
+            if group is None:
+                group = self._groups[registration.interval] = \
+                    _CollectorGroup(registration.interval)
+            group.registrations = group.registrations + [registration]
+
+    def remove(self, registration):
+        with self._lock:
+            group = self._groups.get(registration.interval)
+            if group is None or registration not in group.registrations:
+                return
+            group.registrations = [r for r in group.registrations
+                                   if r is not registration]
+            if not group.registrations:
+                group.cancel()
+                del self._groups[registration.interval]
+
+    def stats(self):
+        return {'registered': sum(len(group.registrations)
+                                  for group in list(self._groups.values())),
+                'timeouts': self.timeouts,
+                'errors': self.errors,
+                'skipped': self.skipped}
+
+    def _after_fork(self):
+        # The scheduler keeps running the groups in the child; calls running
+        # in the parent's worker threads never complete here
+        self._lock = threading.Lock()
+        for group in self._groups.values():
+            group._running = False
+            for registration in group.registrations:
+                registration._call = None
+
+
+_collectors = _CollectorRegistry()
+
+_register_after_fork(_collectors._after_fork)
 
 
 class TimerContextDecorator(contextlib2.ContextDecorator):
@@ -120,18 +1635,282 @@ class TimerContextDecorator(contextlib2.ContextDecorator):
     Combination decorator and context manager to time functions or code blocks.
     Emits a timer metric to the specified logger.  Recommended to be
     instantiated by the timer_cd() convenience function on a MetricLogger.
+
+    Durations are measured with the timer clock (see setTimerClock()), which
+    defaults to the highest resolution monotonic clock available, and are
+    emitted as fractional milliseconds.
     """
-    def __init__(self, logger, name):
+    def __init__(self, logger, name, tags=None):
         self.logger = logger
         self.name = name
+        self.tags = getTagSet(tags)
+        self._kwargs = _tag_kwargs(self.tags)
 
     def __enter__(self):
-        self.start_time = _time()
+        self.start_ns = _time_ns()
         return self
 
     def __exit__(self, *exc):
-        duration = (_time() - self.start_time) * 1000
-        self.logger.timer(self.name, duration)
+        duration_ns = _time_ns() - self.start_ns
+        self.logger.timer(self.name, duration_ns / 1000000.0, **self._kwargs)
+
+    def __call__(self, func):
+        # Each call keeps its own start time, so concurrent calls of the
+        # decorated function don't interfere.  Coroutine functions are timed
+        # until their coroutine completes, and async generator functions
+        # until their generator is exhausted.
+        if _is_async(func):
+            from . import aio
+            return aio._wrap_timer(self.logger, self.name, func, self.tags)
+
+        logger = self.logger
+        name = self.name
+        tag_kwargs = self._kwargs
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start_ns = _time_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                logger.timer(name, (_time_ns() - start_ns) / 1000000.0,
+                             **tag_kwargs)
+        return wrapper
+
+
+def _validate_sample_rate(sample_rate):
+    if sample_rate is not None and not 0.0 <= sample_rate <= 1.0:
+        raise ValueError(
+            "sample_rate must be None, or in the interval [0.0, 1.0]")
+
+
+class RandomSampler(object):
+    """
+    Callable returning True with probability sample_rate.  The sample rate is
+    validated once, on creation.
+
+    :param sample_rate: Sample rate in interval [0.0, 1.0]
+    :param rng: random.Random instance to draw from; a private one by default
+    """
+    __slots__ = ('sample_rate', '_random')
+
+    def __init__(self, sample_rate, rng=None):
+        _validate_sample_rate(sample_rate)
+        self.sample_rate = sample_rate
+        self._random = (rng or random.Random()).random
+
+    def __call__(self):
+        return self._random() < self.sample_rate
+
+
+class EveryNthSampler(object):
+    """
+    Callable returning True for exactly sample_rate of its calls, spread
+    evenly: the kth call is sampled when floor(k * sample_rate) increases.
+    A rate of 0.25 samples every 4th call.  No random numbers are drawn, and
+    the call counter is safe to share between threads.
+
+    :param sample_rate: Sample rate in interval [0.0, 1.0]
+    """
+    __slots__ = ('sample_rate', '_calls')
+
+    def __init__(self, sample_rate):
+        _validate_sample_rate(sample_rate)
+        self.sample_rate = sample_rate
+        self._calls = itertools.count(1)
+
+    def __call__(self):
+        calls = next(self._calls)
+        rate = self.sample_rate
+        return int(calls * rate) != int((calls - 1) * rate)
+
+
+def _name_key(name):
+    """Metric name as a string for matching, with list or tuple names
+    joined by '.'.
+    """
+    if isinstance(name, (list, tuple)):
+        return '.'.join(str(part) for part in name)
+    return name
+
+
+@six.add_metaclass(abc.ABCMeta)
+class MetricProcessor(object):
+    """
+    Processor in a logger's metric pipeline.  Processors are called in order
+    with each metric after sampling, and before its name is formatted or
+    anything is sent, so dropped metrics cost no formatting or I/O.  Any
+    callable with the same signature can be used as a processor.
+
+    Processors are installed for every logger with setProcessors([...]), or
+    for one logger and its children with logger.setProcessors([...]), which
+    replaces the global list.  Set a new list to change them.
+    """
+    @abc.abstractmethod
+    def __call__(self, kind, name, value, tags):
+        """Process a metric.
+
+        :param kind: MetricsLogger.GAUGE, COUNTER or TIMER
+        :param name: Metric name, as passed to the logger
+        :param value: Metric value
+        :param tags: TagSet, or None
+        :returns: (name, value, tags) to pass on, or None to drop the metric
+        """
+
+
+class NameFilter(MetricProcessor):
+    """
+    Drops metrics by name.  allow and deny are lists of shell-style
+    patterns (see fnmatch), matched against the unformatted metric name with
+    list names joined by '.'.  A metric passes if it matches an allow pattern
+    (or allow is None) and no deny pattern.  Each list is compiled into a
+    single regular expression, and decisions are cached per name.
+
+    :param allow: Patterns of names to keep, or None to keep all
+    :param deny: Patterns of names to drop
+    """
+    # Decisions cached, forgotten once the cache grows past this many names
+    CACHE_SIZE = 10000
+
+    def __init__(self, allow=None, deny=None):
+        self._allow = self._compile(allow) if allow is not None else None
+        self._deny = self._compile(deny or ())
+        self._decisions = dict()
+
+    @staticmethod
+    def _compile(patterns):
+        if not patterns:
+            # Matches nothing
+            return re.compile(r'(?!)').match
+        return re.compile('|'.join(
+            '(?:%s)' % fnmatch.translate(p) for p in patterns)).match
+
+    def allows(self, name):
+        """True if metrics named name pass the filter."""
+        key = _name_key(name)
+        allowed = self._decisions.get(key)
+        if allowed is None:
+            allowed = ((self._allow is None or bool(self._allow(key))) and
+                       not self._deny(key))
+            if len(self._decisions) >= self.CACHE_SIZE:
+                self._decisions.clear()
+            self._decisions[key] = allowed
+        return allowed
+
+    def __call__(self, kind, name, value, tags):
+        if self.allows(name):
+            return name, value, tags
+        return None
+
+
+class RateLimiter(MetricProcessor):
+    """
+    Drops metrics sent more often than rate times per second, per metric
+    kind, name and tag set, allowing bursts of up to burst metrics (a token
+    bucket).
+
+    At most MAX_BUCKETS buckets are kept.  When they run out, buckets that
+    have refilled, which behave like new ones, are forgotten; if more than
+    half are still in use, all are, letting one burst through for each
+    metric.
+
+    :param rate: Metrics per second allowed per metric
+    :param burst: Bucket size; rate by default, with a minimum of 1
+    """
+    MAX_BUCKETS = 10000
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self._lock = threading.Lock()
+        self._buckets = dict()
+        _rate_limiters.add(self)
+
+    def __call__(self, kind, name, value, tags):
+        if _CHECK_PID:
+            _check_fork()
+        key = (kind, _name_key(name), tags)
+        now = _monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.MAX_BUCKETS:
+                    self._evict(now)
+                tokens = self.burst
+            else:
+                tokens, last = bucket
+                tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                return None
+            self._buckets[key] = (tokens - 1, now)
+        return name, value, tags
+
+    def _evict(self, now):
+        """Forget refilled buckets, or all if most are in use.  Called with
+        the lock held.
+        """
+        burst, rate = self.burst, self.rate
+        buckets = self._buckets
+        for key, (tokens, last) in list(buckets.items()):
+            if tokens + (now - last) * rate >= burst:
+                del buckets[key]
+        if len(buckets) > self.MAX_BUCKETS // 2:
+            buckets.clear()
+
+
+_rate_limiters = weakref.WeakSet()
+
+
+def _rate_limiters_after_fork():
+    for rate_limiter in list(_rate_limiters):
+        rate_limiter._lock = threading.Lock()
+
+
+_register_after_fork(_rate_limiters_after_fork)
+
+
+class Renamer(MetricProcessor):
+    """
+    Renames metrics before they are formatted, so the logger prefix and
+    host are still applied to the new name.
+
+    :param rename: Dict of old name to new name (names not in it are kept),
+        or a callable taking a name and returning the new name
+    """
+    def __init__(self, rename):
+        if isinstance(rename, dict):
+            mapping = dict((_name_key(k), v) for k, v in six.iteritems(rename))
+            self._rename = lambda name: mapping.get(_name_key(name), name)
+        else:
+            self._rename = rename
+
+    def __call__(self, kind, name, value, tags):
+        return self._rename(name), value, tags
+
+
+class ValueTransform(MetricProcessor):
+    """
+    Replaces metric values with func(value), e.g. to convert units or round.
+
+    :param func: Callable taking a value and returning the new value
+    :param kinds: Metric kinds to transform (MetricsLogger.GAUGE, COUNTER,
+        TIMER), or None for all
+    :param names: NameFilter selecting the metrics to transform, or None
+        for all
+    """
+    def __init__(self, func, kinds=None, names=None):
+        self.func = func
+        self.kinds = frozenset(kinds) if kinds is not None else None
+        self.names = names
+
+    def __call__(self, kind, name, value, tags):
+        if ((self.kinds is None or kind in self.kinds) and
+                (self.names is None or self.names.allows(name))):
+            value = self.func(value)
+        return name, value, tags
 
 
 class CounterContextDecorator(contextlib2.ContextDecorator):
@@ -141,25 +1920,89 @@ class CounterContextDecorator(contextlib2.ContextDecorator):
     Recommended to be instantiated by the counter_cd() convenience function on
     a MetricLogger.
     """
-    def __init__(self, logger, name, sample_rate):
+    def __init__(self, logger, name, sample_rate, sampler=None, tags=None):
         self.logger = logger
         self.name = name
         self.sample_rate = sample_rate
+        self.sampler = sampler or logger.sampler(sample_rate)
+        self.tags = getTagSet(tags)
+        self._kwargs = _tag_kwargs(self.tags)
 
     def __enter__(self):
-        self.logger.counter(self.name, 1, sample_rate=self.sample_rate)
+        self._count()
         return self
 
+    def __call__(self, func):
+        # Coroutine functions are counted when their coroutine starts
+        # running, and async generator functions when iteration starts.
+        if _is_async(func):
+            from . import aio
+            return aio._wrap_counter(self._count, func)
+
+        count = self._count
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            count()
+            return func(*args, **kwargs)
+        return wrapper
+
+    def _count(self):
+        if self.sampler is None or self.sampler():
+            self.logger._emit(self.logger.COUNTER, self.name, 1,
+                              self.sample_rate, **self._kwargs)
+        else:
+            self.logger._sample_skipped()
+
     def __exit__(self, *exc):
         pass
 
 
+class _LoggerStats(object):
+    """Counters kept by a MetricsLogger while setInternalStats() is on.
+    Updates from concurrent threads are not locked, and may rarely be lost.
+    """
+    __slots__ = ('metrics_emitted', 'samples_skipped', 'processor_drops',
+                 'emit_ns')
+
+    def __init__(self):
+        self.metrics_emitted = 0
+        self.samples_skipped = 0
+        self.processor_drops = 0
+        self.emit_ns = 0
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in self.__slots__)
+
+
 @six.add_metaclass(abc.ABCMeta)
 class MetricsLogger(object):
     """Abstract class representing a metrics logger."""
 
+    # Metric kinds, as queued for async delivery
+    GAUGE = 'gauge'
+    COUNTER = 'counter'
+    TIMER = 'timer'
+
+    # Metric types accepted by emit_many(): kinds, and statsd type codes
+    _KINDS = {
+        GAUGE: GAUGE, COUNTER: COUNTER, TIMER: TIMER,
+        'g': GAUGE, 'c': COUNTER, 'ms': TIMER,
+    }
+
     def __init__(self):
         self._config_override = NestedConfig(_global_config)
+        self._random = random.Random()
+        self._name_cache = (None, None)
+        self._settings_snapshot = (None, None)
+
+        # Set on loggers created by child()
+        self._parent = None
+        self._child_parts = []
+        self._children = dict()
+
+        self._stats = _LoggerStats()
+        _all_loggers.add(self)
 
         # Add getters for non-overridable options
         _, self.getLoggerClass = \
@@ -177,33 +2020,123 @@ class MetricsLogger(object):
                                              override=True)
         self.setHost, self.getHost = \
             self._config_override.add_config('host', override=True)
+        self.setAsyncDelivery, self.getAsyncDelivery = \
+            self._config_override.add_config('async_delivery', override=True)
+        self.setProcessors, self.getProcessors = \
+            self._config_override.add_config('processors', override=True)
+        self.setInternalStats, self.getInternalStats = \
+            self._config_override.add_config('internal_stats', override=True)
 
     def format_name(self, name):
         """Format a given metric name in the context of the settings for this
         MetricsLogger.
 
+        Formatted names are cached per logger, and the cache is invalidated
+        whenever a config value visible to the logger changes.
+
         :param name: Metric name
         """
+        if _CHECK_PID:
+            _check_fork()
+
+        # Names formatted while config changes land in a cache that is
+        # already stale, and is replaced on the next call.
+        version, cache = self._name_cache
+        if version != self._config_override.version:
+            version = self._config_override.version
+            cache = _LRUCache(getNameCacheSize())
+            self._name_cache = (version, cache)
+
+        key = tuple(name) if isinstance(name, list) else name
+        formatted = cache.get(key, _MISSING)
+        if formatted is _MISSING:
+            formatted = self._format_name_uncached(name)
+            cache.put(key, formatted)
+        return formatted
+
+    def _format_name_uncached(self, name):
         if self.getPrependHost():
             host = _get_host_parts(self.getHost())
         else:
             host = []
 
-        if self. getPrependHostReverse():
+        if self.getPrependHostReverse():
             host = list(reversed(host))
 
-        return self._format_name(self.getGlobalPrefix(), host,
-                                 self.getPrefix(), name)
+        prefix = self.getPrefix()
+        if self._child_parts:
+            prefix = _to_list(prefix) + self._child_parts
+
+        return self._format_name(self.getGlobalPrefix(), host, prefix, name)
+
+    def child(self, name):
+        """
+        Returns a MetricsLogger of the same class whose metric names have
+        name appended to this logger's prefix.  The child inherits this
+        logger's config (and can override it) through its NestedConfig
+        parent, and shares its backend sockets and buffers.  Children are
+        created once per name and reused.  For example:
 
-    def gauge(self, name, value):
+        DB_METRICS = getLogger("service").child("db")
+        DB_METRICS.child("query").timer("select", 1.5)
+
+        sends service.db.query.select.
+
+        :param name: Name of the child, appended to the prefix
+        """
+        child = self._children.get(name)
+        if child is None:
+            with _children_lock:
+                child = self._children.get(name)
+                if child is None:
+                    child = type(self)()
+                    child._parent = self
+                    child._child_parts = self._child_parts + [name]
+                    child._random = self._random
+                    child._config_override.set_parent(self._config_override)
+                    self._children[name] = child
+        return child
+
+    def _settings(self):
+        """Return a dict of the settings used on every emit, resolved through
+        the config chain once per config version.
+        """
+        version, settings = self._settings_snapshot
+        if version != self._config_override.version:
+            version = self._config_override.version
+            settings = self._resolve_settings()
+            self._settings_snapshot = (version, settings)
+        return settings
+
+    def _resolve_settings(self):
+        """Resolve the settings returned by _settings().  Backends extend the
+        returned dict with their own hot-path settings.
+        """
+        return {'async_delivery': self.getAsyncDelivery(),
+                'processors': tuple(self.getProcessors() or ()),
+                'internal_stats': self.getInternalStats()}
+
+    def flush(self):
+        """Send any metric data the backend has buffered.  Backends that
+        don't buffer need not override this.
+        """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def gauge(self, name, value, tags=None):
         """Send gauge metric data.
 
         :param name: Metric name
         :param value: Metric value
+        :param tags: Dict or iterable of (key, value) pairs, or a TagSet
         """
-        self._gauge(self.format_name(name), value)
+        self._emit(self.GAUGE, name, value, tags=tags)
 
-    def counter(self, name, value, sample_rate=None):
+    def counter(self, name, value, sample_rate=None, tags=None):
         """Send counter metric data.
 
         Optionally, specify sample_rate in the interval [0.0, 1.0], or None to
@@ -214,26 +2147,250 @@ class MetricsLogger(object):
         If sample_rate is None, then always send metric data, but do not
         have the backend send sample rate information (if supported).
 
+        Sampling uses a random number generator private to this logger, and
+        is decided before the name is formatted.  To avoid validating the
+        sample rate on every call, use a sampler() or counter_cd().
+
         :param name: Metric name
         :param value: Metric value
         :param sample_rate: Sample rate in interval [0.0, 1.0], or None
+        :param tags: Dict or iterable of (key, value) pairs, or a TagSet
         """
-        if sample_rate is not None and (sample_rate < 0.0 or
-                                        sample_rate > 1.0):
-            raise ValueError(
-                "sample_rate must be None, or in the interval [0.0, 1.0]")
-
-        if sample_rate is None or random.random() < sample_rate:
-            return self._counter(self.format_name(name), value,
-                                 sample_rate=sample_rate)
-
-    def timer(self, name, value):
+        if sample_rate is not None:
+            _validate_sample_rate(sample_rate)
+            if self._random.random() >= sample_rate:
+                self._sample_skipped()
+                return
+        return self._emit(self.COUNTER, name, value, sample_rate, tags)
+
+    def timer(self, name, value, tags=None):
         """Send timer data.
 
         :param name: Metric name
         :param value: Metric value
+        :param tags: Dict or iterable of (key, value) pairs, or a TagSet
+        """
+        self._emit(self.TIMER, name, value, tags=tags)
+
+    def emit_many(self, metrics, tags=None):
+        """Send a batch of metrics in one call.  Config is resolved once for
+        the batch, and backends may send the metrics together: the statsd
+        backends pack them into as few payloads as setStatsdPacketSize()
+        (PACKET_SIZE_ETHERNET if unset) allows.  For example:
+
+        METRICS.emit_many([("gauge", "pool.size", 10),
+                           ("c", "pool.checkouts", 1, 0.5),
+                           ("timer", "pool.wait", 1.5)])
+        METRICS.emit_many({"queue.depth": 3, "queue.workers": 8})
+
+        :param metrics: Iterable of (type, name, value) or (type, name,
+            value, sample_rate) tuples, where type is GAUGE, COUNTER or
+            TIMER, or the statsd type 'g', 'c' or 'ms', and sample_rate
+            applies to counters as in counter(); or a dict of gauge values
+            by name
+        :param tags: Tags sent with every metric in the batch
+        """
+        if isinstance(metrics, dict):
+            return self.emit_gauges(list(metrics), list(metrics.values()),
+                                    tags=tags)
+
+        kinds = self._KINDS
+        counter = self.COUNTER
+        rand = self._random.random
+        records = []
+        for metric in metrics:
+            if len(metric) == 4:
+                kind, name, value, sample_rate = metric
+            else:
+                kind, name, value = metric
+                sample_rate = None
+            try:
+                kind = kinds[kind]
+            except KeyError:
+                raise ValueError("Unknown metric type %r" % (kind,))
+            if kind != counter:
+                sample_rate = None
+            elif sample_rate is not None:
+                _validate_sample_rate(sample_rate)
+                if rand() >= sample_rate:
+                    self._sample_skipped()
+                    continue
+            records.append((kind, name, value, sample_rate))
+        return self._emit_many(records, tags)
+
+    def emit_gauges(self, names, values, tags=None):
+        """Send a gauge for each of names, with the value at the same index
+        of values, in one call.  The vectorized form of emit_many(): values
+        may be any sequence, including an array.array or a numpy array.
+
+        :param names: Sequence of metric names
+        :param values: Sequence of metric values, as long as names
+        :param tags: Tags sent with every gauge
         """
-        self._timer(self.format_name(name), value)
+        if hasattr(values, 'tolist'):
+            # array.array and numpy arrays, converted in one C call
+            values = values.tolist()
+        if len(names) != len(values):
+            raise ValueError("names and values must have the same length")
+
+        settings = self._settings()
+        if (settings['processors'] or settings['internal_stats'] or
+                settings['async_delivery']):
+            gauge = self.GAUGE
+            return self._emit_many(
+                [(gauge, name, value, None)
+                 for name, value in zip(names, values)], tags)
+
+        format_name = self.format_name
+        self._deliver_gauges([format_name(name) for name in names], values,
+                             getTagSet(tags))
+
+    def _emit_many(self, records, tags):
+        """Send (kind, name, value, sample_rate) records that have passed
+        sampling.
+        """
+        tags = getTagSet(tags)
+        settings = self._settings()
+        if (settings['processors'] or settings['internal_stats'] or
+                settings['async_delivery']):
+            for kind, name, value, sample_rate in records:
+                self._emit(kind, name, value, sample_rate, tags)
+            return
+
+        format_name = self.format_name
+        self._deliver_many([(kind, format_name(name), value, sample_rate)
+                            for kind, name, value, sample_rate in records],
+                           tags)
+
+    def _deliver_many(self, records, tags):
+        """Send (kind, name, value, sample_rate) records with formatted
+        names.  Backends may override this to send them together.
+        """
+        kwargs = _tag_kwargs(tags)
+        gauge, counter = self.GAUGE, self.COUNTER
+        for kind, name, value, sample_rate in records:
+            if kind == gauge:
+                self._gauge(name, value, **kwargs)
+            elif kind == counter:
+                self._counter(name, value, sample_rate=sample_rate, **kwargs)
+            else:
+                self._timer(name, value, **kwargs)
+
+    def _deliver_gauges(self, names, values, tags):
+        """Send gauges with formatted names.  Backends may override this to
+        send them together.
+        """
+        kwargs = _tag_kwargs(tags)
+        for name, value in zip(names, values):
+            self._gauge(name, value, **kwargs)
+
+    def sampler(self, sample_rate, deterministic=False):
+        """Return a sampler for sample_rate: a callable returning True when a
+        sampled metric should be sent.  The rate is validated once, here.
+
+        :param sample_rate: Sample rate in interval [0.0, 1.0], or None
+        :param deterministic: Sample exactly every 1 / sample_rate calls
+            with an EveryNthSampler, rather than randomly
+        :returns: A sampler, or None if sample_rate is None and every call
+            should be sent
+        """
+        if sample_rate is None:
+            return None
+        elif deterministic:
+            return EveryNthSampler(sample_rate)
+        else:
+            return RandomSampler(sample_rate, self._random)
+
+    def _emit(self, kind, name, value, sample_rate=None, tags=None):
+        """Run a metric that has already passed sampling through the
+        processors, then send it, either directly or through async delivery.
+        """
+        if tags is not None:
+            tags = getTagSet(tags)
+        settings = self._settings()
+        if settings['internal_stats']:
+            return self._emit_instrumented(settings, kind, name, value,
+                                           sample_rate, tags)
+        if settings['processors']:
+            metric = self._process(settings['processors'], kind, name,
+                                   value, tags)
+            if metric is None:
+                return None
+            name, value, tags = metric
+        if settings['async_delivery']:
+            _async_sender.put(self, kind, name, value, sample_rate, tags)
+        else:
+            return self._deliver(kind, name, value, sample_rate, tags)
+
+    def _emit_instrumented(self, settings, kind, name, value, sample_rate,
+                           tags):
+        """_emit(), counting metrics and the time spent in _stats."""
+        stats = self._stats
+        start_ns = _time_ns()
+        try:
+            if settings['processors']:
+                metric = self._process(settings['processors'], kind, name,
+                                       value, tags)
+                if metric is None:
+                    stats.processor_drops += 1
+                    return None
+                name, value, tags = metric
+            stats.metrics_emitted += 1
+            if settings['async_delivery']:
+                _async_sender.put(self, kind, name, value, sample_rate, tags)
+            else:
+                return self._deliver(kind, name, value, sample_rate, tags)
+        finally:
+            stats.emit_ns += _time_ns() - start_ns
+
+    @staticmethod
+    def _process(processors, kind, name, value, tags):
+        for processor in processors:
+            metric = processor(kind, name, value, tags)
+            if metric is None:
+                return None
+            name, value, tags = metric
+        if tags is not None:
+            tags = getTagSet(tags)
+        return name, value, tags
+
+    def _sample_skipped(self):
+        """Count a metric skipped by sampling, if internal stats are on."""
+        if self._settings()['internal_stats']:
+            self._stats.samples_skipped += 1
+
+    def stats_name(self):
+        """Name this logger's internal stats are reported under: its prefix,
+        with the names of child() loggers appended.
+        """
+        return _list_join('.', True, self.getPrefix(),
+                          self._child_parts) or 'default'
+
+    def getStats(self):
+        """Return a dict of this logger's internal stats, counted while
+        setInternalStats() is on:
+
+        * metrics_emitted: metrics sent, or queued for async delivery
+        * samples_skipped: counters not sent because of sampling
+        * processor_drops: metrics dropped by processors
+        * emit_ns: nanoseconds spent sending metrics, including processing,
+          formatting and I/O
+        """
+        return self._stats.as_dict()
+
+    def _deliver(self, kind, name, value, sample_rate, tags=None):
+        """Format and send a metric.  Sampling has already been applied by
+        the caller.  Backends are only passed tags when there are some.
+        """
+        name = self.format_name(name)
+        kwargs = _tag_kwargs(tags)
+        if kind == self.GAUGE:
+            return self._gauge(name, value, **kwargs)
+        elif kind == self.COUNTER:
+            return self._counter(name, value, sample_rate=sample_rate,
+                                 **kwargs)
+        else:
+            return self._timer(name, value, **kwargs)
 
     @abc.abstractmethod
     def _format_name(self, global_prefix, host, prefix, name):
@@ -249,6 +2406,9 @@ class MetricsLogger(object):
     def _gauge(self, name, value):
         """Abstract method for backends to implement gauge behavior.
 
+        Backends supporting tags accept a tags keyword argument, a TagSet,
+        which is only passed for metrics that have tags.
+
         :param name: Metric name
         :param value: Metric value
         """
@@ -258,7 +2418,7 @@ class MetricsLogger(object):
         """Abstract method for backends to implement counter behavior.
 
         This function is called with P(call) = sample_rate, as described in
-        counter().
+        counter().  Tags are passed as for _gauge().
 
         :param name: Metric name
         :param value: Metric value
@@ -269,11 +2429,13 @@ class MetricsLogger(object):
     def _timer(self, name, value):
         """Abstract method for backends to implement timer behavior.
 
+        Tags are passed as for _gauge().
+
         :param name: Metric name
         :param value: Metric value
         """
 
-    def timer_cd(self, name):
+    def timer_cd(self, name, tags=None):
         """
         Returns a TimerContextDecorator bound to this MetricsLogger for use
         timing function calls, or code blocks.  Can be used either as a
@@ -289,10 +2451,12 @@ class MetricsLogger(object):
             do_something()
 
         :param name: Metric name
+        :param tags: Tags sent with each timer
         """
-        return TimerContextDecorator(self, name)
+        return TimerContextDecorator(self, name, tags)
 
-    def counter_cd(self, name, sample_rate=None):
+    def counter_cd(self, name, sample_rate=None, deterministic=False,
+                   tags=None):
         """
         Returns a CounterContextDecorator bound to this MetricsLogger for use
         counting function calls, or code block executions.  Can be used either
@@ -309,22 +2473,291 @@ class MetricsLogger(object):
 
         :param name: Metric name
         :param sample_rate: Sample rate to be passed to counter()
+        :param deterministic: Sample every 1 / sample_rate calls exactly,
+            rather than randomly
+        :param tags: Tags sent with each counter
+        """
+        return CounterContextDecorator(
+            self, name, sample_rate,
+            sampler=self.sampler(sample_rate, deterministic), tags=tags)
+
+    def timer_acd(self, name, tags=None):
+        """
+        Returns an AsyncTimerContextDecorator bound to this MetricsLogger for
+        use timing coroutine functions, or code blocks within them.  Can be
+        used either as a decorator, or an async context manager.  For
+        example:
+
+        METRICS = getLogger("name")
+
+        @METRICS.timer_acd("foo")
+        async def foo():
+            await do_something()
+
+        async with METRICS.timer_acd("bar"):
+            await do_something()
+
+        Requires asyncio (Python 3.7+).
+
+        :param name: Metric name
+        :param tags: Tags sent with each timer
+        """
+        from . import aio
+        return aio.AsyncTimerContextDecorator(self, name, tags)
+
+    def counter_acd(self, name, sample_rate=None, deterministic=False,
+                    tags=None):
+        """
+        Returns an AsyncCounterContextDecorator bound to this MetricsLogger
+        for use counting coroutine function calls, or code blocks within
+        them.  Can be used either as a decorator, or an async context
+        manager, like timer_acd().  Requires asyncio (Python 3.7+).
+
+        :param name: Metric name
+        :param sample_rate: Sample rate to be passed to counter()
+        :param deterministic: Sample every 1 / sample_rate calls exactly,
+            rather than randomly
+        :param tags: Tags sent with each counter
         """
-        return CounterContextDecorator(self, name, sample_rate)
+        from . import aio
+        return aio.AsyncCounterContextDecorator(
+            self, name, sample_rate,
+            sampler=self.sampler(sample_rate, deterministic), tags=tags)
 
-    def return_val_gauge_d(self, name):
+    def gauge_handle(self, name, tags=None):
+        """
+        Returns a GaugeHandle bound to this MetricsLogger and name.  The
+        handle resolves the metric name once, rather than on every call,
+        until the config changes.  For example:
+
+        ACTIVE = getLogger("name").gauge_handle("active")
+        ACTIVE.set(10)
+
+        :param name: Metric name
+        :param tags: Tags sent with each value
+        """
+        return GaugeHandle(self, name, tags=tags)
+
+    def counter_handle(self, name, sample_rate=None, deterministic=False,
+                       tags=None):
+        """
+        Returns a CounterHandle bound to this MetricsLogger and name.  The
+        handle resolves the metric name once, rather than on every call,
+        until the config changes, and validates sample_rate once.  For
+        example:
+
+        REQUESTS = getLogger("name").counter_handle("requests")
+        REQUESTS.inc()
+
+        :param name: Metric name
+        :param sample_rate: Sample rate in interval [0.0, 1.0], or None
+        :param deterministic: Sample every 1 / sample_rate calls exactly,
+            rather than randomly
+        :param tags: Tags sent with each value
+        """
+        return CounterHandle(self, name, sample_rate,
+                             self.sampler(sample_rate, deterministic), tags)
+
+    def timer_handle(self, name, tags=None):
+        """
+        Returns a TimerHandle bound to this MetricsLogger and name.  The
+        handle resolves the metric name once, rather than on every call,
+        until the config changes.
+
+        :param name: Metric name
+        :param tags: Tags sent with each value
+        """
+        return TimerHandle(self, name, tags=tags)
+
+    def _bind_handle(self, kind, name, sample_rate, tags=None):
+        """Return a callable sending a value for a metric handle, valid until
+        this logger's config version changes.  Backends may override this
+        to pre-format more of the metric.
+        """
+        settings = self._settings()
+        if settings['processors'] or settings['internal_stats']:
+            # Processors may drop, rename or change each value
+            emit = self._emit
+            return lambda value: emit(kind, name, value, sample_rate, tags)
+
+        if settings['async_delivery']:
+            put = _async_sender.put
+
+            def send(value):
+                put(self, kind, name, value, sample_rate, tags)
+            return send
+
+        name = self.format_name(name)
+        kwargs = _tag_kwargs(tags)
+        if kind == self.GAUGE:
+            gauge = self._gauge
+            return lambda value: gauge(name, value, **kwargs)
+        elif kind == self.COUNTER:
+            counter = self._counter
+            return lambda value: counter(name, value,
+                                         sample_rate=sample_rate, **kwargs)
+        else:
+            timer = self._timer
+            return lambda value: timer(name, value, **kwargs)
+
+    def return_val_gauge_d(self, name, tags=None):
         """
         Returns a decorator bound to this metrics MetricsLogger that emits the
         return value of the function it wraps as a gauge each time it is
-        called.
+        called.  For coroutine functions, the awaited result is emitted; for
+        async generator functions, each value yielded.
         :param name: Metric name
+        :param tags: Tags sent with each gauge
         """
+        tags = getTagSet(tags)
+        tag_kwargs = _tag_kwargs(tags)
+
         @wrapt.decorator
         def wrapper(wrapped, instance, args, kwargs):
             result = wrapped(*args, **kwargs)
-            self.gauge(name, result)
+            self.gauge(name, result, **tag_kwargs)
             return result
-        return wrapper
+
+        def decorator(func):
+            # Coroutine functions gauge the awaited result, and async
+            # generator functions each value they yield.
+            if _is_async(func):
+                from . import aio
+                return aio._wrap_return_val_gauge(self, name, func, tags)
+            return wrapper(func)
+        return decorator
+
+    def add_collector(self, name, collector, interval, timeout=None,
+                      tags=None):
+        """
+        Registers a collector, sampled every interval seconds from a
+        background thread, whose values are sent as gauges.  Use it to poll
+        values like queue sizes rather than running a thread of your own.
+        For example:
+
+        METRICS.add_collector("queue.depth", work_queue.qsize, 10)
+        METRICS.add_collector("pool", lambda: {"size": pool.size,
+                                               "idle": pool.idle}, 10)
+
+        Collectors registered with the same interval, on any logger, are
+        sampled together, and their values sent in one batch per logger.
+        Each collector runs on a worker thread, so one that is slow or hangs
+        can't hold up the others: its values are skipped if it hasn't
+        returned within timeout seconds, and it isn't sampled again until it
+        does.
+
+        :param name: Metric name of the value returned; for a dict of
+            values, the prefix of their names, or None for no prefix
+        :param collector: Callable, or object with a collect() method,
+            taking no arguments and returning a value, a dict of values by
+            metric name (a string, or a tuple of name parts), or None to send
+            nothing
+        :param interval: Seconds between samples
+        :param timeout: Seconds to wait for the collector, or None for
+            getCollectorTimeout()
+        :param tags: Tags sent with each gauge
+        :returns: CollectorRegistration, whose remove() method stops
+            sampling the collector
+        """
+        collect = getattr(collector, 'collect', collector)
+        if not callable(collect):
+            raise TypeError("%r is not callable and has no collect() method"
+                            % (collector,))
+        if _is_async(collect):
+            raise TypeError("Collectors are called from a thread, and can't "
+                            "be coroutine functions: %r" % (collector,))
+        if not interval or interval <= 0:
+            raise ValueError("Collector interval must be positive")
+
+        registration = CollectorRegistration(self, name, collect, interval,
+                                             timeout, getTagSet(tags))
+        _collectors.add(registration)
+        return registration
+
+
+class _MetricHandle(object):
+    """Base class for metric handles bound to a logger and metric name."""
+    __slots__ = ('logger', 'name', 'sample_rate', 'tags', '_sampler',
+                 '_config', '_version', '_send')
+
+    KIND = None
+
+    def __init__(self, logger, name, sample_rate=None, sampler=None,
+                 tags=None):
+        self.logger = logger
+        self.name = name
+        self.sample_rate = sample_rate
+        self.tags = getTagSet(tags)
+        self._sampler = sampler
+        self._config = logger._config_override
+        self._version = None
+        self._send = None
+
+    def _bind(self):
+        version = self._config.version
+        self._send = self.logger._bind_handle(self.KIND, self.name,
+                                              self.sample_rate, self.tags)
+        self._version = version
+
+
+class GaugeHandle(_MetricHandle):
+    """Sends gauge values for a fixed metric name.  Recommended to be
+    instantiated by the gauge_handle() convenience function on a
+    MetricsLogger.
+    """
+    __slots__ = ()
+
+    KIND = MetricsLogger.GAUGE
+
+    def set(self, value):
+        """Send a gauge value.
+
+        :param value: Metric value
+        """
+        if self._version != self._config.version:
+            self._bind()
+        return self._send(value)
+
+
+class CounterHandle(_MetricHandle):
+    """Sends counter values for a fixed metric name, sampled as configured
+    on creation.  Recommended to be instantiated by the counter_handle()
+    convenience function on a MetricsLogger.
+    """
+    __slots__ = ()
+
+    KIND = MetricsLogger.COUNTER
+
+    def inc(self, value=1):
+        """Send a counter value, subject to sampling.
+
+        :param value: Metric value
+        """
+        if self._sampler is not None and not self._sampler():
+            self.logger._sample_skipped()
+            return None
+        if self._version != self._config.version:
+            self._bind()
+        return self._send(value)
+
+
+class TimerHandle(_MetricHandle):
+    """Sends timer values for a fixed metric name.  Recommended to be
+    instantiated by the timer_handle() convenience function on a
+    MetricsLogger.
+    """
+    __slots__ = ()
+
+    KIND = MetricsLogger.TIMER
+
+    def record(self, value):
+        """Send a timer value.
+
+        :param value: Metric value
+        """
+        if self._version != self._config.version:
+            self._bind()
+        return self._send(value)
 
 
 class NoopMetricsLogger(MetricsLogger):
@@ -364,7 +2797,27 @@ class DebugMetricsLogger(MetricsLogger):
 
 
 class StatsdMetricsLogger(MetricsLogger):
-    """MetricsLogger that sends data via the statsd protocol."""
+    """
+    MetricsLogger that sends data via the statsd protocol.
+
+    Lines are sent over the transport set by setStatsdTransport():
+
+    * 'udp': datagrams to setStatsdHost():setStatsdPort() (default)
+    * 'unix': datagrams to the unix socket at setStatsdSocketPath(), for
+      agents on the same host
+    * 'tcp': newline-terminated lines over a persistent connection to
+      setStatsdHost():setStatsdPort(), buffered in memory while the agent is
+      unreachable (see setStatsdTcpBufferSize())
+
+    The statsd host is resolved once, to an IPv4 or IPv6 address, and
+    re-resolved in the background every setStatsdDnsTtl() seconds.
+
+    Tags are encoded in the dialect set by setStatsdTagFormat():
+
+    * 'dogstatsd': name:value|type|#key:value,key2:value2 (default)
+    * 'influxdb': name,key=value,key2=value2:value|type
+    * 'graphite': name;key=value;key2=value2:value|type
+    """
 
     GAUGE_TYPE = 'g'
     COUNTER_TYPE = 'c'
@@ -372,6 +2825,47 @@ class StatsdMetricsLogger(MetricsLogger):
 
     PROHIBITED_CHARS = ':|@\n'
     REPLACE_CHARS = '----'
+    _SANITIZE_TABLE = _translation_table(PROHIBITED_CHARS, REPLACE_CHARS)
+    _NUMBER_TYPES = frozenset(six.integer_types + (float,))
+
+    # Strings known to need no sanitizing, forgotten once the set grows past
+    # CLEAN_STRINGS_CACHE_SIZE entries
+    CLEAN_STRINGS_CACHE_SIZE = 10000
+    _clean_strings = set()
+
+    # Further characters replaced in tag keys and values
+    TAG_PROHIBITED_CHARS = ',#=; '
+    TAG_REPLACE_CHARS = '-----'
+    _TAG_SANITIZE_TABLE = _translation_table(TAG_PROHIBITED_CHARS,
+                                             TAG_REPLACE_CHARS)
+
+    TAG_FORMAT_DOGSTATSD = 'dogstatsd'
+    TAG_FORMAT_INFLUXDB = 'influxdb'
+    TAG_FORMAT_GRAPHITE = 'graphite'
+
+    # Per tag format: whether tags follow the name (rather than the line),
+    # what starts them, and the pair and key/value separators
+    _TAG_FORMATS = {
+        TAG_FORMAT_DOGSTATSD: (False, '|#', ',', ':'),
+        TAG_FORMAT_INFLUXDB: (True, ',', ',', '='),
+        TAG_FORMAT_GRAPHITE: (True, ';', ';', '='),
+    }
+
+    _TYPES = {
+        MetricsLogger.GAUGE: GAUGE_TYPE,
+        MetricsLogger.COUNTER: COUNTER_TYPE,
+        MetricsLogger.TIMER: TIMER_TYPE,
+    }
+
+    TRANSPORT_UDP = 'udp'
+    TRANSPORT_UNIX = 'unix'
+    TRANSPORT_TCP = 'tcp'
+
+    # Common payload sizes for setStatsdPacketSize(): safe for any internet
+    # path, a standard 1500 byte ethernet MTU, and 9000 byte jumbo frames.
+    PACKET_SIZE_INTERNET = 512
+    PACKET_SIZE_ETHERNET = 1432
+    PACKET_SIZE_JUMBO = 8932
 
     def __init__(self):
         super(StatsdMetricsLogger, self).__init__()
@@ -383,45 +2877,448 @@ class StatsdMetricsLogger(MetricsLogger):
             self._config_override.add_config('statsd_host', override=True)
         self.setStatsdPort, self.getStatsdPort = \
             self._config_override.add_config('statsd_port', override=True)
+        self.setStatsdPacketSize, self.getStatsdPacketSize = \
+            self._config_override.add_config('statsd_packet_size',
+                                             override=True)
+        self.setStatsdFlushInterval, self.getStatsdFlushInterval = \
+            self._config_override.add_config('statsd_flush_interval',
+                                             override=True)
+        self.setStatsdTagFormat, self.getStatsdTagFormat = \
+            self._config_override.add_config('statsd_tag_format',
+                                             override=True)
+        self.setStatsdTransport, self.getStatsdTransport = \
+            self._config_override.add_config('statsd_transport',
+                                             override=True)
+        self.setStatsdSocketPath, self.getStatsdSocketPath = \
+            self._config_override.add_config('statsd_socket_path',
+                                             override=True)
 
-    def _send(self, name, value, type, sample_rate=None):
-        if sample_rate is None:
-            metric = '%s:%s|%s' % (self._sanitize(name),
-                                   self._sanitize(value),
-                                   self._sanitize(type))
+    def _send(self, name, value, type, sample_rate=None, tags=None):
+        sanitize = self._sanitize
+        if tags is None:
+            metric = (sanitize(name) + ':' + sanitize(value) + '|' +
+                      sanitize(type))
+            if sample_rate is not None:
+                metric += '@' + sanitize(sample_rate)
         else:
-            metric = '%s:%s|%s@%s' % (self._sanitize(name),
-                                      self._sanitize(value),
-                                      self._sanitize(type),
-                                      self._sanitize(sample_rate))
+            name_tags, line_tags = self._encode_tags(tags)
+            metric = (sanitize(name) + name_tags + ':' + sanitize(value) +
+                      '|' + sanitize(type))
+            if sample_rate is not None:
+                metric += '@' + sanitize(sample_rate)
+            metric += line_tags
+
+        return self._write(_encode(metric))
+
+    def _encode_tags(self, tags):
+        """Return the strings to append to the name and to the line for a
+        TagSet, encoded once per tag format and cached on the tag set.
+        """
+        tag_format = self._settings()['tag_format']
+        encoded = tags._encoded.get(tag_format)
+        if encoded is None:
+            encoded = tags._encoded[tag_format] = self._format_tags(
+                tags, tag_format)
+        return encoded
+
+    @classmethod
+    def _format_tags(cls, tags, tag_format):
+        try:
+            in_name, start, pair_sep, kv_sep = cls._TAG_FORMATS[tag_format]
+        except KeyError:
+            raise ValueError("Unknown statsd tag format %r" % (tag_format,))
+
+        sanitize = cls._sanitize_tag
+        encoded = start + pair_sep.join(
+            sanitize(key) + kv_sep + sanitize(value) for key, value in tags)
+        return (encoded, '') if in_name else ('', encoded)
+
+    @classmethod
+    def _sanitize_tag(cls, s):
+        return cls._sanitize(s).translate(cls._TAG_SANITIZE_TABLE)
+
+    def _resolve_settings(self):
+        settings = super(StatsdMetricsLogger, self)._resolve_settings()
+        transport = self.getStatsdTransport()
+        if transport == self.TRANSPORT_UNIX:
+            target = self.getStatsdSocketPath()
+            open_socket = self._open_unix_socket
+        else:
+            target = (self.getStatsdHost(), self.getStatsdPort())
+            open_socket = self._open_socket
+        settings.update(
+            target=target,
+            transport_name=transport,
+            transport=_get_transport(transport, target, open_socket),
+            packet_size=self.getStatsdPacketSize(),
+            flush_interval=self.getStatsdFlushInterval(),
+            tag_format=self.getStatsdTagFormat())
+        return settings
+
+    def _write(self, line):
+        """Send a formatted statsd line over this logger's transport,
+        batching it with other lines for the same transport if a packet size
+        is configured.
+        """
+        settings = self._settings()
+        if not settings['packet_size']:
+            return settings['transport'].send(line)
 
-        with contextlib.closing(self._open_socket()) as sock:
-            return sock.sendto(metric, (self.getStatsdHost(),
-                                        self.getStatsdPort()))
+        _get_packet_buffer(settings['transport']).add(
+            line, settings['packet_size'], settings['flush_interval'])
+
+    def _write_many(self, lines):
+        """Send formatted statsd lines over this logger's transport, packed
+        into as few payloads as the packet size allows.
+        """
+        settings = self._settings()
+        packet_size = settings['packet_size']
+        if packet_size:
+            buf = _get_packet_buffer(settings['transport'])
+            flush_interval = settings['flush_interval']
+            for line in lines:
+                buf.add(line, packet_size, flush_interval)
+            return
+
+        send = settings['transport'].send
+        for payload in _pack_lines(lines, self.PACKET_SIZE_ETHERNET):
+            send(payload)
+
+    def _deliver_many(self, records, tags):
+        sanitize = self._sanitize
+        types = self._TYPES
+        name_tags, line_tags = ('', '') if tags is None else \
+            self._encode_tags(tags)
+        lines = []
+        for kind, name, value, sample_rate in records:
+            metric = (sanitize(name) + name_tags + ':' + sanitize(value) +
+                      '|' + types[kind])
+            if sample_rate is not None:
+                metric += '@' + sanitize(sample_rate)
+            lines.append(_encode(metric + line_tags))
+        self._write_many(lines)
+
+    def _deliver_gauges(self, names, values, tags):
+        sanitize = self._sanitize
+        name_tags, line_tags = ('', '') if tags is None else \
+            self._encode_tags(tags)
+        suffix = '|' + self.GAUGE_TYPE + line_tags
+        self._write_many([
+            _encode(sanitize(name) + name_tags + ':' + sanitize(value) +
+                    suffix)
+            for name, value in zip(names, values)])
+
+    def flush(self):
+        """Send any lines buffered for this logger's transport."""
+        buf = _packet_buffers.get(self._settings()['transport'])
+        if buf is not None:
+            buf.flush()
+
+    @classmethod
+    def _sanitize(cls, s):
+        """Convert s to a native string with prohibited characters replaced.
+
+        Numbers are formatted directly, since they can't contain prohibited
+        characters.  Strings already found to be clean are remembered, so
+        names sent repeatedly skip translation.
+        """
+        s_type = type(s)
+        if s_type is str:
+            if s in cls._clean_strings:
+                return s
+        elif s_type in cls._NUMBER_TYPES:
+            return str(s)
+        elif s_type is six.text_type:
+            s = s.encode('utf-8')
+        elif s_type is six.binary_type:
+            s = s.decode('utf-8')
+        else:
+            s = str(s)
+
+        clean = s.translate(cls._SANITIZE_TABLE)
+        if clean == s:
+            if len(cls._clean_strings) >= cls.CLEAN_STRINGS_CACHE_SIZE:
+                cls._clean_strings.clear()
+            cls._clean_strings.add(s)
+        return clean
 
     @staticmethod
-    def _sanitize(s):
-        return str(s).translate(string.maketrans(
-            StatsdMetricsLogger.PROHIBITED_CHARS,
-            StatsdMetricsLogger.REPLACE_CHARS))
+    def _open_socket(family=socket.AF_INET):
+        return socket.socket(family, socket.SOCK_DGRAM)
 
     @staticmethod
-    def _open_socket():
-        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    def _open_unix_socket(family=socket.AF_UNIX):
+        return socket.socket(family, socket.SOCK_DGRAM)
 
     def _format_name(self, global_prefix, host, prefix, name):
         return _list_join(self.getStatsdDelimiter(), True,
                           global_prefix, host, prefix, name)
 
-    def _gauge(self, m_name, m_value):
-        return self._send(m_name, m_value, self.GAUGE_TYPE)
+    def _gauge(self, m_name, m_value, tags=None):
+        if tags is None:
+            return self._send(m_name, m_value, self.GAUGE_TYPE)
+        return self._send(m_name, m_value, self.GAUGE_TYPE, tags=tags)
 
-    def _counter(self, m_name, m_value, sample_rate=None):
+    def _counter(self, m_name, m_value, sample_rate=None, tags=None):
+        if tags is None:
+            return self._send(m_name, m_value, self.COUNTER_TYPE,
+                              sample_rate=sample_rate)
         return self._send(m_name, m_value, self.COUNTER_TYPE,
-                          sample_rate=sample_rate)
+                          sample_rate=sample_rate, tags=tags)
+
+    def _timer(self, m_name, m_value, tags=None):
+        if tags is None:
+            return self._send(m_name, m_value, self.TIMER_TYPE)
+        return self._send(m_name, m_value, self.TIMER_TYPE, tags=tags)
+
+    def _bind_handle(self, kind, name, sample_rate, tags=None):
+        settings = self._settings()
+        if (settings['async_delivery'] or settings['processors'] or
+                settings['internal_stats']):
+            return super(StatsdMetricsLogger, self)._bind_handle(
+                kind, name, sample_rate, tags)
+
+        # Everything but the value is formatted once, here
+        sanitize = self._sanitize
+        write = self._write
+        name_tags, line_tags = ('', '') if tags is None else \
+            self._encode_tags(tags)
+        prefix = sanitize(self.format_name(name)) + name_tags + ':'
+        suffix = '|' + self._TYPES[kind]
+        if sample_rate is not None:
+            suffix += '@' + sanitize(sample_rate)
+        suffix += line_tags
+
+        def send(value):
+            return write(_encode(prefix + sanitize(value) + suffix))
+        return send
+
+
+class _LogHistogram(object):
+    """
+    Mergeable histogram of timer values with logarithmically sized buckets.
+
+    Each bucket spans a fixed ratio of 1 + PRECISION, so percentiles are
+    accurate to within PRECISION relative error.  Values are clamped to
+    [MIN_VALUE, MAX_VALUE], which bounds the number of buckets, and hence the
+    memory used, regardless of how many values are recorded.  Count, min,
+    max and sum are tracked exactly.
+    """
+    PRECISION = 0.02
+    MIN_VALUE = 0.001
+    MAX_VALUE = 3600000.0
 
-    def _timer(self, m_name, m_value):
-        return self._send(m_name, m_value, self.TIMER_TYPE)
+    _LOG_BASE = math.log(1 + PRECISION)
+    NUM_BUCKETS = int(math.log(MAX_VALUE / MIN_VALUE) / _LOG_BASE) + 1
+
+    __slots__ = ('buckets', 'count', 'min', 'max', 'sum')
+
+    def __init__(self):
+        self.buckets = dict()
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0
+
+    def record(self, value):
+        if value <= self.MIN_VALUE:
+            index = 0
+        else:
+            index = min(int(math.log(value / self.MIN_VALUE) / self._LOG_BASE),
+                        self.NUM_BUCKETS - 1)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the values recorded by another histogram to this one."""
+        for index, count in six.iteritems(other.buckets):
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or
+                                      other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or
+                                      other.max > self.max):
+            self.max = other.max
+
+    def mean(self):
+        return self.sum / float(self.count) if self.count else None
+
+    def percentiles(self, percents):
+        """Return the approximate value at each of percents, a sorted
+        sequence of numbers in [0, 100].
+        """
+        if not self.count:
+            return [None] * len(percents)
+
+        results = []
+        targets = iter(percents)
+        percent = next(targets, None)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            while percent is not None and seen >= percent / 100.0 * self.count:
+                results.append(self._bucket_value(index))
+                percent = next(targets, None)
+        while len(results) < len(percents):
+            results.append(self.max)
+        return results
+
+    def _bucket_value(self, index):
+        # Geometric midpoint of the bucket, clamped to the exact extremes
+        value = self.MIN_VALUE * math.exp((index + 0.5) * self._LOG_BASE)
+        return min(max(value, self.min), self.max)
+
+
+class AggregatingMetricsLogger(StatsdMetricsLogger):
+    """
+    StatsdMetricsLogger that aggregates counters and gauges in-process, and
+    sends one line per metric name and tag set every setAggregateInterval()
+    seconds.
+
+    Counters are summed, scaling each sampled value by 1 / sample_rate so the
+    totals stay correct; gauges keep their last value.  Timers are sent
+    unaggregated, unless setAggregateTimers(True) is set: then they are
+    recorded into a fixed-size histogram per name, and sent as count, min,
+    max, mean and setTimerPercentiles() gauges (e.g. name.p99).  Aggregates
+    are also sent on flush() and at interpreter exit.
+    """
+    def __init__(self):
+        super(AggregatingMetricsLogger, self).__init__()
+
+        self.setAggregateInterval, self.getAggregateInterval = \
+            self._config_override.add_config('aggregate_interval',
+                                             override=True)
+        self.setAggregateTimers, self.getAggregateTimers = \
+            self._config_override.add_config('aggregate_timers',
+                                             override=True)
+        self.setTimerPercentiles, self.getTimerPercentiles = \
+            self._config_override.add_config('timer_percentiles',
+                                             override=True)
+
+        self._lock = threading.Lock()
+        self._counters = dict()
+        self._gauges = dict()
+        self._timers = dict()
+
+        self._flush_entry = None
+        self._schedule_flush()
+        self._config_override.subscribe(self._config_changed)
+        _aggregators.add(self)
+
+    def _counter(self, m_name, m_value, sample_rate=None, tags=None):
+        if sample_rate:
+            m_value = m_value / float(sample_rate)
+        key = (m_name, tags)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + m_value
+
+    def _gauge(self, m_name, m_value, tags=None):
+        with self._lock:
+            self._gauges[(m_name, tags)] = m_value
+
+    def _timer(self, m_name, m_value, tags=None):
+        if not self._settings()['aggregate_timers']:
+            return super(AggregatingMetricsLogger, self)._timer(
+                m_name, m_value, tags=tags)
+
+        key = (m_name, tags)
+        with self._lock:
+            histogram = self._timers.get(key)
+            if histogram is None:
+                histogram = self._timers[key] = _LogHistogram()
+            histogram.record(m_value)
+
+    # Values must go through the aggregating _gauge/_counter/_timer
+    def _bind_handle(self, kind, name, sample_rate, tags=None):
+        return MetricsLogger._bind_handle(self, kind, name, sample_rate, tags)
+
+    def _deliver_many(self, records, tags):
+        return MetricsLogger._deliver_many(self, records, tags)
+
+    def _deliver_gauges(self, names, values, tags):
+        return MetricsLogger._deliver_gauges(self, names, values, tags)
+
+    def _resolve_settings(self):
+        settings = super(AggregatingMetricsLogger, self)._resolve_settings()
+        settings['aggregate_timers'] = self.getAggregateTimers()
+        return settings
+
+    def flush(self):
+        """Send the aggregates collected since the last flush, then any lines
+        buffered for this logger's target.
+        """
+        with self._lock:
+            counters, self._counters = self._counters, dict()
+            gauges, self._gauges = self._gauges, dict()
+            timers, self._timers = self._timers, dict()
+
+        send_gauge = super(AggregatingMetricsLogger, self)._gauge
+        send_counter = super(AggregatingMetricsLogger, self)._counter
+        for (m_name, tags), m_value in six.iteritems(counters):
+            send_counter(m_name, m_value, tags=tags)
+        for (m_name, tags), m_value in six.iteritems(gauges):
+            send_gauge(m_name, m_value, tags=tags)
+        if timers:
+            for m_name, tags, m_value in self._timer_summaries(timers):
+                send_gauge(m_name, m_value, tags=tags)
+        super(AggregatingMetricsLogger, self).flush()
+
+    def _timer_summaries(self, timers):
+        delimiter = self.getStatsdDelimiter()
+        percents = sorted(self.getTimerPercentiles() or ())
+        labels = ['p%s' % str(p).replace('.', '_') for p in percents]
+
+        for (m_name, tags), histogram in six.iteritems(timers):
+            prefix = m_name + delimiter
+            yield prefix + 'count', tags, histogram.count
+            yield prefix + 'min', tags, histogram.min
+            yield prefix + 'max', tags, histogram.max
+            yield prefix + 'mean', tags, histogram.mean()
+            values = histogram.percentiles(percents)
+            for label, value in zip(labels, values):
+                yield prefix + label, tags, value
+
+    def _schedule_flush(self):
+        if self._flush_entry is not None:
+            _scheduler.cancel(self._flush_entry)
+
+        interval = self.getAggregateInterval()
+        if interval:
+            self._flush_entry = _scheduler.call_every_method(interval,
+                                                             self.flush)
+        else:
+            self._flush_entry = None
+
+    def _config_changed(self, name, value):
+        if name in (None, 'aggregate_interval'):
+            self._schedule_flush()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._counters = dict()
+        self._gauges = dict()
+        self._timers = dict()
+
+
+_aggregators = weakref.WeakSet()
+
+
+def _aggregators_after_fork():
+    # Aggregates collected before the fork belong to the parent, which sends
+    # them
+    for aggregator in list(_aggregators):
+        aggregator._reset()
+
+
+_register_after_fork(_aggregators_after_fork)
 
 
 def initLogger(prefix):
@@ -438,6 +3335,7 @@ def initLogger(prefix):
     return logger
 
 _loggers = dict()
+_loggers_lock = threading.Lock()
 
 
 def getLogger(prefix):
@@ -446,14 +3344,159 @@ def getLogger(prefix):
     has already been created, return it.  Otherwise, return a new one via
     initLogger()
 
+    Existing loggers are returned without locking; creation is serialized,
+    so racing threads always get the same logger.
+
     :param prefix: Prefix to set on MetricsLogger
     """
+    if _CHECK_PID:
+        _check_fork()
+
+    logger = _loggers.get(prefix)
+    if logger is None:
+        with _loggers_lock:
+            logger = _loggers.get(prefix)
+            if logger is None:
+                logger = _loggers[prefix] = initLogger(prefix)
+    return logger
 
-    if prefix not in _loggers:
-        _loggers[prefix] = initLogger(prefix)
 
-    return _loggers[prefix]
+def _loggers_after_fork():
+    global _loggers_lock
+    _loggers_lock = threading.Lock()
+    # Name caches may have been locked by another thread of the parent
+    for logger in list(_all_loggers):
+        logger._name_cache = (None, None)
+
+
+_register_after_fork(_loggers_after_fork)
 
 
 setLoggerClass, getLoggerClass = \
     _global_config.add_config('logger_class', StatsdMetricsLogger)
+
+
+_all_loggers = weakref.WeakSet()
+
+# Metric names internal stats are reported under, by setInternalStatsInterval()
+INTERNAL_STATS_PREFIX = 'metricslogging'
+
+_STATS_NAME_INVALID = re.compile(r'[^A-Za-z0-9_-]')
+
+# Callables returning the counters of transports kept outside _transports,
+# by name, such as the asyncio backend's endpoints
+_transport_stats_sources = []
+
+
+def _register_transport_stats(source):
+    _transport_stats_sources.append(source)
+
+
+def getStats():
+    """
+    Return a snapshot of the library's internal stats:
+
+    * 'loggers': MetricsLogger.getStats() of every logger, by stats_name(),
+      summed over loggers with the same name.  Counted while
+      setInternalStats() is on.
+    * 'transports': counters of every statsd transport, by transport and
+      target: packets_sent, bytes_sent and send_errors (payloads that could
+      not be sent); for UDP, refused (datagrams reported as refused because
+      nothing listened on the port); for TCP, buffered_bytes and dropped;
+      and for the asyncio backend's 'asyncio-udp' endpoints, dropped (lines
+      discarded while the endpoint couldn't send).  Always counted.
+    * 'async': queued and dropped metrics of async delivery.
+    * 'collectors': the number of collectors registered, and the times
+      collectors timed out, raised, or were skipped while still running.
+    """
+    loggers = dict()
+    for logger in list(_all_loggers):
+        stats = logger.getStats()
+        totals = loggers.setdefault(logger.stats_name(), dict.fromkeys(
+            stats, 0))
+        for field, value in six.iteritems(stats):
+            totals[field] += value
+
+    transports = dict()
+    for (name, target), transport in list(_transports.items()):
+        if isinstance(target, tuple):
+            target = '%s:%s' % target
+        transports['%s:%s' % (name, target)] = transport.stats()
+    for source in _transport_stats_sources:
+        transports.update(source())
+
+    return {'loggers': loggers,
+            'transports': transports,
+            'async': {'queued': len(_async_sender._queue),
+                      'dropped': _async_sender.dropped},
+            'collectors': _collectors.stats()}
+
+
+class _StatsReporter(object):
+    """
+    Sends getStats() every setInternalStatsInterval() seconds under
+    INTERNAL_STATS_PREFIX: counts as counters of the change since the last
+    report, and buffered_bytes, queued and registered as gauges.  The
+    reporting logger doesn't count its own metrics.
+    """
+    GAUGES = frozenset(['buffered_bytes', 'queued', 'registered'])
+
+    def __init__(self):
+        self._logger = None
+        self._entry = None
+        self._last = dict()
+
+    def report(self):
+        if self._logger is None:
+            self._logger = initLogger(INTERNAL_STATS_PREFIX)
+            self._logger.setInternalStats(False)
+        logger = self._logger
+
+        stats = getStats()
+        groups = [('loggers', stats['loggers']),
+                  ('transports', stats['transports']),
+                  ('async', {'': stats['async']}),
+                  ('collectors', {'': stats['collectors']})]
+        for group, entries in groups:
+            for entry, values in six.iteritems(entries):
+                entry = _STATS_NAME_INVALID.sub('_', entry)
+                for field, value in six.iteritems(values):
+                    name = [group, entry, field] if entry else [group, field]
+                    if field in self.GAUGES:
+                        logger.gauge(name, value)
+                        continue
+                    key = (group, entry, field)
+                    delta = value - self._last.get(key, 0)
+                    self._last[key] = value
+                    if delta:
+                        logger.counter(name, delta)
+
+    def _config_changed(self, name, value):
+        if name not in (None, 'internal_stats_interval'):
+            return
+        if self._entry is not None:
+            _scheduler.cancel(self._entry)
+            self._entry = None
+        interval = getInternalStatsInterval()
+        if interval:
+            self._entry = _scheduler.call_every(interval, self.report)
+
+
+_stats_reporter = _StatsReporter()
+
+_global_config.subscribe(_stats_reporter._config_changed)
+
+
+def _at_exit():
+    _async_sender.drain(1.0)
+    for aggregator in list(_aggregators):
+        try:
+            aggregator.flush()
+        except socket.error:
+            pass
+    flush()
+    _scheduler.stop(1.0)
+    _worker_pool.stop(1.0)
+
+
+atexit.register(_at_exit)
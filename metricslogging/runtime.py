@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Rackspace Hosting
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Process and runtime metrics: CPU, memory, page faults, context switches,
+threads, file descriptors and garbage collection, read straight from /proc
+where available, so no third party package is needed.  For example:
+
+    from metricslogging import runtime
+
+    runtime.install(getLogger("service"), interval=1.0)
+
+sends gauges such as service.runtime.cpu.percent and
+service.runtime.memory.rss every second.  GcPauseTimer times garbage
+collections.
+"""
+
+import collections
+import gc
+import os
+import re
+import sys
+import threading
+import weakref
+
+from . import metricslogging as _core
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+_PROC_STAT = '/proc/self/stat'
+_PROC_STATUS = '/proc/self/status'
+_PROC_FD = '/proc/self/fd'
+
+# Fields of /proc/self/stat, indexed from the state field that follows the
+# parenthesized command name: field n of proc(5) is at index n - 3
+_STAT_MINFLT = 7
+_STAT_MAJFLT = 9
+_STAT_UTIME = 11
+_STAT_STIME = 12
+_STAT_NUM_THREADS = 17
+_STAT_VSIZE = 20
+_STAT_RSS = 21
+
+# Fields of /proc/self/status, and the metric names they're sent under
+_STATUS_FIELDS = re.compile(
+    br'^(VmHWM|VmSwap|voluntary_ctxt_switches|nonvoluntary_ctxt_switches):'
+    br'\s*(\d+)', re.M)
+_STATUS_NAMES = {
+    b'VmHWM': ('memory', 'rss_peak'),
+    b'VmSwap': ('memory', 'swap'),
+    b'voluntary_ctxt_switches': ('context_switches', 'voluntary'),
+    b'nonvoluntary_ctxt_switches': ('context_switches', 'involuntary'),
+}
+_STATUS_KB = frozenset([b'VmHWM', b'VmSwap'])
+
+# /proc files are a few KB at most
+_READ_SIZE = 16384
+
+
+def _read(path):
+    """Read a /proc file with a single read() call."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, _READ_SIZE)
+    finally:
+        os.close(fd)
+
+
+class RuntimeCollector(object):
+    """
+    Collector of process and runtime metrics, for
+    MetricsLogger.add_collector().  Each collect() reads /proc/self/stat and
+    /proc/self/status once each, lists /proc/self/fd, and calls
+    resource.getrusage() and gc.get_stats(), returning:
+
+    * cpu.user, cpu.system: CPU seconds used since the process started
+    * cpu.percent: CPU used since the previous collect(), in percent of one
+      core; not sent on the first
+    * memory.rss, memory.vms, memory.rss_peak, memory.swap: bytes
+    * page_faults.minor, page_faults.major: since the process started
+    * context_switches.voluntary, context_switches.involuntary: ditto
+    * io.blocks_in, io.blocks_out: filesystem blocks read and written
+    * threads.os: threads of the process; threads.python: Python threads
+    * fds: open file descriptors
+    * gc.genN.collections, gc.genN.collected, gc.genN.uncollectable: per
+      generation, since the process started (Python 3.4+), and gc.genN.count,
+      the allocations counting towards its next collection
+
+    Where /proc isn't available, CPU, peak memory and context switches come
+    from getrusage(), and the other /proc metrics are left out.
+    """
+    def __init__(self):
+        self._proc = os.path.exists(_PROC_STAT)
+        self._clock_ticks = float(os.sysconf('SC_CLK_TCK')) \
+            if self._proc else None
+        self._page_size = resource.getpagesize() if resource else None
+        # ru_maxrss is in kilobytes, except on macOS
+        self._maxrss_scale = 1 if sys.platform == 'darwin' else 1024
+        self._gc_stats = getattr(gc, 'get_stats', None)
+        self._last_cpu = None
+        self._lock = threading.Lock()
+        _runtime_collectors.add(self)
+
+    def collect(self):
+        values = dict()
+        if self._proc:
+            self._collect_stat(values)
+            self._collect_status(values)
+            # listdir() opens /proc/self/fd itself, so the directory's own
+            # fd is in the listing: leave it out
+            values['fds'] = len(os.listdir(_PROC_FD)) - 1
+        if resource is not None:
+            self._collect_rusage(values)
+        values[('threads', 'python')] = threading.active_count()
+        self._collect_gc(values)
+        self._collect_cpu_percent(values)
+        return values
+
+    def _collect_stat(self, values):
+        data = _read(_PROC_STAT)
+        # The command name may itself contain spaces and parentheses
+        fields = data[data.rindex(b')') + 2:].split()
+        values[('page_faults', 'minor')] = int(fields[_STAT_MINFLT])
+        values[('page_faults', 'major')] = int(fields[_STAT_MAJFLT])
+        values[('threads', 'os')] = int(fields[_STAT_NUM_THREADS])
+        values[('memory', 'vms')] = int(fields[_STAT_VSIZE])
+        values[('memory', 'rss')] = int(fields[_STAT_RSS]) * \
+            (self._page_size or 4096)
+        if resource is None:
+            values[('cpu', 'user')] = \
+                int(fields[_STAT_UTIME]) / self._clock_ticks
+            values[('cpu', 'system')] = \
+                int(fields[_STAT_STIME]) / self._clock_ticks
+
+    def _collect_status(self, values):
+        for field, value in _STATUS_FIELDS.findall(_read(_PROC_STATUS)):
+            value = int(value)
+            if field in _STATUS_KB:
+                value *= 1024
+            values[_STATUS_NAMES[field]] = value
+
+    def _collect_rusage(self, values):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        values[('cpu', 'user')] = usage.ru_utime
+        values[('cpu', 'system')] = usage.ru_stime
+        values[('io', 'blocks_in')] = usage.ru_inblock
+        values[('io', 'blocks_out')] = usage.ru_oublock
+        if not self._proc:
+            values[('memory', 'rss_peak')] = \
+                usage.ru_maxrss * self._maxrss_scale
+            values[('context_switches', 'voluntary')] = usage.ru_nvcsw
+            values[('context_switches', 'involuntary')] = usage.ru_nivcsw
+
+    def _collect_gc(self, values):
+        for generation, count in enumerate(gc.get_count()):
+            values[('gc', 'gen%d' % generation, 'count')] = count
+        if self._gc_stats is not None:
+            for generation, stats in enumerate(self._gc_stats()):
+                gen = 'gen%d' % generation
+                values[('gc', gen, 'collections')] = stats['collections']
+                values[('gc', gen, 'collected')] = stats['collected']
+                values[('gc', gen, 'uncollectable')] = stats['uncollectable']
+
+    def _collect_cpu_percent(self, values):
+        cpu = values.get(('cpu', 'user'))
+        if cpu is None:
+            return
+        cpu += values[('cpu', 'system')]
+        now = _core._monotonic()
+        if _core._CHECK_PID:
+            _core._check_fork()
+        with self._lock:
+            last, self._last_cpu = self._last_cpu, (now, cpu)
+        if last is not None and now > last[0]:
+            values[('cpu', 'percent')] = \
+                (cpu - last[1]) / (now - last[0]) * 100.0
+
+
+_runtime_collectors = weakref.WeakSet()
+
+
+def _runtime_collectors_after_fork():
+    for collector in list(_runtime_collectors):
+        collector._lock = threading.Lock()
+
+
+_core._register_after_fork(_runtime_collectors_after_fork)
+
+
+def install(logger, interval=10.0, name='runtime', timeout=None, tags=None):
+    """
+    Send the metrics of a RuntimeCollector through logger every interval
+    seconds, under name.
+
+    :param logger: MetricsLogger to send the metrics through
+    :param interval: Seconds between collections
+    :param name: Prefix of the metric names, or None for none
+    :param timeout: As for MetricsLogger.add_collector()
+    :param tags: Tags sent with each metric
+    :returns: CollectorRegistration, whose remove() method stops collecting
+    """
+    return logger.add_collector(name, RuntimeCollector(), interval,
+                                timeout=timeout, tags=tags)
+
+
+class GcPauseTimer(object):
+    """
+    Times every garbage collection through a gc.callbacks hook, and sends
+    the pause as a timer, in milliseconds, named name.genN after the
+    generation collected.  For example:
+
+        gc_timer = runtime.GcPauseTimer(getLogger("service"))
+        gc_timer.install()
+        ...
+        gc_timer.uninstall()
+
+    A collection can start in any allocation, including one made by an emit
+    path holding a lock, so the hook never sends: it only appends the pause
+    to a bounded queue, which the shared scheduler thread drains every
+    flush_interval seconds through TimerHandles, so the pauses are
+    aggregated and batched like any other timer.  The hook costs two clock
+    reads and a deque append per collection, at most once per
+    gc.get_threshold()[0] allocations; pauses beyond MAX_PENDING waiting to
+    be sent are dropped, and counted in dropped.  Leave frequent generation
+    0 collections out with generations=(1, 2) to bound the cost further.
+    Requires Python 3.3+.
+    """
+    MAX_PENDING = 10000
+
+    def __init__(self, logger, name=('gc', 'pause'), generations=None,
+                 tags=None, flush_interval=1.0):
+        """
+        :param logger: MetricsLogger to send the timers through
+        :param name: Metric name prefix
+        :param generations: Generations to time, or None for all
+        :param tags: Tags sent with each timer
+        :param flush_interval: Seconds between sends of the queued pauses
+        """
+        prefix = _core._to_list(name)
+        self._handles = [
+            logger.timer_handle(prefix + ['gen%d' % generation], tags=tags)
+            if generations is None or generation in generations else None
+            for generation in range(len(gc.get_count()))]
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._pending = collections.deque()
+        self._start_ns = None
+        self._entry = None
+
+    @property
+    def installed(self):
+        return self._callback in getattr(gc, 'callbacks', ())
+
+    def install(self):
+        """Start timing collections.  Does nothing if already installed."""
+        if not hasattr(gc, 'callbacks'):
+            raise RuntimeError("GcPauseTimer requires gc.callbacks, added "
+                               "in Python 3.3")
+        if not self.installed:
+            self._entry = _core._scheduler.call_every(self.flush_interval,
+                                                      self.flush)
+            gc.callbacks.append(self._callback)
+
+    def uninstall(self):
+        """Stop timing collections, and send the pauses still queued."""
+        if self.installed:
+            gc.callbacks.remove(self._callback)
+            _core._scheduler.cancel(self._entry)
+            self._entry = None
+            self.flush()
+
+    def flush(self):
+        """Send the queued pauses.  Never called from the hook."""
+        pending = self._pending
+        handles = self._handles
+        while True:
+            try:
+                generation, duration_ns = pending.popleft()
+            except IndexError:
+                return
+            handles[generation].record(duration_ns / 1000000.0)
+
+    def _callback(self, phase, info):
+        # Runs inside whatever allocation triggered the collection: must not
+        # take locks or send
+        if phase == 'start':
+            self._start_ns = _core._time_ns()
+            return
+        start_ns, self._start_ns = self._start_ns, None
+        if start_ns is None:
+            # Installed during a collection
+            return
+        generation = info['generation']
+        if self._handles[generation] is None:
+            return
+        if len(self._pending) >= self.MAX_PENDING:
+            self.dropped += 1
+            return
+        self._pending.append((generation, _core._time_ns() - start_ns))
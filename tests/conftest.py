@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+import sys
+
+# asyncio support, and its tests, need Python 3.7+
+collect_ignore = []
+if sys.version_info < (3, 7):
+    collect_ignore.append("test_aio.py")
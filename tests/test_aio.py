@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Rackspace
+# All Rights Reserved
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import asyncio
+import gc
+import metricslogging
+import metricslogging.aio
+import mock
+import socket
+import time
+import unittest
+import warnings
+
+
+class TestAsyncioStatsdMetricsLogger(unittest.TestCase):
+    def setUp(self):
+        super(TestAsyncioStatsdMetricsLogger, self).setUp()
+        self.sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sink.bind(("127.0.0.1", 0))
+        self.sink.settimeout(5)
+        self.addCleanup(self.sink.close)
+
+        self.ml = metricslogging.aio.AsyncioStatsdMetricsLogger()
+        metricslogging.setGlobalPrefix("")
+        self.ml.setPrefix("aio")
+        self.ml.setPrependHost(False)
+        self.ml.setStatsdHost("127.0.0.1")
+        self.ml.setStatsdPort(self.sink.getsockname()[1])
+
+    def test_lines_batched_per_loop_iteration(self):
+        async def emit():
+            with mock.patch.object(metricslogging.metricslogging
+                                   ._DatagramTransport, "send") as mock_send:
+                for i in range(3):
+                    self.ml.counter("metric", i)
+                await asyncio.sleep(0.05)
+            self.assertFalse(mock_send.called)
+
+        asyncio.run(emit())
+        self.assertEqual(self.sink.recv(4096),
+                         b"aio.metric:0|c\naio.metric:1|c\naio.metric:2|c")
+
+    def test_packet_size(self):
+        self.ml.setStatsdPacketSize(32)
+
+        async def emit():
+            for i in range(3):
+                self.ml.gauge("metric", i)
+            await asyncio.sleep(0.05)
+
+        asyncio.run(emit())
+        self.assertEqual(self.sink.recv(4096),
+                         b"aio.metric:0|g\naio.metric:1|g")
+        self.assertEqual(self.sink.recv(4096), b"aio.metric:2|g")
+
+    def test_stats(self):
+        key = "asyncio-udp:127.0.0.1:%d" % self.sink.getsockname()[1]
+
+        def totals():
+            # Endpoints of earlier tests' loops may still be alive
+            return metricslogging.getStats()["transports"].get(
+                key, {"packets_sent": 0, "bytes_sent": 0, "send_errors": 0,
+                      "dropped": 0})
+
+        async def emit():
+            before = totals()
+            self.ml.gauge("metric", 1)
+            await asyncio.sleep(0.05)
+            after = totals()
+            return dict((field, after[field] - before[field])
+                        for field in after)
+
+        self.assertEqual(asyncio.run(emit()),
+                         {"packets_sent": 1, "bytes_sent": 14,
+                          "send_errors": 0, "dropped": 0})
+
+    def test_dropped_lines_counted(self):
+        async def emit():
+            endpoint = metricslogging.aio._DatagramEndpoint(
+                asyncio.get_running_loop(), ("127.0.0.1", 1))
+            endpoint.MAX_PENDING_LINES = 2
+            with mock.patch.object(
+                    asyncio.get_running_loop(), "create_datagram_endpoint",
+                    side_effect=OSError("unreachable")):
+                for i in range(3):
+                    endpoint.write(b"metric:%d|g" % i, 1432)
+                await asyncio.sleep(0.05)
+            return endpoint.stats()
+
+        self.assertEqual(asyncio.run(emit()),
+                         {"packets_sent": 0, "bytes_sent": 0,
+                          "send_errors": 1, "dropped": 3})
+
+    def test_endpoints_closed_with_loop(self):
+        async def emit(i):
+            self.ml.gauge("metric", i)
+            await asyncio.sleep(0)
+            return metricslogging.aio._endpoints[asyncio.get_running_loop()]
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always", ResourceWarning)
+            for i in range(5):
+                endpoints = asyncio.run(emit(i))
+                self.assertEqual(len(metricslogging.aio._endpoints), 0)
+                self.assertEqual(endpoints, {})
+            gc.collect()
+        self.assertEqual(caught, [])
+        for i in range(5):
+            self.assertEqual(self.sink.recv(4096), b"aio.metric:%d|g" % i)
+
+    def test_closed_loop_forgotten(self):
+        key = "asyncio-udp:127.0.0.1:%d" % self.sink.getsockname()[1]
+
+        async def emit():
+            with mock.patch.object(
+                    asyncio.get_running_loop(), "create_datagram_endpoint",
+                    side_effect=OSError("unreachable")):
+                self.ml.gauge("metric", 1)
+                await asyncio.sleep(0.05)
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        loop.run_until_complete(emit())
+        errors = metricslogging.getStats()["transports"][key]["send_errors"]
+        self.assertTrue(loop in metricslogging.aio._endpoints)
+
+        # Closed without loop.shutdown_asyncgens()
+        loop.close()
+        stats = metricslogging.getStats()["transports"][key]
+        self.assertFalse(loop in metricslogging.aio._endpoints)
+        self.assertEqual(stats["send_errors"], errors)
+
+    def test_outside_loop_sends_directly(self):
+        self.ml.timer("metric", 2)
+        self.assertEqual(self.sink.recv(4096), b"aio.metric:2|ms")
+
+
+class RecordingLogger(metricslogging.NoopMetricsLogger):
+    def __init__(self):
+        super(RecordingLogger, self).__init__()
+        self.timer = mock.Mock()
+        self.counter_emits = []
+
+    def _emit(self, kind, name, value, sample_rate=None):
+        self.counter_emits.append((kind, name, value, sample_rate))
+
+
+class TestAsyncContextDecorators(unittest.TestCase):
+    def setUp(self):
+        super(TestAsyncContextDecorators, self).setUp()
+        self.ml = RecordingLogger()
+
+    @mock.patch("metricslogging.metricslogging._time_ns")
+    def test_timer_acd_as_decorator(self, mock_time):
+        mock_time.side_effect = [1 * 10 ** 9, 43 * 10 ** 9]
+
+        @self.ml.timer_acd("metric")
+        async def func(x):
+            await asyncio.sleep(0)
+            return x * x
+
+        self.assertEqual(asyncio.run(func(10)), 100)
+        self.ml.timer.assert_called_once_with("metric", 42 * 1000)
+
+    @mock.patch("metricslogging.metricslogging._time_ns")
+    def test_timer_acd_as_context(self, mock_time):
+        mock_time.side_effect = [1 * 10 ** 9, 43 * 10 ** 9]
+
+        async def func():
+            async with self.ml.timer_acd("metric"):
+                await asyncio.sleep(0)
+
+        asyncio.run(func())
+        self.ml.timer.assert_called_once_with("metric", 42 * 1000)
+
+    def test_timer_acd_shared_between_tasks(self):
+        timed = self.ml.timer_acd("metric")
+
+        async def task(delay):
+            async with timed:
+                await asyncio.sleep(delay)
+
+        async def main():
+            await asyncio.gather(task(0.05), task(0.01))
+
+        asyncio.run(main())
+        durations = sorted(c[0][1] for c in self.ml.timer.call_args_list)
+        self.assertTrue(10 <= durations[0] < 50)
+        self.assertTrue(durations[1] >= 50)
+
+    def test_counter_acd(self):
+        @self.ml.counter_acd("metric")
+        async def func():
+            async with self.ml.counter_acd("block", sample_rate=1.0):
+                pass
+
+        asyncio.run(func())
+        self.assertEqual(self.ml.counter_emits,
+                         [("counter", "metric", 1, None),
+                          ("counter", "block", 1, 1.0)])
+
+    @mock.patch("metricslogging.metricslogging._time_ns")
+    def test_tags(self, mock_time):
+        mock_time.side_effect = [1 * 10 ** 9, 43 * 10 ** 9]
+
+        @self.ml.timer_acd("metric", tags={"op": "get"})
+        async def func():
+            await asyncio.sleep(0)
+
+        asyncio.run(func())
+        self.ml.timer.assert_called_once_with(
+            "metric", 42 * 1000, tags=metricslogging.getTagSet({"op": "get"}))
+
+    def test_decorating_plain_function_rejected(self):
+        self.assertRaises(TypeError, self.ml.timer_acd("metric"), lambda: 1)
+
+
+class TestSyncContextDecoratorsOnCoroutines(unittest.TestCase):
+    def setUp(self):
+        super(TestSyncContextDecoratorsOnCoroutines, self).setUp()
+        self.ml = RecordingLogger()
+        self.ml.gauge = mock.Mock()
+
+    @mock.patch("metricslogging.metricslogging._time_ns")
+    def test_timer_cd_times_awaited_execution(self, mock_time):
+        mock_time.side_effect = [1 * 10 ** 9, 43 * 10 ** 9]
+
+        @self.ml.timer_cd("metric")
+        async def func(x):
+            return x * x
+
+        coro = func(10)
+        self.assertFalse(mock_time.called)
+        self.assertEqual(asyncio.run(coro), 100)
+        self.ml.timer.assert_called_once_with("metric", 42 * 1000)
+
+    def test_timer_cd_concurrent_tasks(self):
+        @self.ml.timer_cd("metric")
+        async def func(delay):
+            await asyncio.sleep(delay)
+
+        async def main():
+            await asyncio.gather(*[func(i * 0.01) for i in range(20)])
+
+        asyncio.run(main())
+        durations = sorted(c[0][1] for c in self.ml.timer.call_args_list)
+        self.assertEqual(len(durations), 20)
+        for i, duration in enumerate(durations):
+            self.assertTrue(duration >= i * 10 * 0.9)
+        self.assertTrue(durations[-1] < 1000)
+
+    @mock.patch("metricslogging.metricslogging._time_ns")
+    def test_timer_cd_async_generator(self, mock_time):
+        mock_time.side_effect = [1 * 10 ** 9, 3 * 10 ** 9]
+
+        @self.ml.timer_cd("metric")
+        async def gen():
+            yield 1
+            yield 2
+
+        async def main():
+            return [value async for value in gen()]
+
+        self.assertEqual(asyncio.run(main()), [1, 2])
+        self.ml.timer.assert_called_once_with("metric", 2 * 1000)
+
+    def test_async_generator_asend_and_athrow(self):
+        received = []
+
+        @self.ml.timer_cd("metric")
+        async def gen():
+            while True:
+                try:
+                    received.append((yield len(received)))
+                except ValueError as e:
+                    received.append(e.args[0])
+
+        async def main():
+            agen = gen()
+            results = [await agen.asend(None), await agen.asend("hi"),
+                       await agen.athrow(ValueError("thrown")),
+                       await agen.asend("bye")]
+            await agen.aclose()
+            return results
+
+        self.assertEqual(asyncio.run(main()), [0, 1, 2, 3])
+        self.assertEqual(received, ["hi", "thrown", "bye"])
+        self.assertEqual(self.ml.timer.call_count, 1)
+
+    def test_async_generator_aclose(self):
+        closed = []
+
+        @self.ml.counter_cd("metric")
+        async def gen():
+            try:
+                yield 1
+                yield 2
+            finally:
+                closed.append(True)
+
+        async def main():
+            agen = gen()
+            value = await agen.__anext__()
+            await agen.aclose()
+            # Closed by aclose(), not later by the loop's finalizer
+            self.assertEqual(closed, [True])
+            return value
+
+        self.assertEqual(asyncio.run(main()), 1)
+        self.assertEqual(self.ml.counter_emits,
+                         [("counter", "metric", 1, None)])
+
+    def test_async_generator_uncaught_athrow(self):
+        @self.ml.timer_cd("metric")
+        async def gen():
+            yield 1
+
+        async def main():
+            agen = gen()
+            await agen.__anext__()
+            await agen.athrow(KeyError("raised"))
+
+        self.assertRaises(KeyError, asyncio.run, main())
+        self.assertEqual(self.ml.timer.call_count, 1)
+
+    def test_counter_cd_counts_on_execution(self):
+        @self.ml.counter_cd("metric")
+        async def func():
+            return 1
+
+        coro = func()
+        self.assertEqual(self.ml.counter_emits, [])
+        asyncio.run(coro)
+        self.assertEqual(self.ml.counter_emits,
+                         [("counter", "metric", 1, None)])
+
+    def test_return_val_gauge_d_awaits_result(self):
+        @self.ml.return_val_gauge_d("metric")
+        async def func():
+            await asyncio.sleep(0)
+            return 42
+
+        self.assertEqual(asyncio.run(func()), 42)
+        self.ml.gauge.assert_called_once_with("metric", 42)
+
+    def test_return_val_gauge_d_async_generator(self):
+        @self.ml.return_val_gauge_d("metric")
+        async def gen():
+            yield 1
+            yield 2
+
+        async def main():
+            return [value async for value in gen()]
+
+        self.assertEqual(asyncio.run(main()), [1, 2])
+        self.assertEqual(self.ml.gauge.call_args_list,
+                         [mock.call("metric", 1), mock.call("metric", 2)])
+
+
+class TestLoopLagMonitor(unittest.TestCase):
+    def setUp(self):
+        super(TestLoopLagMonitor, self).setUp()
+        self.ml = mock.Mock()
+        self.handle = self.ml.timer_handle.return_value
+        self.monitor = metricslogging.aio.LoopLagMonitor(
+            self.ml, interval=0.01, tags={"loop": "main"})
+
+    def test_measures_blocked_loop(self):
+        async def main():
+            self.monitor.install()
+            self.monitor.install()
+            self.assertTrue(self.monitor.installed)
+            time.sleep(0.1)
+            await asyncio.sleep(0.05)
+            self.monitor.uninstall()
+            calls = self.handle.record.call_count
+            await asyncio.sleep(0.05)
+            self.assertEqual(self.handle.record.call_count, calls)
+            self.assertFalse(self.monitor.installed)
+
+        asyncio.run(main())
+        self.ml.timer_handle.assert_called_once_with(
+            ("loop", "lag"), tags={"loop": "main"})
+        lags = [c[0][0] for c in self.handle.record.call_args_list]
+        self.assertTrue(lags[0] >= 80, lags)
+        self.assertTrue(all(lag >= 0 for lag in lags))
+
+    def test_invalid_interval(self):
+        self.assertRaises(ValueError, metricslogging.aio.LoopLagMonitor,
+                          self.ml, interval=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -16,9 +16,18 @@
 #    under the License.
 
 
+import array
+import errno
 import metricslogging
 import mock
+import os
+import shutil
+import signal
+import six
 import socket
+import tempfile
+import threading
+import time
 import unittest
 
 
@@ -41,6 +50,36 @@ class TestNestedConfig(unittest.TestCase):
     def test_add_config(self):
         pass
 
+    def test_version_propagates_to_child(self):
+        parent_version = self.parent_config.version
+        child_version = self.child_config.version
+
+        self.parentSetConfigDefault("changed")
+        self.assertTrue(self.parent_config.version > parent_version)
+        self.assertTrue(self.child_config.version > child_version)
+
+    def test_version_not_propagated_to_overriding_child(self):
+        self.childSetConfig("child")
+        child_version = self.child_config.version
+
+        self.parentSetConfig("parent")
+        self.assertEqual(self.child_config.version, child_version)
+        self.assertEqual(self.childGetConfig(), "child")
+
+    def test_subscribe(self):
+        callback = mock.Mock()
+        self.child_config.subscribe(callback)
+
+        self.parentSetConfigDefault("changed")
+        callback.assert_called_once_with("configdefault", "changed")
+
+        self.child_config.reset_config()
+        callback.assert_called_with(None, None)
+
+        self.child_config.unsubscribe(callback)
+        self.parentSetConfigDefault("changed again")
+        self.assertEqual(callback.call_count, 2)
+
 
 class MockedMetricsLogger(metricslogging.MetricsLogger):
     _format_name = mock.Mock(return_value="mocked_format_name")
@@ -55,10 +94,10 @@ class TestTimerContextDecorator(unittest.TestCase):
 
         self.ml = MockedMetricsLogger()
 
-    @mock.patch("metricslogging.metricslogging._time")
+    @mock.patch("metricslogging.metricslogging._time_ns")
     @mock.patch("metricslogging.metricslogging.MetricsLogger.timer")
     def test_timer_cd_as_decorator(self, mock_timer, mock_time):
-        mock_time.side_effect = [1, 43]
+        mock_time.side_effect = [1 * 10 ** 9, 43 * 10 ** 9]
 
         @self.ml.timer_cd("metric")
         def func(x):
@@ -67,54 +106,142 @@ class TestTimerContextDecorator(unittest.TestCase):
         func(10)
         mock_timer.assert_called_once_with("metric", 42*1000)
 
-    @mock.patch("metricslogging.metricslogging._time")
+    @mock.patch("metricslogging.metricslogging._time_ns")
     @mock.patch("metricslogging.metricslogging.MetricsLogger.timer")
     def test_timer_cd_as_context(self, mock_timer, mock_time):
-        mock_time.side_effect = [1, 43]
+        mock_time.side_effect = [1 * 10 ** 9, 43 * 10 ** 9]
 
         with self.ml.timer_cd("metric") as _:
             pass
 
         mock_timer.assert_called_once_with("metric", 42*1000)
 
+    @mock.patch("metricslogging.metricslogging.MetricsLogger.timer")
+    def test_timer_cd_as_decorator_concurrent_threads(self, mock_timer):
+        @self.ml.timer_cd("metric")
+        def func(delay):
+            time.sleep(delay)
+
+        threads = [threading.Thread(target=func, args=(0.05 * i,))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        durations = sorted(c[0][1] for c in mock_timer.call_args_list)
+        for i, duration in enumerate(durations):
+            self.assertTrue(50 * i <= duration < 50 * i + 45)
+
+    @mock.patch("metricslogging.metricslogging._time_ns")
+    @mock.patch("metricslogging.metricslogging.MetricsLogger.timer")
+    def test_timer_cd_sub_millisecond(self, mock_timer, mock_time):
+        mock_time.side_effect = [10 ** 9, 10 ** 9 + 1500]
+
+        with self.ml.timer_cd("metric") as _:
+            pass
+
+        mock_timer.assert_called_once_with("metric", 0.0015)
+
+    @mock.patch("metricslogging.metricslogging.MetricsLogger.timer")
+    def test_set_timer_clock(self, mock_timer):
+        metricslogging.setTimerClock(mock.Mock(side_effect=[100, 2100]))
+        self.addCleanup(metricslogging.setTimerClock,
+                        metricslogging.metricslogging._default_clock_ns)
+
+        with self.ml.timer_cd("metric") as _:
+            pass
+
+        mock_timer.assert_called_once_with("metric", 0.002)
+
+    def test_default_clock_monotonic(self):
+        first = metricslogging.metricslogging._time_ns()
+        second = metricslogging.metricslogging._time_ns()
+        self.assertTrue(isinstance(first, six.integer_types))
+        self.assertTrue(second >= first)
+
 
 class TestCounterContextDecorator(unittest.TestCase):
     def setUp(self):
         super(TestCounterContextDecorator, self).setUp()
 
         self.ml = MockedMetricsLogger()
+        self.ml._random = mock.Mock()
+        self.ml._random.random.return_value = 0.25
 
-    @mock.patch("metricslogging.metricslogging.MetricsLogger.counter")
-    def test_counter_cd_as_decorator(self, mock_counter):
+    @mock.patch("metricslogging.metricslogging.MetricsLogger._emit")
+    def test_counter_cd_as_decorator(self, mock_emit):
         @self.ml.counter_cd("metric")
         def func(x):
             return x * x
 
         func(10)
-        mock_counter.assert_called_once_with("metric", 1, sample_rate=None)
+        mock_emit.assert_called_once_with("counter", "metric", 1, None)
 
-    @mock.patch("metricslogging.metricslogging.MetricsLogger.counter")
-    def test_counter_cd_as_decorator_sample_rate(self, mock_counter):
+    @mock.patch("metricslogging.metricslogging.MetricsLogger._emit")
+    def test_counter_cd_as_decorator_sample_rate(self, mock_emit):
         @self.ml.counter_cd("metric", 0.5)
         def func(x):
             return x * x
 
         func(10)
-        mock_counter.assert_called_once_with("metric", 1, sample_rate=0.5)
+        mock_emit.assert_called_once_with("counter", "metric", 1, 0.5)
+
+        mock_emit.reset_mock()
+        self.ml._random.random.return_value = 0.75
+        func(10)
+        self.assertFalse(mock_emit.called)
 
-    @mock.patch("metricslogging.metricslogging.MetricsLogger.counter")
-    def test_counter_cd_as_context(self, mock_counter):
+    @mock.patch("metricslogging.metricslogging.MetricsLogger._emit")
+    def test_counter_cd_as_context(self, mock_emit):
         with self.ml.counter_cd("metric") as _:
             pass
 
-        mock_counter.assert_called_once_with("metric", 1, sample_rate=None)
+        mock_emit.assert_called_once_with("counter", "metric", 1, None)
 
-    @mock.patch("metricslogging.metricslogging.MetricsLogger.counter")
-    def test_counter_cd_as_context_sample_rate(self, mock_counter):
+    @mock.patch("metricslogging.metricslogging.MetricsLogger._emit")
+    def test_counter_cd_as_context_sample_rate(self, mock_emit):
         with self.ml.counter_cd("metric", sample_rate=0.5) as _:
             pass
 
-        mock_counter.assert_called_once_with("metric", 1, sample_rate=0.5)
+        mock_emit.assert_called_once_with("counter", "metric", 1, 0.5)
+
+    @mock.patch("metricslogging.metricslogging.MetricsLogger._emit")
+    def test_counter_cd_deterministic(self, mock_emit):
+        counted = self.ml.counter_cd("metric", 0.25, deterministic=True)
+        for _ in range(10):
+            with counted:
+                pass
+
+        self.assertEqual(mock_emit.call_count, 2)
+
+    def test_counter_cd_validates_sample_rate(self):
+        self.assertRaises(ValueError, self.ml.counter_cd, "metric", 1.5)
+        self.assertRaises(ValueError, self.ml.counter_cd, "metric", -0.1,
+                          deterministic=True)
+
+
+class TestSamplers(unittest.TestCase):
+    def test_random_sampler(self):
+        rng = mock.Mock()
+        rng.random.side_effect = [0.1, 0.3, 0.2]
+        sampler = metricslogging.RandomSampler(0.25, rng)
+        self.assertEqual([sampler(), sampler(), sampler()],
+                         [True, False, True])
+
+    def test_every_nth_sampler_exact_rate(self):
+        for rate, calls, expected in [(0.25, 100, 25), (0.3, 100, 30),
+                                      (1.0, 10, 10), (0.0, 10, 0)]:
+            sampler = metricslogging.EveryNthSampler(rate)
+            self.assertEqual(sum(sampler() for _ in range(calls)), expected)
+
+    def test_every_nth_sampler_spread(self):
+        sampler = metricslogging.EveryNthSampler(0.5)
+        self.assertEqual([sampler() for _ in range(4)],
+                         [False, True, False, True])
+
+    def test_sampler_rate_none(self):
+        self.assertEqual(MockedMetricsLogger().sampler(None), None)
 
 
 class TestMetricsLogger(unittest.TestCase):
@@ -158,6 +285,42 @@ class TestMetricsLogger(unittest.TestCase):
         self.ml._format_name.assert_called_once_with(
             "globalprefix", [], "testprefix", "metric")
 
+    def test_format_name_cached(self):
+        self.ml._format_name.reset_mock()
+
+        self.ml.format_name("metric")
+        self.ml.format_name("metric")
+        self.ml.format_name(["list", "metric"])
+        self.ml.format_name(["list", "metric"])
+        self.assertEqual(self.ml._format_name.call_count, 2)
+
+    def test_format_name_cache_invalidated_by_config(self):
+        setters = [
+            lambda: self.ml.setPrefix("otherprefix"),
+            lambda: self.ml.setHost("other.example.com"),
+            lambda: self.ml.setPrependHost(False),
+            lambda: metricslogging.setGlobalPrefix("otherglobal"),
+            lambda: metricslogging.setStatsdDelimiter("_"),
+        ]
+        for setter in setters:
+            self.ml.format_name("metric")
+            self.ml._format_name.reset_mock()
+            setter()
+            self.ml.format_name("metric")
+            self.assertEqual(self.ml._format_name.call_count, 1)
+
+    def test_format_name_cache_bounded(self):
+        metricslogging.setNameCacheSize(2)
+        self.addCleanup(metricslogging.setNameCacheSize, 1000)
+        self.ml._format_name.reset_mock()
+
+        for name in ["a", "b", "a", "c", "a", "b"]:
+            self.ml.format_name(name)
+        self.assertEqual(len(self.ml._name_cache), 2)
+        self.assertEqual(
+            [c[0][3] for c in self.ml._format_name.call_args_list],
+            ["a", "b", "c", "b"])
+
     def test_gauge(self):
         self.ml.gauge("metric", 10)
         self.ml._gauge.assert_called_once_with("mocked_format_name", 10)
@@ -202,11 +365,16 @@ class TestMetricsLogger(unittest.TestCase):
 class TestStatsdMetricsLogger(unittest.TestCase):
     def setUp(self):
         super(TestStatsdMetricsLogger, self).setUp()
+        metricslogging.metricslogging._socket_pool.reset()
         self.ml = metricslogging.StatsdMetricsLogger()
         self.ml.setStatsdDelimiter(".")
         self.ml.setStatsdHost("testhost")
         self.ml.setStatsdPort(4321)
 
+    def tearDown(self):
+        super(TestStatsdMetricsLogger, self).tearDown()
+        metricslogging.metricslogging._socket_pool.reset()
+
     def test__format_name(self):
         self.assertEqual(
             self.ml._format_name("globalprefix", "testhost",
@@ -293,31 +461,23 @@ class TestStatsdMetricsLogger(unittest.TestCase):
         mock_socket_constructor.return_value = mock_socket
 
         self.ml._send("metric", 2, "type")
-        mock_socket.sendto.assert_called_once_with(
-            "metric:2|type",
-            ("testhost", 4321))
-        mock_socket.close.assert_called()
+        mock_socket.connect.assert_called_once_with(("testhost", 4321))
+        mock_socket.send.assert_called_once_with(b"metric:2|type")
         mock_socket.reset_mock()
 
         self.ml._send("metric", 3.14159, "type")
-        mock_socket.sendto.assert_called_once_with(
-            "metric:3.14159|type",
-            ("testhost", 4321))
-        mock_socket.close.assert_called()
+        mock_socket.send.assert_called_once_with(b"metric:3.14159|type")
         mock_socket.reset_mock()
 
         self.ml._send("metric", 5, "type")
-        mock_socket.sendto.assert_called_once_with(
-            "metric:5|type",
-            ("testhost", 4321))
-        mock_socket.close.assert_called()
+        mock_socket.send.assert_called_once_with(b"metric:5|type")
         mock_socket.reset_mock()
 
         self.ml._send("metric", 5, "type", sample_rate=0.5)
-        mock_socket.sendto.assert_called_once_with(
-            "metric:5|type@0.5",
-            ("testhost", 4321))
-        mock_socket.close.assert_called()
+        mock_socket.send.assert_called_once_with(b"metric:5|type@0.5")
+
+        self.assertFalse(mock_socket.connect.called)
+        self.assertFalse(mock_socket.close.called)
 
     @mock.patch("socket.socket")
     def test__send_prohibited_chars(self, mock_socket_constructor):
@@ -325,14 +485,1519 @@ class TestStatsdMetricsLogger(unittest.TestCase):
         mock_socket_constructor.return_value = mock_socket
 
         self.ml._send("m|e@t:r\nic", 2, "type")
-        mock_socket.sendto.assert_called_once_with(
-            "m-e-t-r-ic:2|type",
-            ("testhost", 4321))
+        mock_socket.send.assert_called_once_with(b"m-e-t-r-ic:2|type")
+
+    def test__sanitize(self):
+        sanitize = self.ml._sanitize
+        self.assertEqual(sanitize("m|e@t:r\nic"), "m-e-t-r-ic")
+        self.assertEqual(sanitize(u"m|e\u00e9"), sanitize(b"m|e\xc3\xa9"))
+        self.assertEqual(sanitize(u"metric"), "metric")
+        self.assertEqual(sanitize(b"metric"), "metric")
+        self.assertEqual(sanitize(42), "42")
+        self.assertEqual(sanitize(2.5), "2.5")
+        self.assertEqual(sanitize(True), "True")
+        self.assertEqual(sanitize(None), "None")
+
+    def test__sanitize_remembers_clean_strings(self):
+        self.ml._clean_strings.clear()
+        self.ml._sanitize("clean.metric")
+        self.ml._sanitize("dirty|metric")
+        self.assertEqual(self.ml._clean_strings, set(["clean.metric"]))
+
+    @mock.patch("socket.socket")
+    def test__send_shares_socket_per_target(self, mock_socket_constructor):
+        mock_socket_constructor.side_effect = lambda *a: mock.Mock()
+
+        other = metricslogging.StatsdMetricsLogger()
+        other.setStatsdHost("testhost")
+        other.setStatsdPort(4321)
+
+        self.ml._send("metric", 1, "type")
+        other._send("metric", 2, "type")
+        self.assertEqual(mock_socket_constructor.call_count, 1)
+
+        other.setStatsdPort(1234)
+        other._send("metric", 3, "type")
+        self.assertEqual(mock_socket_constructor.call_count, 2)
+
+    @mock.patch("socket.socket")
+    def test__send_recreates_socket_after_error(self,
+                                                mock_socket_constructor):
+        bad_socket = mock.Mock()
+        bad_socket.send.side_effect = socket.error("refused")
+        good_socket = mock.Mock()
+        mock_socket_constructor.side_effect = [bad_socket, good_socket]
+
+        self.ml._send("metric", 2, "type")
+        bad_socket.close.assert_called_once_with()
+        good_socket.connect.assert_called_once_with(("testhost", 4321))
+        good_socket.send.assert_called_once_with(b"metric:2|type")
+
+    @mock.patch("socket.socket")
+    def test__send_raises_after_retry(self, mock_socket_constructor):
+        mock_socket = mock.Mock()
+        mock_socket.send.side_effect = socket.error("refused")
+        mock_socket_constructor.return_value = mock_socket
+
+        self.assertRaises(socket.error, self.ml._send, "metric", 2, "type")
+        self.assertEqual(mock_socket.send.call_count, 2)
+
+    @mock.patch("socket.socket")
+    def test__send_keeps_socket_when_refused(self, mock_socket_constructor):
+        mock_socket = mock.Mock()
+        mock_socket.send.side_effect = [
+            socket.error(errno.ECONNREFUSED, "refused"), 14]
+        mock_socket_constructor.return_value = mock_socket
+
+        with mock.patch.object(metricslogging.metricslogging._resolver,
+                               "refresh_soon") as mock_refresh_soon:
+            self.ml._send("metric", 2, "type")
+        self.assertEqual(mock_socket.send.call_args_list,
+                         [mock.call(b"metric:2|type")] * 2)
+        self.assertFalse(mock_socket.close.called)
+        self.assertFalse(mock_refresh_soon.called)
+        self.assertEqual(mock_socket_constructor.call_count, 1)
+
+    def test__send_to_closed_port_uses_one_socket(self):
+        closed = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        closed.bind(("127.0.0.1", 0))
+        port = closed.getsockname()[1]
+        closed.close()
+        self.ml.setStatsdHost("127.0.0.1")
+        self.ml.setStatsdPort(port)
+
+        real_socket = socket.socket
+        with mock.patch("socket.socket",
+                        side_effect=real_socket) as mock_socket_constructor:
+            for i in range(100):
+                try:
+                    self.ml.gauge("metric", i)
+                except socket.error:
+                    pass
+        self.assertEqual(mock_socket_constructor.call_count, 1)
+        stats = self.ml._settings()["transport"].stats()
+        self.assertTrue(stats["refused"] > 0)
+
+    @mock.patch("socket.socket")
+    def test__send_after_fork(self, mock_socket_constructor):
+        mock_socket_constructor.side_effect = lambda *a: mock.Mock()
+
+        self.ml._send("metric", 1, "type")
+        metricslogging.metricslogging._socket_pool._after_fork()
+        self.ml._send("metric", 1, "type")
+        self.assertEqual(mock_socket_constructor.call_count, 2)
+
+
+class TestMetricHandles(unittest.TestCase):
+    def setUp(self):
+        super(TestMetricHandles, self).setUp()
+        metricslogging.setGlobalPrefix("")
+        self.ml = metricslogging.StatsdMetricsLogger()
+        self.ml.setPrefix("prefix")
+        self.ml.setPrependHost(False)
+        self.ml.setStatsdDelimiter(".")
+
+        patcher = mock.patch(
+            "metricslogging.metricslogging.StatsdMetricsLogger._write")
+        self.addCleanup(patcher.stop)
+        self.mock_write = patcher.start()
+
+    def test_handles_send_wire_lines(self):
+        self.ml.gauge_handle("active").set(3)
+        self.ml.counter_handle("requests").inc()
+        self.ml.counter_handle("bytes", sample_rate=1.0).inc(512)
+        self.ml.timer_handle("latency").record(1.5)
+
+        self.assertEqual(
+            [c[0][0] for c in self.mock_write.call_args_list],
+            [b"prefix.active:3|g", b"prefix.requests:1|c",
+             b"prefix.bytes:512|c@1.0", b"prefix.latency:1.5|ms"])
+
+    def test_handle_matches_call_path(self):
+        self.ml.counter("requests", 1, sample_rate=1.0)
+        self.ml.counter_handle("requests", sample_rate=1.0).inc()
+        first, second = self.mock_write.call_args_list
+        self.assertEqual(first, second)
+
+    def test_handle_rebinds_on_config_change(self):
+        handle = self.ml.counter_handle("requests|all")
+        handle.inc()
+        self.ml.setPrefix("other")
+        handle.inc()
+        metricslogging.setGlobalPrefix("global")
+        self.addCleanup(metricslogging.setGlobalPrefix, "")
+        handle.inc()
+
+        self.assertEqual(
+            [c[0][0] for c in self.mock_write.call_args_list],
+            [b"prefix.requests-all:1|c", b"other.requests-all:1|c",
+             b"global.other.requests-all:1|c"])
+
+    def test_counter_handle_sampling(self):
+        handle = self.ml.counter_handle("requests", 0.5, deterministic=True)
+        for _ in range(10):
+            handle.inc()
+        self.assertEqual(self.mock_write.call_count, 5)
+        self.assertRaises(ValueError, self.ml.counter_handle, "requests", 2)
+
+    def test_handles_use_slots(self):
+        handle = self.ml.timer_handle("latency")
+        self.assertRaises(AttributeError, setattr, handle, "extra", 1)
+
+    def test_handles_on_other_backends(self):
+        ml = RecordingMetricsLogger()
+        ml.gauge_handle("active").set(3)
+        ml.counter_handle("requests", sample_rate=1.0).inc(2)
+        ml.timer_handle("latency").record(1.5)
+        self.assertEqual(ml.calls, [("gauge", "active", 3),
+                                    ("counter", "requests", 2, 1.0),
+                                    ("timer", "latency", 1.5)])
+
+    def test_handles_aggregate(self):
+        ml = metricslogging.AggregatingMetricsLogger()
+        ml.setAggregateInterval(None)
+        handle = ml.counter_handle("requests")
+        handle.inc()
+        handle.inc(2)
+        with mock.patch.object(ml, "_send") as mock_send:
+            ml.flush()
+        mock_send.assert_called_once_with(mock.ANY, 3, "c",
+                                          sample_rate=None)
+
+
+class TestChildLoggers(unittest.TestCase):
+    def setUp(self):
+        super(TestChildLoggers, self).setUp()
+        metricslogging.setGlobalPrefix("")
+        self.ml = metricslogging.StatsdMetricsLogger()
+        self.ml.setPrefix("service")
+        self.ml.setPrependHost(False)
+        self.ml.setStatsdDelimiter(".")
+
+        patcher = mock.patch(
+            "metricslogging.metricslogging.StatsdMetricsLogger._write")
+        self.addCleanup(patcher.stop)
+        self.mock_write = patcher.start()
+
+    def test_child_prefix(self):
+        db = self.ml.child("db")
+        db.gauge("connections", 3)
+        db.child("query").timer("select", 1.5)
+
+        self.assertEqual(
+            [c[0][0] for c in self.mock_write.call_args_list],
+            [b"service.db.connections:3|g",
+             b"service.db.query.select:1.5|ms"])
+
+    def test_child_reused(self):
+        self.assertIs(self.ml.child("db"), self.ml.child("db"))
+        self.assertIsNot(self.ml.child("db"), self.ml.child("cache"))
+        self.assertIsInstance(self.ml.child("db"),
+                              metricslogging.StatsdMetricsLogger)
+
+    def test_child_follows_parent_config(self):
+        db = self.ml.child("db")
+        db.counter("requests", 1, sample_rate=1.0)
+        self.ml.setPrefix("other")
+        self.ml.setStatsdPort(9125)
+        db.counter("requests", 1, sample_rate=1.0)
+
+        self.assertEqual(db.getStatsdPort(), 9125)
+        self.assertEqual(
+            [c[0][0] for c in self.mock_write.call_args_list],
+            [b"service.db.requests:1|c@1.0", b"other.db.requests:1|c@1.0"])
+
+    def test_child_overrides_config(self):
+        db = self.ml.child("db")
+        db.setStatsdPort(9125)
+        self.assertEqual(db.getStatsdPort(), 9125)
+        self.assertNotEqual(self.ml.getStatsdPort(), 9125)
+
+    def test_child_without_prefix(self):
+        ml = metricslogging.StatsdMetricsLogger()
+        ml.setPrependHost(False)
+        ml.setStatsdDelimiter(".")
+        ml.child("db").gauge("connections", 3)
+        self.mock_write.assert_called_once_with(b"db.connections:3|g")
+
+    def test_child_shares_random(self):
+        self.assertIs(self.ml.child("db")._random, self.ml._random)
+
+    def test_concurrent_child(self):
+        children = []
+        threads = [threading.Thread(
+            target=lambda: children.append(self.ml.child("db")))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(map(id, children))), 1)
+
+
+class TestTags(unittest.TestCase):
+    def setUp(self):
+        super(TestTags, self).setUp()
+        metricslogging.setGlobalPrefix("")
+        self.ml = metricslogging.StatsdMetricsLogger()
+        self.ml.setPrefix("service")
+        self.ml.setPrependHost(False)
+        self.ml.setStatsdDelimiter(".")
+
+        patcher = mock.patch(
+            "metricslogging.metricslogging.StatsdMetricsLogger._write")
+        self.addCleanup(patcher.stop)
+        self.mock_write = patcher.start()
+
+    def lines(self):
+        return [c[0][0] for c in self.mock_write.call_args_list]
+
+    def test_tag_sets_interned(self):
+        tags = metricslogging.getTagSet({"region": "dfw", "az": 1})
+        self.assertIs(tags, metricslogging.getTagSet([("az", 1),
+                                                      ("region", "dfw")]))
+        self.assertIs(tags, metricslogging.getTagSet(tags))
+        self.assertEqual(tags.pairs, (("az", 1), ("region", "dfw")))
+        self.assertIsNone(metricslogging.getTagSet({}))
+        self.assertIsNone(metricslogging.getTagSet(None))
+
+    def test_dogstatsd(self):
+        self.ml.gauge("active", 3, tags={"region": "dfw", "az": 1})
+        self.ml.counter("requests", 1, sample_rate=1.0,
+                        tags={"region": "dfw"})
+        self.assertEqual(self.lines(),
+                         [b"service.active:3|g|#az:1,region:dfw",
+                          b"service.requests:1|c@1.0|#region:dfw"])
+
+    def test_influxdb(self):
+        self.ml.setStatsdTagFormat("influxdb")
+        self.ml.timer("latency", 1.5, tags={"region": "dfw", "az": 1})
+        self.mock_write.assert_called_once_with(
+            b"service.latency,az=1,region=dfw:1.5|ms")
+
+    def test_graphite(self):
+        self.ml.setStatsdTagFormat("graphite")
+        self.ml.timer("latency", 1.5, tags={"region": "dfw", "az": 1})
+        self.mock_write.assert_called_once_with(
+            b"service.latency;az=1;region=dfw:1.5|ms")
+
+    def test_unknown_format(self):
+        self.ml.setStatsdTagFormat("unknown")
+        self.assertRaises(ValueError, self.ml.gauge, "active", 3,
+                          tags={"a": "b"})
+
+    def test_tags_sanitized(self):
+        self.ml.gauge("active", 3, tags={"a b|c": "d,e:f#g"})
+        self.mock_write.assert_called_once_with(
+            b"service.active:3|g|#a-b-c:d-e-f-g")
+
+    def test_encoding_cached(self):
+        tags = metricslogging.getTagSet({"encoding": "cached"})
+        with mock.patch.object(metricslogging.StatsdMetricsLogger,
+                               "_format_tags",
+                               return_value=("", "|#x")) as mock_format:
+            self.ml.gauge("active", 1, tags=tags)
+            self.ml.gauge("active", 2, tags={"encoding": "cached"})
+        self.assertEqual(mock_format.call_count, 1)
+        self.assertEqual(self.lines(), [b"service.active:1|g|#x",
+                                        b"service.active:2|g|#x"])
+
+    def test_context_decorators_and_handles(self):
+        @self.ml.counter_cd("calls", tags={"op": "get"})
+        @self.ml.return_val_gauge_d("result", tags={"op": "get"})
+        def get():
+            return 5
+
+        get()
+        self.ml.timer_handle("latency", tags={"op": "get"}).record(1.5)
+        self.assertEqual(self.lines(),
+                         [b"service.calls:1|c|#op:get",
+                          b"service.result:5|g|#op:get",
+                          b"service.latency:1.5|ms|#op:get"])
+
+    def test_backends_without_tags(self):
+        ml = RecordingMetricsLogger()
+        ml.gauge("active", 3)
+        ml.timer_cd("latency")(lambda: None)()
+        self.assertEqual([c[:2] for c in ml.calls],
+                         [("gauge", "active"), ("timer", "latency")])
+
+    def test_async_delivery(self):
+        self.ml.setAsyncDelivery(True)
+        self.ml.gauge("active", 3, tags={"region": "dfw"})
+        metricslogging.metricslogging._async_sender.drain()
+        self.mock_write.assert_called_once_with(
+            b"service.active:3|g|#region:dfw")
+
+    def test_aggregation_keyed_by_tags(self):
+        ml = metricslogging.AggregatingMetricsLogger()
+        ml.setAggregateInterval(None)
+        ml.counter("requests", 1, tags={"region": "dfw"})
+        ml.counter("requests", 2, tags={"region": "dfw"})
+        ml.counter("requests", 4, tags={"region": "ord"})
+        ml.counter("requests", 8)
+        with mock.patch.object(ml, "_send") as mock_send:
+            ml.flush()
+        self.assertEqual(
+            sorted((c[0][1], c[1].get("tags")) for c in
+                   mock_send.call_args_list),
+            [(3, metricslogging.getTagSet({"region": "dfw"})),
+             (4, metricslogging.getTagSet({"region": "ord"})),
+             (8, None)])
+
+
+class TestProcessors(unittest.TestCase):
+    def setUp(self):
+        super(TestProcessors, self).setUp()
+        metricslogging.setGlobalPrefix("")
+        self.ml = metricslogging.StatsdMetricsLogger()
+        self.ml.setPrefix("service")
+        self.ml.setPrependHost(False)
+        self.ml.setStatsdDelimiter(".")
+
+        patcher = mock.patch(
+            "metricslogging.metricslogging.StatsdMetricsLogger._write")
+        self.addCleanup(patcher.stop)
+        self.mock_write = patcher.start()
+
+    def lines(self):
+        return [c[0][0] for c in self.mock_write.call_args_list]
+
+    def test_name_filter(self):
+        name_filter = metricslogging.NameFilter(allow=["db.*", "requests"],
+                                                deny=["db.debug.*"])
+        self.assertTrue(name_filter.allows("db.query"))
+        self.assertTrue(name_filter.allows(["db", "query"]))
+        self.assertTrue(name_filter.allows("requests"))
+        self.assertFalse(name_filter.allows("db.debug.query"))
+        self.assertFalse(name_filter.allows("cache.hits"))
+        self.assertTrue(metricslogging.NameFilter(deny=["x"]).allows("y"))
+
+    def test_rejected_before_formatting(self):
+        self.ml.setProcessors([metricslogging.NameFilter(deny=["noisy*"])])
+        with mock.patch.object(self.ml, "format_name") as mock_format:
+            self.ml.gauge("noisy", 1)
+            self.ml.counter_handle("noisy.handle").inc()
+        self.assertFalse(mock_format.called)
+        self.assertFalse(self.mock_write.called)
+
+    def test_rate_limiter(self):
+        limiter = metricslogging.RateLimiter(1, burst=2)
+        with mock.patch("metricslogging.metricslogging._monotonic",
+                        side_effect=[0, 0, 0, 0, 0, 1.0]):
+            self.ml.setProcessors([limiter])
+            for value in range(4):
+                self.ml.gauge("active", value)
+            self.ml.gauge("other", 0)
+            self.ml.gauge("active", 4)
+        self.assertEqual(self.lines(), [b"service.active:0|g",
+                                        b"service.active:1|g",
+                                        b"service.other:0|g",
+                                        b"service.active:4|g"])
+        self.assertRaises(ValueError, metricslogging.RateLimiter, 0)
+
+    def test_rate_limiter_buckets_bounded(self):
+        limiter = metricslogging.RateLimiter(1, burst=1)
+        limiter.MAX_BUCKETS = 4
+        with mock.patch("metricslogging.metricslogging._monotonic",
+                        side_effect=[0, 0, 0, 5, 5, 5]):
+            for i in range(3):
+                limiter(self.ml.GAUGE, "name%d" % i, 0, None)
+            limiter(self.ml.GAUGE, "active", 0, None)
+            self.assertEqual(len(limiter._buckets), 4)
+
+            # The refilled buckets are forgotten, the empty one is kept
+            limiter(self.ml.GAUGE, "name3", 0, None)
+            self.assertEqual(len(limiter._buckets), 2)
+            self.assertEqual(limiter(self.ml.GAUGE, "active", 1, None), None)
+
+    def test_rate_limiter_buckets_bounded_when_all_in_use(self):
+        limiter = metricslogging.RateLimiter(1, burst=1)
+        limiter.MAX_BUCKETS = 4
+        with mock.patch("metricslogging.metricslogging._monotonic",
+                        return_value=0):
+            for i in range(50):
+                self.assertTrue(limiter(self.ml.GAUGE, "name%d" % i, 0, None))
+                self.assertTrue(len(limiter._buckets) <= 4)
+
+    def test_rename_and_transform(self):
+        self.ml.setProcessors([
+            metricslogging.Renamer({"latency_s": "latency"}),
+            metricslogging.ValueTransform(
+                lambda value: value * 1000, kinds=[self.ml.TIMER],
+                names=metricslogging.NameFilter(allow=["latency"])),
+        ])
+        self.ml.timer("latency_s", 1.5)
+        self.ml.timer("other", 1.5)
+        self.ml.gauge("latency_s", 2)
+        self.ml.timer_handle("latency_s").record(2)
+        self.assertEqual(self.lines(), [b"service.latency:1500.0|ms",
+                                        b"service.other:1.5|ms",
+                                        b"service.latency:2|g",
+                                        b"service.latency:2000|ms"])
+
+    def test_processor_sees_tags(self):
+        def add_tag(kind, name, value, tags):
+            return name, value, dict(tags or (), env="prod")
+
+        self.ml.setProcessors([add_tag])
+        self.ml.gauge("active", 1, tags={"region": "dfw"})
+        self.mock_write.assert_called_once_with(
+            b"service.active:1|g|#env:prod,region:dfw")
+
+    def test_global_processors(self):
+        metricslogging.setProcessors([metricslogging.NameFilter(
+            deny=["dropped"])])
+        self.addCleanup(metricslogging.setProcessors, None)
+        self.ml.gauge("dropped", 1)
+        self.ml.child("db").gauge("dropped", 1)
+        self.assertFalse(self.mock_write.called)
+
+        self.ml.setProcessors([])
+        self.ml.gauge("dropped", 1)
+        self.mock_write.assert_called_once_with(b"service.dropped:1|g")
+
+
+class TestInternalStats(unittest.TestCase):
+    def setUp(self):
+        super(TestInternalStats, self).setUp()
+        metricslogging.setGlobalPrefix("")
+        self.sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.sink.close)
+        self.sink.bind(("127.0.0.1", 0))
+        self.sink.settimeout(5)
+
+        self.ml = metricslogging.StatsdMetricsLogger()
+        self.ml.setPrefix("stats")
+        self.ml.setPrependHost(False)
+        self.ml.setStatsdHost("127.0.0.1")
+        self.ml.setStatsdPort(self.sink.getsockname()[1])
+        self.ml.setInternalStats(True)
+
+    def test_disabled_by_default(self):
+        ml = metricslogging.StatsdMetricsLogger()
+        with mock.patch.object(ml, "_deliver"):
+            ml.gauge("metric", 1)
+        self.assertEqual(ml.getStats()["metrics_emitted"], 0)
+
+    def test_logger_stats(self):
+        self.ml.setProcessors([metricslogging.NameFilter(deny=["dropped"])])
+        self.ml.gauge("metric", 1)
+        self.ml.gauge_handle("metric").set(2)
+        self.ml.counter("metric", 1, sample_rate=0.0)
+        self.ml.counter_handle("metric", sample_rate=0.0).inc()
+        self.ml.gauge("dropped", 1)
+
+        stats = self.ml.getStats()
+        self.assertEqual(stats["metrics_emitted"], 2)
+        self.assertEqual(stats["samples_skipped"], 2)
+        self.assertEqual(stats["processor_drops"], 1)
+        self.assertTrue(stats["emit_ns"] > 0)
+
+    def test_transport_stats(self):
+        self.ml.gauge("metric", 1)
+        self.ml.gauge("metric", 2)
+        key = "udp:127.0.0.1:%d" % self.sink.getsockname()[1]
+        self.assertEqual(metricslogging.getStats()["transports"][key],
+                         {"packets_sent": 2, "bytes_sent": 32,
+                          "send_errors": 0, "refused": 0})
+
+    @mock.patch("socket.socket")
+    def test_send_errors(self, mock_socket_constructor):
+        mock_socket = mock.Mock()
+        mock_socket.send.side_effect = socket.error("refused")
+        mock_socket_constructor.return_value = mock_socket
+        self.ml.setStatsdPort(1)
+
+        self.assertRaises(socket.error, self.ml.gauge, "metric", 1)
+        transport = self.ml._settings()["transport"]
+        self.assertEqual(transport.stats()["send_errors"], 1)
+        self.assertEqual(transport.stats()["packets_sent"], 0)
+
+    def test_snapshot_sums_loggers(self):
+        other = metricslogging.StatsdMetricsLogger()
+        other.setPrefix("stats")
+        other.setInternalStats(True)
+        with mock.patch.object(other, "_deliver"):
+            other.gauge("metric", 1)
+        self.ml.child("db").gauge("metric", 1)
+        self.ml.gauge("metric", 1)
+
+        loggers = metricslogging.getStats()["loggers"]
+        self.assertEqual(loggers["stats"]["metrics_emitted"], 2)
+        self.assertEqual(loggers["stats.db"]["metrics_emitted"], 1)
+
+    def test_report(self):
+        reporter = metricslogging.metricslogging._StatsReporter()
+        snapshots = [
+            {"loggers": {"stats.db": {"metrics_emitted": 3}},
+             "transports": {"tcp:127.0.0.1:8125": {"buffered_bytes": 10}},
+             "async": {"queued": 0, "dropped": 0},
+             "collectors": {}},
+            {"loggers": {"stats.db": {"metrics_emitted": 5}},
+             "transports": {"tcp:127.0.0.1:8125": {"buffered_bytes": 0}},
+             "async": {"queued": 0, "dropped": 0},
+             "collectors": {}},
+        ]
+        with mock.patch("metricslogging.metricslogging.getStats",
+                        side_effect=snapshots):
+            with mock.patch.object(metricslogging.StatsdMetricsLogger,
+                                   "_send") as mock_send:
+                metricslogging.setPrependHost(False)
+                self.addCleanup(metricslogging.setPrependHost, False)
+                reporter.report()
+                reporter.report()
+
+        sent = sorted(c[0][:3] for c in mock_send.call_args_list)
+        self.assertEqual(sent, [
+            ("metricslogging.async.queued", 0, "g"),
+            ("metricslogging.async.queued", 0, "g"),
+            ("metricslogging.loggers.stats_db.metrics_emitted", 2, "c"),
+            ("metricslogging.loggers.stats_db.metrics_emitted", 3, "c"),
+            ("metricslogging.transports.tcp_127_0_0_1_8125.buffered_bytes",
+             0, "g"),
+            ("metricslogging.transports.tcp_127_0_0_1_8125.buffered_bytes",
+             10, "g"),
+        ])
+
+    def test_report_interval(self):
+        with mock.patch("metricslogging.metricslogging._scheduler") \
+                as mock_scheduler:
+            metricslogging.setInternalStatsInterval(10)
+            metricslogging.setInternalStatsInterval(None)
+        mock_scheduler.call_every.assert_called_once_with(
+            10, metricslogging.metricslogging._stats_reporter.report)
+        mock_scheduler.cancel.assert_called_once_with(
+            mock_scheduler.call_every.return_value)
+
+
+class TestEmitMany(unittest.TestCase):
+    def setUp(self):
+        super(TestEmitMany, self).setUp()
+        metricslogging.setGlobalPrefix("")
+        self.sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.sink.close)
+        self.sink.bind(("127.0.0.1", 0))
+        self.sink.settimeout(5)
+
+        self.ml = metricslogging.StatsdMetricsLogger()
+        self.ml.setPrefix("pool")
+        self.ml.setPrependHost(False)
+        self.ml.setStatsdHost("127.0.0.1")
+        self.ml.setStatsdPort(self.sink.getsockname()[1])
+
+    def test_one_datagram(self):
+        self.ml.emit_many([("gauge", "size", 10),
+                           ("c", "checkouts", 2, 1.0),
+                           ("counter", "skipped", 1, 0.0),
+                           ("ms", "wait", 1.5)])
+        self.assertEqual(self.sink.recv(4096),
+                         b"pool.size:10|g\npool.checkouts:2|c@1.0\n"
+                         b"pool.wait:1.5|ms")
+
+    def test_dict_of_gauges(self):
+        self.ml.emit_many({"depth": 3})
+        self.assertEqual(self.sink.recv(4096), b"pool.depth:3|g")
+
+    def test_packed_to_packet_size(self):
+        self.ml.setStatsdPacketSize(25)
+        self.ml.emit_gauges(["a", "b", "c"], [1, 2, 3])
+        self.ml.flush()
+        self.assertEqual(self.sink.recv(4096), b"pool.a:1|g\npool.b:2|g")
+        self.assertEqual(self.sink.recv(4096), b"pool.c:3|g")
+
+    def test_emit_gauges_array(self):
+        self.ml.emit_gauges(["a", "b"], array.array("d", [1.5, 2.5]),
+                            tags={"pool": "db"})
+        self.assertEqual(self.sink.recv(4096),
+                         b"pool.a:1.5|g|#pool:db\npool.b:2.5|g|#pool:db")
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.ml.emit_many, [("x", "a", 1)])
+        self.assertRaises(ValueError, self.ml.emit_many,
+                          [("c", "a", 1, 2.0)])
+        self.assertRaises(ValueError, self.ml.emit_gauges, ["a"], [1, 2])
+
+    def test_processors_applied(self):
+        self.ml.setProcessors([metricslogging.NameFilter(deny=["b"])])
+        with mock.patch.object(self.ml, "_write") as mock_write:
+            self.ml.emit_gauges(["a", "b"], [1, 2])
+        mock_write.assert_called_once_with(b"pool.a:1|g")
+
+    def test_other_backends(self):
+        ml = RecordingMetricsLogger()
+        ml.emit_many([("gauge", "a", 1), ("timer", "b", 2)])
+        ml.emit_many({"c": 3})
+        self.assertEqual(ml.calls, [("gauge", "a", 1), ("timer", "b", 2),
+                                    ("gauge", "c", 3)])
+
+    def test_aggregated(self):
+        ml = metricslogging.AggregatingMetricsLogger()
+        ml.setAggregateInterval(None)
+        ml.emit_many([("c", "a", 1), ("c", "a", 2)])
+        with mock.patch.object(ml, "_send") as mock_send:
+            ml.flush()
+        mock_send.assert_called_once_with(mock.ANY, 3, "c", sample_rate=None)
+
+
+class TestCollectors(unittest.TestCase):
+    def setUp(self):
+        super(TestCollectors, self).setUp()
+        metricslogging.setGlobalPrefix("")
+        self.sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.sink.close)
+        self.sink.bind(("127.0.0.1", 0))
+        self.sink.settimeout(5)
+
+        self.ml = metricslogging.StatsdMetricsLogger()
+        self.ml.setPrefix("app")
+        self.ml.setPrependHost(False)
+        self.ml.setStatsdHost("127.0.0.1")
+        self.ml.setStatsdPort(self.sink.getsockname()[1])
+
+    def add_collector(self, *args, **kwargs):
+        registration = self.ml.add_collector(*args, **kwargs)
+        self.addCleanup(registration.remove)
+        return registration
+
+    def group(self, interval):
+        return metricslogging.metricslogging._collectors._groups[interval]
+
+    def test_coalesced_into_one_batch(self):
+        class Pool(object):
+            def collect(self):
+                return {"size": 10, "idle": None}
+
+        self.add_collector("queue.depth", lambda: 3, 3600)
+        self.add_collector("pool", Pool(), 3600, tags={"pool": "db"})
+        self.add_collector(None, lambda: {"workers": 8}, 3600)
+        self.add_collector("skipped", lambda: None, 3600)
+        self.assertEqual(len(self.group(3600).registrations), 4)
+
+        self.group(3600).collect()
+        self.assertEqual(self.sink.recv(4096),
+                         b"app.queue.depth:3|g\napp.workers:8|g")
+        self.assertEqual(self.sink.recv(4096), b"app.pool.size:10|g|#pool:db")
+
+    def test_scheduled(self):
+        self.add_collector("depth", lambda: 3, 0.01)
+        self.assertEqual(self.sink.recv(4096), b"app.depth:3|g")
+
+    def test_timeout(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def slow():
+            release.wait(5)
+            return 1
+
+        collectors = metricslogging.metricslogging._collectors
+        timeouts, skipped = collectors.timeouts, collectors.skipped
+        self.add_collector("slow", slow, 3600, timeout=0.01)
+        self.add_collector("fast", lambda: 2, 3600)
+
+        self.group(3600).collect()
+        self.assertEqual(self.sink.recv(4096), b"app.fast:2|g")
+        self.assertEqual(collectors.timeouts, timeouts + 1)
+
+        # Not sampled again while still running
+        self.group(3600).collect()
+        self.assertEqual(self.sink.recv(4096), b"app.fast:2|g")
+        self.assertEqual(collectors.skipped, skipped + 1)
+
+    def test_errors_counted(self):
+        def broken():
+            raise RuntimeError("broken")
+
+        errors = metricslogging.getStats()["collectors"]["errors"]
+        self.add_collector("broken", broken, 3600)
+        self.add_collector(None, lambda: 1, 3600)
+        self.add_collector("fine", lambda: 1, 3600)
+
+        self.group(3600).collect()
+        self.assertEqual(self.sink.recv(4096), b"app.fine:1|g")
+        self.assertEqual(metricslogging.getStats()["collectors"]["errors"],
+                         errors + 2)
+
+    def test_remove(self):
+        registration = self.ml.add_collector("depth", lambda: 3, 3600)
+        group = self.group(3600)
+        with mock.patch("metricslogging.metricslogging._scheduler") \
+                as mock_scheduler:
+            registration.remove()
+            registration.remove()
+        mock_scheduler.cancel.assert_called_once_with(group._entry)
+        self.assertNotIn(3600,
+                         metricslogging.metricslogging._collectors._groups)
+
+    def test_invalid(self):
+        self.assertRaises(TypeError, self.ml.add_collector, "a", 1, 10)
+        self.assertRaises(ValueError, self.ml.add_collector, "a", int, 0)
+
+
+class TestStatsdBatching(unittest.TestCase):
+    def setUp(self):
+        super(TestStatsdBatching, self).setUp()
+        metricslogging.metricslogging._socket_pool.reset()
+        metricslogging.metricslogging._packet_buffers.clear()
+
+        self.ml = metricslogging.StatsdMetricsLogger()
+        self.ml.setStatsdHost("testhost")
+        self.ml.setStatsdPort(4321)
+        self.ml.setStatsdPacketSize(32)
+        self.ml.setStatsdFlushInterval(None)
+
+        patcher = mock.patch("socket.socket")
+        self.addCleanup(patcher.stop)
+        self.mock_socket = mock.Mock()
+        patcher.start().return_value = self.mock_socket
+
+    def tearDown(self):
+        super(TestStatsdBatching, self).tearDown()
+        metricslogging.metricslogging._packet_buffers.clear()
+        metricslogging.metricslogging._socket_pool.reset()
+
+    def test_flush_joins_lines(self):
+        self.ml._send("a", 1, "c")
+        self.ml._send("b", 2, "g")
+        self.assertFalse(self.mock_socket.send.called)
+
+        self.ml.flush()
+        self.mock_socket.send.assert_called_once_with(b"a:1|c\nb:2|g")
+
+        self.ml.flush()
+        self.assertEqual(self.mock_socket.send.call_count, 1)
+
+    def test_full_buffer_sent_without_splitting_lines(self):
+        for i in range(5):
+            self.ml._send("metric%d" % i, 100, "ms")
+
+        self.assertEqual(
+            self.mock_socket.send.call_args_list,
+            [mock.call(b"metric0:100|ms\nmetric1:100|ms"),
+             mock.call(b"metric2:100|ms\nmetric3:100|ms")])
+        self.ml.flush()
+        self.mock_socket.send.assert_called_with(b"metric4:100|ms")
+
+    def test_oversized_line_sent_alone(self):
+        self.ml._send("a", 1, "c")
+        self.ml._send("a_very_long_metric_name_indeed", 1, "c")
+        self.ml.flush()
+        self.assertEqual(
+            self.mock_socket.send.call_args_list,
+            [mock.call(b"a:1|c"),
+             mock.call(b"a_very_long_metric_name_indeed:1|c")])
+
+    def test_context_exit_flushes(self):
+        with self.ml as logger:
+            logger._send("a", 1, "c")
+        self.mock_socket.send.assert_called_once_with(b"a:1|c")
+
+    def test_loggers_share_target_buffer(self):
+        other = metricslogging.StatsdMetricsLogger()
+        other.setStatsdHost("testhost")
+        other.setStatsdPort(4321)
+        other.setStatsdPacketSize(32)
+
+        self.ml._send("a", 1, "c")
+        other._send("b", 1, "c")
+        metricslogging.flush()
+        self.mock_socket.send.assert_called_once_with(b"a:1|c\nb:1|c")
+
+    def test_flush_interval(self):
+        sent = threading.Event()
+        self.mock_socket.send.side_effect = lambda data: sent.set()
+        self.ml.setStatsdFlushInterval(0.01)
+
+        self.ml._send("a", 1, "c")
+        self.assertTrue(sent.wait(5))
+        self.mock_socket.send.assert_called_once_with(b"a:1|c")
+
+
+class TestStatsdTransports(unittest.TestCase):
+    def setUp(self):
+        super(TestStatsdTransports, self).setUp()
+        metricslogging.setGlobalPrefix("")
+        self.ml = metricslogging.StatsdMetricsLogger()
+        self.ml.setPrependHost(False)
+        self.ml.setStatsdHost("127.0.0.1")
+
+    def tcp_server(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        self.ml.setStatsdTransport("tcp")
+        self.ml.setStatsdPort(server.getsockname()[1])
+        self.addCleanup(self.ml._settings()["transport"].close)
+        return server
+
+    def recv_lines(self, conn, count):
+        data = b""
+        while data.count(b"\n") < count:
+            chunk = conn.recv(4096)
+            self.assertTrue(chunk)
+            data += chunk
+        return data
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.001)
+
+    def test_unix_datagram(self):
+        path = os.path.join(tempfile.mkdtemp(), "statsd.sock")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(path)
+        server.settimeout(5)
+
+        self.ml.setStatsdTransport("unix")
+        self.ml.setStatsdSocketPath(path)
+        self.ml.gauge("metric", 1)
+        self.assertEqual(server.recv(4096), b"metric:1|g")
+
+    def test_tcp_newline_framing(self):
+        server = self.tcp_server()
+        server.listen(1)
+        self.ml.gauge("first", 1)
+        self.ml.gauge("second", 2)
+
+        conn, _ = server.accept()
+        self.addCleanup(conn.close)
+        conn.settimeout(5)
+        self.assertEqual(self.recv_lines(conn, 2),
+                         b"first:1|g\nsecond:2|g\n")
+
+    def test_tcp_batched(self):
+        server = self.tcp_server()
+        server.listen(1)
+        self.ml.setStatsdPacketSize(1432)
+        self.ml.gauge("first", 1)
+        self.ml.gauge("second", 2)
+        self.ml.flush()
+
+        conn, _ = server.accept()
+        self.addCleanup(conn.close)
+        conn.settimeout(5)
+        self.assertEqual(self.recv_lines(conn, 1),
+                         b"first:1|g\nsecond:2|g\n")
+
+    def test_tcp_buffers_during_outage(self):
+        # Bound but not listening, so connections are refused
+        server = self.tcp_server()
+        transport = self.ml._settings()["transport"]
+        self.ml.gauge("first", 1)
+        self.ml.gauge("second", 2)
+        self.wait_for(lambda: transport._reconnect_entry is not None)
+
+        server.listen(1)
+        transport._reconnect()
+        self.ml.gauge("third", 3)
+
+        conn, _ = server.accept()
+        self.addCleanup(conn.close)
+        conn.settimeout(5)
+        self.assertEqual(self.recv_lines(conn, 3),
+                         b"first:1|g\nsecond:2|g\nthird:3|g\n")
+
+    def test_tcp_connect_doesnt_block_emitters(self):
+        self.tcp_server()
+        transport = self.ml._settings()["transport"]
+        connecting, release = threading.Event(), threading.Event()
+        self.addCleanup(release.set)
+        mock_socket = mock.Mock()
+
+        def connect(address):
+            connecting.set()
+            release.wait(5)
+
+        mock_socket.connect.side_effect = connect
+        with mock.patch("socket.socket", return_value=mock_socket):
+            self.ml.gauge("first", 1)
+            self.assertTrue(connecting.wait(5))
+
+            # Only buffered while the connect is in flight
+            self.ml.gauge("second", 2)
+            self.assertFalse(mock_socket.sendall.called)
+            self.assertTrue(transport._lock.acquire(False))
+            transport._lock.release()
+
+            release.set()
+            self.wait_for(lambda: transport._sock is mock_socket)
+            self.ml.gauge("third", 3)
+        self.assertEqual(mock_socket.sendall.call_args_list,
+                         [mock.call(b"first:1|g\n"),
+                          mock.call(b"second:2|g\n"),
+                          mock.call(b"third:3|g\n")])
+        self.assertEqual(transport.packets_sent, 3)
+
+    def test_tcp_buffer_size(self):
+        self.tcp_server()
+        metricslogging.setStatsdTcpBufferSize(22)
+        self.addCleanup(metricslogging.setStatsdTcpBufferSize, 1048576)
+        transport = self.ml._settings()["transport"]
+        for i in range(3):
+            self.ml.gauge("metric", i)
+
+        self.assertEqual(transport.dropped, 1)
+        self.assertEqual(list(transport._pending),
+                         [b"metric:1|g\n", b"metric:2|g\n"])
+
+    def test_unknown_transport(self):
+        self.ml.setStatsdTransport("carrier-pigeon")
+        self.assertRaises(ValueError, self.ml.gauge, "metric", 1)
+
+
+class TestResolver(unittest.TestCase):
+    def setUp(self):
+        super(TestResolver, self).setUp()
+        metricslogging.metricslogging._resolver.reset()
+        metricslogging.metricslogging._socket_pool.reset()
+        self.addCleanup(metricslogging.metricslogging._resolver.reset)
+        self.addCleanup(metricslogging.metricslogging._socket_pool.reset)
+
+        metricslogging.setGlobalPrefix("")
+        self.ml = metricslogging.StatsdMetricsLogger()
+        self.ml.setPrependHost(False)
+
+    def sink(self, family, host):
+        sink = socket.socket(family, socket.SOCK_DGRAM)
+        self.addCleanup(sink.close)
+        sink.bind((host, 0))
+        sink.settimeout(5)
+        return sink
+
+    def test_resolved_once(self):
+        sink = self.sink(socket.AF_INET, "127.0.0.1")
+        self.ml.setStatsdHost("localhost")
+        self.ml.setStatsdPort(sink.getsockname()[1])
+
+        with mock.patch("socket.getaddrinfo",
+                        return_value=[(socket.AF_INET, socket.SOCK_DGRAM, 17,
+                                       "", sink.getsockname())]) as mock_gai:
+            self.ml.gauge("metric", 1)
+            metricslogging.metricslogging._socket_pool.reset()
+            self.ml.gauge("metric", 2)
+
+        self.assertEqual(mock_gai.call_count, 1)
+        self.assertEqual(sink.recv(4096), b"metric:1|g")
+        self.assertEqual(sink.recv(4096), b"metric:2|g")
+
+    def test_ipv4_preferred(self):
+        sink = self.sink(socket.AF_INET, "127.0.0.1")
+        port = sink.getsockname()[1]
+        self.ml.setStatsdHost("localhost")
+        self.ml.setStatsdPort(port)
+
+        with mock.patch("socket.getaddrinfo",
+                        return_value=[(socket.AF_INET6, socket.SOCK_DGRAM, 17,
+                                       "", ("::1", port, 0, 0)),
+                                      (socket.AF_INET, socket.SOCK_DGRAM, 17,
+                                       "", ("127.0.0.1", port))]):
+            self.ml.gauge("metric", 1)
+
+        self.assertEqual(sink.recv(4096), b"metric:1|g")
+
+    def test_ipv6_only(self):
+        with mock.patch("socket.getaddrinfo",
+                        return_value=[(socket.AF_INET6, socket.SOCK_DGRAM, 17,
+                                       "", ("::1", 8125, 0, 0))]):
+            self.assertEqual(
+                metricslogging.metricslogging._Resolver._lookup(
+                    ("::1", 8125)),
+                (True, (socket.AF_INET6, ("::1", 8125, 0, 0))))
+
+    def test_refresh_lookup_doesnt_hold_lock(self):
+        resolver = metricslogging.metricslogging._resolver
+        slow_target, other_target = ("slow", 8125), ("other", 8125)
+        with mock.patch("socket.getaddrinfo", return_value=[]):
+            resolver.resolve(slow_target)
+
+        looking_up, release = threading.Event(), threading.Event()
+        self.addCleanup(release.set)
+
+        def slow_getaddrinfo(host, *args):
+            if host == "slow":
+                looking_up.set()
+                release.wait(5)
+            return [(socket.AF_INET, socket.SOCK_DGRAM, 17, "",
+                     ("127.0.0.1", 8125))]
+
+        with mock.patch("socket.getaddrinfo", side_effect=slow_getaddrinfo):
+            refresh = threading.Thread(target=resolver._refresh,
+                                       args=(slow_target,))
+            refresh.start()
+            self.assertTrue(looking_up.wait(5))
+
+            # Emitting threads aren't held up by the lookup
+            self.assertTrue(resolver._lock.acquire(False))
+            resolver._lock.release()
+            self.assertEqual(resolver.resolve(other_target),
+                             (socket.AF_INET, ("127.0.0.1", 8125)))
+            resolver.refresh_soon(slow_target)
+
+            release.set()
+            refresh.join(5)
+        self.assertEqual(resolver.resolve(slow_target),
+                         (socket.AF_INET, ("127.0.0.1", 8125)))
+
+    @unittest.skipUnless(socket.has_ipv6, "IPv6 not supported")
+    def test_ipv6(self):
+        try:
+            sink = self.sink(socket.AF_INET6, "::1")
+        except socket.error:
+            self.skipTest("IPv6 loopback not available")
+        self.ml.setStatsdHost("::1")
+        self.ml.setStatsdPort(sink.getsockname()[1])
+
+        self.ml.gauge("metric", 1)
+        self.assertEqual(sink.recv(4096), b"metric:1|g")
+
+    def test_address_change(self):
+        old_sink = self.sink(socket.AF_INET, "127.0.0.1")
+        new_sink = self.sink(socket.AF_INET, "127.0.0.1")
+        target = ("statsd.example", 8125)
+        self.ml.setStatsdHost(target[0])
+        self.ml.setStatsdPort(target[1])
+
+        def addrinfo(sink):
+            return [(socket.AF_INET, socket.SOCK_DGRAM, 17, "",
+                     sink.getsockname())]
+
+        resolver = metricslogging.metricslogging._resolver
+        with mock.patch("socket.getaddrinfo", return_value=addrinfo(old_sink)):
+            self.ml.gauge("metric", 1)
+        with mock.patch("socket.getaddrinfo", return_value=addrinfo(new_sink)):
+            resolver._refresh(target)
+        self.ml.gauge("metric", 2)
+
+        self.assertEqual(old_sink.recv(4096), b"metric:1|g")
+        self.assertEqual(new_sink.recv(4096), b"metric:2|g")
+
+    @mock.patch("socket.socket")
+    def test_send_failure_refreshes(self, mock_socket_constructor):
+        mock_socket = mock.Mock()
+        mock_socket.send.side_effect = [socket.error("refused"), 10]
+        mock_socket_constructor.return_value = mock_socket
+        self.ml.setStatsdHost("127.0.0.1")
+        self.ml.setStatsdPort(8125)
+
+        resolver = metricslogging.metricslogging._resolver
+        resolver.MIN_REFRESH_INTERVAL = 0
+        self.addCleanup(delattr, resolver, "MIN_REFRESH_INTERVAL")
+        with mock.patch.object(resolver, "_schedule") as mock_schedule:
+            self.ml.gauge("metric", 1)
+        mock_schedule.assert_called_with(("127.0.0.1", 8125), 0)
+
+    def test_unresolvable_host(self):
+        with mock.patch("socket.getaddrinfo",
+                        side_effect=socket.gaierror("unknown")):
+            address = metricslogging.metricslogging._resolver.resolve(
+                ("unknown.example", 8125))
+        self.assertEqual(address,
+                         (socket.AF_INET, ("unknown.example", 8125)))
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        super(TestScheduler, self).setUp()
+        self.scheduler = metricslogging.metricslogging._Scheduler()
+
+    def test_call_later_runs_in_order(self):
+        calls = []
+        done = threading.Event()
+        self.scheduler.call_later(0.02, done.set)
+        self.scheduler.call_later(0.01, lambda: calls.append(2))
+        self.scheduler.call_later(0, lambda: calls.append(1))
+
+        self.assertTrue(done.wait(5))
+        self.assertEqual(calls, [1, 2])
+
+    def test_call_every_and_cancel(self):
+        calls = []
+        done = threading.Event()
+
+        def callback():
+            calls.append(1)
+            if len(calls) == 3:
+                self.scheduler.cancel(entry)
+                done.set()
+
+        entry = self.scheduler.call_every(0.001, callback)
+        self.assertTrue(done.wait(5))
+        time.sleep(0.01)
+        self.assertEqual(len(calls), 3)
+
+    def test_failing_callback_does_not_stop_scheduler(self):
+        done = threading.Event()
+        self.scheduler.call_later(0, lambda: 1 / 0)
+        self.scheduler.call_later(0.001, done.set)
+        self.assertTrue(done.wait(5))
+
+
+class RecordingMetricsLogger(metricslogging.MetricsLogger):
+    def __init__(self):
+        super(RecordingMetricsLogger, self).__init__()
+        self.calls = []
+        self.received = threading.Event()
+
+    def _format_name(self, global_prefix, host, prefix, name):
+        return name
+
+    def _gauge(self, name, value):
+        self.calls.append(("gauge", name, value))
+        self.received.set()
+
+    def _counter(self, name, value, sample_rate=None):
+        self.calls.append(("counter", name, value, sample_rate))
+        self.received.set()
+
+    def _timer(self, name, value):
+        self.calls.append(("timer", name, value))
+        self.received.set()
+
+
+class TestAsyncDelivery(unittest.TestCase):
+    def setUp(self):
+        super(TestAsyncDelivery, self).setUp()
+        self.sender = metricslogging.metricslogging._AsyncSender()
+        self.ml = RecordingMetricsLogger()
+        metricslogging.setAsyncQueueSize(2)
+
+    def tearDown(self):
+        super(TestAsyncDelivery, self).tearDown()
+        metricslogging.setAsyncQueueSize(10000)
+        metricslogging.setAsyncOverflowPolicy("drop_newest")
+
+    def test_delivered_by_sender_thread(self):
+        self.ml.setAsyncDelivery(True)
+        self.ml.counter("metric", 3, sample_rate=1.0)
+        self.assertTrue(self.ml.received.wait(5))
+        self.assertEqual(self.ml.calls, [("counter", "metric", 3, 1.0)])
+
+    def test_sampled_out_counter_not_queued(self):
+        self.ml.setAsyncDelivery(True)
+        with mock.patch.object(metricslogging.metricslogging._async_sender,
+                               "put") as mock_put:
+            self.ml.counter("metric", 3, sample_rate=0.0)
+        self.assertFalse(mock_put.called)
+
+    @mock.patch("metricslogging.metricslogging._AsyncSender._start")
+    def test_drop_newest(self, mock_start):
+        for i in range(3):
+            self.sender.put(self.ml, self.ml.GAUGE, "metric", i)
+        self.assertEqual(self.sender.dropped, 1)
+
+        self.sender.drain()
+        self.assertEqual(self.ml.calls,
+                         [("gauge", "metric", 0), ("gauge", "metric", 1)])
+
+    @mock.patch("metricslogging.metricslogging._AsyncSender._start")
+    def test_drop_oldest(self, mock_start):
+        metricslogging.setAsyncOverflowPolicy("drop_oldest")
+        for i in range(3):
+            self.sender.put(self.ml, self.ml.TIMER, "metric", i)
+        self.assertEqual(self.sender.dropped, 1)
+
+        self.sender.drain()
+        self.assertEqual(self.ml.calls,
+                         [("timer", "metric", 1), ("timer", "metric", 2)])
+
+    def test_block(self):
+        metricslogging.setAsyncOverflowPolicy("block")
+        for i in range(10):
+            self.sender.put(self.ml, self.ml.GAUGE, "metric", i)
+        self.sender.drain()
+
+        self.assertEqual(sorted(c[2] for c in self.ml.calls), list(range(10)))
+        self.assertEqual(self.sender.dropped, 0)
+
+    def test_drain_waits_for_record_in_flight(self):
+        delivering = threading.Event()
+        release = threading.Event()
+        deliver = self.ml._deliver
+
+        def slow_deliver(*args):
+            delivering.set()
+            release.wait(5)
+            deliver(*args)
+
+        with mock.patch.object(self.ml, "_deliver", slow_deliver):
+            self.sender.put(self.ml, self.ml.GAUGE, "metric", 1)
+            self.assertTrue(delivering.wait(5))
+            # The queue is empty, but the sender thread holds the record
+            self.assertFalse(self.sender.drain(0.01))
+            self.assertEqual(self.ml.calls, [])
+
+            release.set()
+            self.assertTrue(self.sender.drain())
+        self.assertEqual(self.ml.calls, [("gauge", "metric", 1)])
+
+
+class TestLogHistogram(unittest.TestCase):
+    def test_percentiles_within_precision(self):
+        histogram = metricslogging.metricslogging._LogHistogram()
+        for value in range(1, 10001):
+            histogram.record(value / 10.0)
+
+        for expected, actual in zip(
+                [10.0, 500.0, 900.0, 990.0],
+                histogram.percentiles([1, 50, 90, 99])):
+            self.assertAlmostEqual(actual, expected,
+                                   delta=expected * histogram.PRECISION)
+
+    def test_memory_bounded(self):
+        histogram = metricslogging.metricslogging._LogHistogram()
+        for exponent in range(-10, 20):
+            for value in range(1, 100):
+                histogram.record(value * 10 ** exponent)
+        self.assertTrue(len(histogram.buckets) <= histogram.NUM_BUCKETS)
+        self.assertEqual(histogram.count, 30 * 99)
+
+    def test_merge(self):
+        first = metricslogging.metricslogging._LogHistogram()
+        second = metricslogging.metricslogging._LogHistogram()
+        for value in range(1, 51):
+            first.record(value)
+        for value in range(51, 101):
+            second.record(value)
+
+        first.merge(second)
+        self.assertEqual(first.count, 100)
+        self.assertEqual(first.min, 1)
+        self.assertEqual(first.max, 100)
+        self.assertEqual(first.mean(), 50.5)
+
+    def test_empty(self):
+        histogram = metricslogging.metricslogging._LogHistogram()
+        self.assertEqual(histogram.percentiles([50, 99]), [None, None])
+        self.assertEqual(histogram.mean(), None)
+
+
+class TestAggregatingMetricsLogger(unittest.TestCase):
+    def setUp(self):
+        super(TestAggregatingMetricsLogger, self).setUp()
+        self.ml = metricslogging.AggregatingMetricsLogger()
+        self.ml.setAggregateInterval(None)
+
+        patcher = mock.patch(
+            "metricslogging.metricslogging.StatsdMetricsLogger._send")
+        self.addCleanup(patcher.stop)
+        self.mock_send = patcher.start()
+
+    def test_counters_summed(self):
+        self.ml._counter("metric", 1)
+        self.ml._counter("metric", 2)
+        self.ml._counter("other", 5)
+        self.assertFalse(self.mock_send.called)
+
+        self.ml.flush()
+        self.assertEqual(
+            sorted(self.mock_send.call_args_list),
+            sorted([mock.call("metric", 3, "c", sample_rate=None),
+                    mock.call("other", 5, "c", sample_rate=None)]))
+
+        self.mock_send.reset_mock()
+        self.ml.flush()
+        self.assertFalse(self.mock_send.called)
+
+    def test_sampled_counters_scaled(self):
+        self.ml._counter("metric", 1, sample_rate=0.5)
+        self.ml._counter("metric", 1, sample_rate=0.25)
+        self.ml._counter("metric", 1)
+        self.ml.flush()
+        self.mock_send.assert_called_once_with("metric", 7.0, "c",
+                                               sample_rate=None)
+
+    def test_gauges_keep_last_value(self):
+        self.ml._gauge("metric", 1)
+        self.ml._gauge("metric", 2)
+        self.ml.flush()
+        self.mock_send.assert_called_once_with("metric", 2, "g")
+
+    def test_timers_not_aggregated(self):
+        self.ml._timer("metric", 1)
+        self.mock_send.assert_called_once_with("metric", 1, "ms")
+
+    def test_aggregated_timers(self):
+        self.ml.setAggregateTimers(True)
+        self.ml.setTimerPercentiles((50, 99.9))
+        for value in range(1, 101):
+            self.ml._timer("metric", value)
+        self.assertFalse(self.mock_send.called)
+
+        self.ml.flush()
+        sent = dict((c[0][0], c[0][1])
+                    for c in self.mock_send.call_args_list)
+        self.assertEqual(sorted(sent), ["metric.count", "metric.max",
+                                        "metric.mean", "metric.min",
+                                        "metric.p50", "metric.p99_9"])
+        self.assertEqual(sent["metric.count"], 100)
+        self.assertEqual(sent["metric.min"], 1)
+        self.assertEqual(sent["metric.max"], 100)
+        self.assertEqual(sent["metric.mean"], 50.5)
+        self.assertAlmostEqual(sent["metric.p50"], 50, delta=1)
+        self.assertAlmostEqual(sent["metric.p99_9"], 100, delta=2)
+        self.assertTrue(all(c[0][2] == "g"
+                            for c in self.mock_send.call_args_list))
+
+    def test_concurrent_counters(self):
+        def work():
+            for i in range(1000):
+                self.ml._counter("metric", 1)
+                if i % 100 == 0:
+                    self.ml.flush()
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.ml.flush()
+
+        self.assertEqual(sum(c[0][1] for c in self.mock_send.call_args_list),
+                         8000)
+
+    def test_periodic_flush(self):
+        flushed = threading.Event()
+        self.mock_send.side_effect = lambda *a, **kw: flushed.set()
+
+        self.ml._counter("metric", 1)
+        self.ml.setAggregateInterval(0.01)
+        self.assertTrue(flushed.wait(5))
+        self.mock_send.assert_called_once_with("metric", 1, "c",
+                                               sample_rate=None)
+
+    def test_get_aggregating_logger(self):
+        metricslogging.setLoggerClass(metricslogging.AggregatingMetricsLogger)
+        self.addCleanup(metricslogging.setLoggerClass,
+                        metricslogging.StatsdMetricsLogger)
+        logger = metricslogging.initLogger("foo")
+        self.assertTrue(
+            isinstance(logger, metricslogging.AggregatingMetricsLogger))
 
 
 class TestGetLogger(unittest.TestCase):
     def setUp(self):
         super(TestGetLogger, self).setUp()
+        self.addCleanup(metricslogging.setLoggerClass,
+                        metricslogging.StatsdMetricsLogger)
+
+    def test_concurrent_get_logger(self):
+        metricslogging.setLoggerClass(metricslogging.NoopMetricsLogger)
+        real_init_logger = metricslogging.metricslogging.initLogger
+
+        def slow_init_logger(prefix):
+            time.sleep(0.001)
+            return real_init_logger(prefix)
+
+        prefixes = ["concurrent%d" % i for i in range(5)]
+        results = dict((prefix, []) for prefix in prefixes)
+        start = threading.Event()
+
+        def work():
+            start.wait()
+            for prefix in prefixes * 10:
+                results[prefix].append(metricslogging.getLogger(prefix))
+
+        with mock.patch("metricslogging.metricslogging.initLogger",
+                        side_effect=slow_init_logger) as mock_init:
+            threads = [threading.Thread(target=work) for _ in range(16)]
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(mock_init.call_count, len(prefixes))
+        for prefix, loggers in results.items():
+            self.assertEqual(len(loggers), 160)
+            self.assertEqual(len(set(map(id, loggers))), 1)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "requires os.fork")
+    def test_forked_workers(self):
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(("127.0.0.1", 0))
+        sink.settimeout(5)
+        self.addCleanup(sink.close)
+
+        logger = metricslogging.StatsdMetricsLogger()
+        logger.setPrefix("fork")
+        logger.setPrependHost(False)
+        logger.setStatsdHost("127.0.0.1")
+        logger.setStatsdPort(sink.getsockname()[1])
+        logger.setStatsdPacketSize(512)
+        logger.setStatsdFlushInterval(0.01)
+
+        # Leave buffered lines, a pooled socket and running threads behind
+        logger.counter("parent", 1)
+        logger.flush()
+        logger.counter("parent", 1)
+        parent_socket = metricslogging.metricslogging._socket_pool.get(
+            ("127.0.0.1", sink.getsockname()[1]), None)
+
+        def child(worker):
+            # With register_at_fork the hooks have already run; without it,
+            # the first send notices the new pid
+            logger.setAsyncDelivery(True)
+            for _ in range(10):
+                logger.counter("worker%d" % worker, 1)
+            metricslogging.metricslogging._async_sender.drain()
+            logger.flush()
+            sock = metricslogging.metricslogging._socket_pool.get(
+                ("127.0.0.1", sink.getsockname()[1]), None)
+            return sock is not parent_socket
+
+        pids = []
+        for worker in range(4):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    status = 0 if child(worker) else 2
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+
+        for pid in pids:
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(status, 0)
+        logger.flush()
+
+        lines = []
+        while len(lines) < 42:
+            lines.extend(sink.recv(4096).split(b"\n"))
+        self.assertEqual(lines.count(b"fork.parent:1|c"), 2)
+        for worker in range(4):
+            self.assertEqual(lines.count(b"fork.worker%d:1|c" % worker), 10)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "requires os.fork")
+    def test_fork_while_locks_held(self):
+        logger = metricslogging.StatsdMetricsLogger()
+        logger.setPrependHost(False)
+        rate_limiter = metricslogging.RateLimiter(100)
+        logger.setProcessors([rate_limiter])
+        logger.format_name("metric")
+
+        # As if other threads were formatting a name and rate limiting when
+        # the process forked
+        name_cache_lock = logger._name_cache[1]._lock
+        with name_cache_lock, rate_limiter._lock:
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    signal.alarm(5)
+                    with mock.patch.object(logger, "_deliver"):
+                        logger.gauge("metric", 1)
+                    status = 0
+                finally:
+                    os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
 
     def test_get_noop_logger(self):
         metricslogging.setLoggerClass(metricslogging.NoopMetricsLogger)
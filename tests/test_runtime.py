@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Rackspace
+# All Rights Reserved
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import gc
+import metricslogging
+import metricslogging.runtime
+import mock
+import os
+import signal
+import socket
+import threading
+import unittest
+
+
+STAT = (b"4242 (my (odd) cmd) S 1 4242 4242 0 -1 4194304 1500 0 3 0 "
+        b"250 50 0 0 20 0 7 0 12345 104857600 2560 18446744073709551615")
+
+STATUS = (b"Name:\tpython\nVmPeak:\t  102400 kB\nVmHWM:\t   12000 kB\n"
+          b"VmRSS:\t   10240 kB\nVmSwap:\t       8 kB\nThreads:\t7\n"
+          b"voluntary_ctxt_switches:\t150\n"
+          b"nonvoluntary_ctxt_switches:\t12\n")
+
+
+class TestRuntimeCollector(unittest.TestCase):
+    def setUp(self):
+        super(TestRuntimeCollector, self).setUp()
+        self.collector = metricslogging.runtime.RuntimeCollector()
+        self.collector._proc = True
+        self.collector._clock_ticks = 100.0
+        self.collector._page_size = 4096
+
+        files = {metricslogging.runtime._PROC_STAT: STAT,
+                 metricslogging.runtime._PROC_STATUS: STATUS}
+        for target, kwargs in [
+                ("metricslogging.runtime._read",
+                 {"side_effect": files.__getitem__}),
+                ("os.listdir", {"return_value": ["0", "1", "2", "5"]})]:
+            patcher = mock.patch(target, **kwargs)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+
+    def test_proc(self):
+        values = self.collector.collect()
+        self.assertEqual(values[("page_faults", "minor")], 1500)
+        self.assertEqual(values[("page_faults", "major")], 3)
+        self.assertEqual(values[("threads", "os")], 7)
+        self.assertEqual(values[("memory", "vms")], 104857600)
+        self.assertEqual(values[("memory", "rss")], 2560 * 4096)
+        self.assertEqual(values[("memory", "rss_peak")], 12000 * 1024)
+        self.assertEqual(values[("memory", "swap")], 8 * 1024)
+        self.assertEqual(values[("context_switches", "voluntary")], 150)
+        self.assertEqual(values[("context_switches", "involuntary")], 12)
+        self.assertEqual(values["fds"], 3)
+        self.assertTrue(values[("threads", "python")] >= 1)
+        self.assertTrue(("gc", "gen0", "count") in values)
+
+    def test_cpu_from_proc_without_resource(self):
+        with mock.patch("metricslogging.runtime.resource", None):
+            values = self.collector.collect()
+        self.assertEqual(values[("cpu", "user")], 2.5)
+        self.assertEqual(values[("cpu", "system")], 0.5)
+
+    def test_without_proc(self):
+        self.collector._proc = False
+        values = self.collector.collect()
+        self.assertFalse(("memory", "rss") in values)
+        self.assertFalse("fds" in values)
+        if metricslogging.runtime.resource is not None:
+            self.assertTrue(("memory", "rss_peak") in values)
+            self.assertTrue(("cpu", "user") in values)
+
+    def test_cpu_percent(self):
+        with mock.patch("metricslogging.runtime.resource", None):
+            with mock.patch("metricslogging.metricslogging._monotonic",
+                            side_effect=[10.0, 12.0]):
+                first = self.collector.collect()
+                self.collector._clock_ticks = 50.0
+                second = self.collector.collect()
+        self.assertFalse(("cpu", "percent") in first)
+        # 3.0s of CPU became 6.0s over 2.0s
+        self.assertEqual(second[("cpu", "percent")], 150.0)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "requires os.fork")
+    def test_fork_while_locked(self):
+        with self.collector._lock:
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    signal.alarm(5)
+                    self.collector.collect()
+                    status = 0
+                finally:
+                    os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
+    def test_install(self):
+        ml = metricslogging.StatsdMetricsLogger()
+        ml.setPrefix("service")
+        ml.setPrependHost(False)
+        registration = metricslogging.runtime.install(ml, interval=3600)
+        self.addCleanup(registration.remove)
+        group = metricslogging.metricslogging._collectors._groups[3600]
+
+        with mock.patch.object(ml, "_write_many") as mock_write_many:
+            group.collect()
+        lines = mock_write_many.call_args[0][0]
+        self.assertTrue(b"service.runtime.memory.rss:10485760|g" in lines)
+        self.assertTrue(b"service.runtime.fds:3|g" in lines)
+
+
+@unittest.skipUnless(os.path.isdir(metricslogging.runtime._PROC_FD),
+                     "requires /proc")
+class TestRuntimeCollectorProc(unittest.TestCase):
+    def test_fds(self):
+        fds = metricslogging.runtime.RuntimeCollector().collect()["fds"]
+        # The fd listdir() opened is closed again by now
+        open_fds = 0
+        for fd in os.listdir(metricslogging.runtime._PROC_FD):
+            try:
+                os.fstat(int(fd))
+            except OSError:
+                continue
+            open_fds += 1
+        self.assertEqual(fds, open_fds)
+
+
+@unittest.skipUnless(hasattr(gc, "callbacks"), "requires gc.callbacks")
+class TestGcPauseTimer(unittest.TestCase):
+    def setUp(self):
+        super(TestGcPauseTimer, self).setUp()
+        self.ml = mock.Mock()
+        self.handles = [mock.Mock(), mock.Mock(), mock.Mock()]
+        self.ml.timer_handle.side_effect = self.handles
+
+    def test_times_collections(self):
+        timer = metricslogging.runtime.GcPauseTimer(self.ml, tags={"a": "b"})
+        self.assertEqual(self.ml.timer_handle.call_args_list, [
+            mock.call(["gc", "pause", "gen%d" % i], tags={"a": "b"})
+            for i in range(3)])
+
+        timer.install()
+        timer.install()
+        self.addCleanup(timer.uninstall)
+        self.assertEqual(gc.callbacks.count(timer._callback), 1)
+        gc.collect()
+        gc.collect(1)
+        timer.uninstall()
+        gc.collect()
+
+        self.assertEqual(self.handles[2].record.call_count, 1)
+        self.assertEqual(self.handles[1].record.call_count, 1)
+        self.assertTrue(self.handles[2].record.call_args[0][0] >= 0)
+        self.assertFalse(timer.installed)
+
+    def test_generations(self):
+        with mock.patch("metricslogging.metricslogging._time_ns",
+                        side_effect=[0, 1000000, 3500000]):
+            timer = metricslogging.runtime.GcPauseTimer(
+                self.ml, name="gc", generations=(2,))
+            timer._callback("start", {"generation": 0})
+            timer._callback("stop", {"generation": 0})
+            timer._callback("start", {"generation": 2})
+            timer._callback("stop", {"generation": 2})
+        self.assertEqual(self.ml.timer_handle.call_count, 1)
+        self.assertFalse(self.handles[0].record.called)
+        timer.flush()
+        self.handles[0].record.assert_called_once_with(2.5)
+
+    def test_pending_bounded(self):
+        timer = metricslogging.runtime.GcPauseTimer(self.ml)
+        timer.MAX_PENDING = 2
+        for _ in range(3):
+            timer._callback("start", {"generation": 0})
+            timer._callback("stop", {"generation": 0})
+        self.assertEqual(timer.dropped, 1)
+        timer.flush()
+        self.assertEqual(self.handles[0].record.call_count, 2)
+
+
+@unittest.skipUnless(hasattr(gc, "callbacks"), "requires gc.callbacks")
+class TestGcPauseTimerLoggers(unittest.TestCase):
+    """Collections triggered inside the emit paths, which hold locks."""
+    def setUp(self):
+        super(TestGcPauseTimerLoggers, self).setUp()
+        self.sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.sink.close)
+        self.sink.bind(("127.0.0.1", 0))
+
+    def configure(self, ml):
+        ml.setPrependHost(False)
+        ml.setStatsdHost("127.0.0.1")
+        ml.setStatsdPort(self.sink.getsockname()[1])
+        return ml
+
+    def assert_no_deadlock(self, ml):
+        timer = metricslogging.runtime.GcPauseTimer(ml, flush_interval=0.01)
+        timer.install()
+        self.addCleanup(timer.uninstall)
+
+        def emit():
+            for i in range(2000):
+                ml.timer("metric%d" % (i % 100), 1.0)
+
+        thread = threading.Thread(target=emit)
+        thread.daemon = True
+        threshold = gc.get_threshold()
+        gc.set_threshold(1)
+        try:
+            thread.start()
+            thread.join(10)
+        finally:
+            gc.set_threshold(*threshold)
+        self.assertFalse(thread.is_alive())
+        timer.uninstall()
+        self.assertFalse(timer._pending)
+
+    def test_aggregating_timers(self):
+        ml = self.configure(metricslogging.AggregatingMetricsLogger())
+        ml.setAggregateInterval(None)
+        ml.setAggregateTimers(True)
+        self.assert_no_deadlock(ml)
+
+    def test_batching(self):
+        ml = self.configure(metricslogging.StatsdMetricsLogger())
+        ml.setStatsdPacketSize(512)
+        ml.setStatsdFlushInterval(None)
+        self.assert_no_deadlock(ml)
+
+
+if __name__ == "__main__":
+    unittest.main()